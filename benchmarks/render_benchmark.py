@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Benchmark template rendering against synthetic configs of increasing size
+
+Each scenario scales the number of ELBs, security group ingress rules,
+s3 buckets, ELB policies and include files. For each one we time
+ConfigParser.process() (from scratch and re-rendering an unchanged
+config), ec2(), elb(), s3() and mime_packer.pack(), and
+report the size of the rendered template and the peak memory of the
+process. Every scenario runs in its own python process so that the peak
+memory figures don't bleed into each other.
+
+Every timed call is paired with a run of a fixed calibration workload
+that doesn't touch bootstrap_cfn, and each benchmark records the median
+ratio of the two. The ratios are what get compared to the baselines, so
+that a faster or slower machine, or one that gets busier part way through,
+doesn't show up as a change in the render path.
+
+Usage:
+    python benchmarks/render_benchmark.py                 # run and compare to the baselines
+    python benchmarks/render_benchmark.py --save          # run and store new baselines
+    python benchmarks/render_benchmark.py --scenario large --repeat 50
+
+Exits non-zero if any relative timing, memory or size figure has grown by
+more than --tolerance over its baseline.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bootstrap_cfn import mime_packer  # noqa: E402
+from bootstrap_cfn.config import ConfigParser, ProjectConfig  # noqa: E402
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# How far each scenario scales the parts of the config
+SCENARIOS = {
+    'small': {'elbs': 1, 'sg_rules': 2, 'buckets': 1, 'policies': 1, 'includes': 1},
+    'medium': {'elbs': 10, 'sg_rules': 50, 'buckets': 10, 'policies': 5, 'includes': 5},
+    'large': {'elbs': 50, 'sg_rules': 250, 'buckets': 50, 'policies': 20, 'includes': 20},
+}
+
+BENCHMARKS = ['process', 'process_compact', 'process_incremental', 'ec2', 'elb', 's3', 'mime_pack']
+
+
+def build_config(scale, work_dir):
+    """
+    Write a synthetic project config, and the policy and include files it
+    refers to, into work_dir
+
+    Returns:
+        (string): The path of the project config
+    """
+    policy_files = []
+    for i in range(scale['buckets']):
+        path = os.path.join(work_dir, 'bucket-policy-{0}.json'.format(i))
+        with open(path, 'w') as f:
+            json.dump({'Action': ['s3:GetObject'],
+                       'Resource': 'arn:aws:s3:::bench-bucket-{0}/*'.format(i),
+                       'Effect': 'Allow',
+                       'Principal': '*'}, f)
+        policy_files.append(path)
+
+    include_files = []
+    for i in range(scale['includes']):
+        path = os.path.join(work_dir, 'include-{0}.json'.format(i))
+        with open(path, 'w') as f:
+            json.dump({'Outputs': {'IncludedOutput{0}'.format(i): {'Value': 'included-{0}'.format(i)}}}, f)
+        include_files.append(path)
+
+    ingress = [{'IpProtocol': 'tcp',
+                'FromPort': 1000 + i,
+                'ToPort': 1000 + i,
+                'CidrIp': '10.{0}.{1}.0/24'.format(i // 256, i % 256)}
+               for i in range(scale['sg_rules'])]
+
+    elbs = []
+    for i in range(scale['elbs']):
+        elbs.append({
+            'name': 'bench-elb-{0}'.format(i),
+            'hosted_zone': 'bench.example.com.',
+            'scheme': 'internet-facing' if i % 2 == 0 else 'internal',
+            'listeners': [{'LoadBalancerPort': 80, 'InstancePort': 80, 'Protocol': 'TCP'},
+                          {'LoadBalancerPort': 443, 'InstancePort': 443, 'Protocol': 'TCP'}],
+            'policies': [{'name': 'BenchPolicy{0}'.format(p),
+                          'type': 'BackendServerAuthenticationPolicyType',
+                          'instance_ports': [443],
+                          'attributes': [{'PublicKeyPolicyName': 'BenchKey{0}'.format(p)}]}
+                         for p in range(scale['policies'])],
+        })
+
+    config = {'bench': {
+        'vpc': {'CIDR': '10.0.0.0/16',
+                'SubnetA': '10.0.0.0/20',
+                'SubnetB': '10.0.16.0/20',
+                'SubnetC': '10.0.32.0/20'},
+        'ec2': {
+            'auto_scaling': {'desired': 1, 'max': 3, 'min': 0},
+            'tags': {'Role': 'bench', 'Apps': 'bench'},
+            'parameters': {'KeyName': 'default', 'InstanceType': 't2.micro'},
+            'block_devices': [{'DeviceName': '/dev/sda1', 'VolumeSize': 10}],
+            'security_groups': {'BaseHostSG': ingress},
+            'cloud_config': {'manage_etc_hosts': True,
+                             'runcmd': ['echo {0}'.format(i) for i in range(scale['sg_rules'])]},
+        },
+        'elb': elbs,
+        's3': {'static-bucket-name': 'bench-static',
+               'buckets': [{'name': 'BenchBucket{0}'.format(i), 'policy': policy_file}
+                           for i, policy_file in enumerate(policy_files)]},
+        'includes': include_files,
+    }}
+    config_path = os.path.join(work_dir, 'bench.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def calibrate():
+    """
+    Fixed pure python and json work to measure the speed of the machine by
+    """
+    data = [{'Key': str(i), 'Value': range(20)} for i in range(200)]
+    json.loads(json.dumps(data, sort_keys=True))
+    sum(len(str(i)) for i in xrange(5000))
+
+
+def _elapsed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def _time(func, repeat):
+    """
+    Returns:
+        (dict): The best and median wall time of repeat calls, in seconds,
+            and the median of each call's time relative to a calibration
+            run made just before it
+    """
+    # The first call pays for imports and filling caches
+    func()
+    timings = []
+    ratios = []
+    for _ in range(repeat):
+        calibration = _elapsed(calibrate)
+        timings.append(_elapsed(func))
+        ratios.append(timings[-1] / calibration)
+    timings.sort()
+    ratios.sort()
+    return {'best': round(timings[0], 6), 'median': round(timings[len(timings) // 2], 6),
+            'relative': round(ratios[len(ratios) // 2], 4)}
+
+
+def run_scenario(name, repeat):
+    """
+    Run every benchmark for one scenario in this process
+
+    Returns:
+        (dict): Timings per benchmark, template sizes and peak memory
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        config_path = build_config(SCENARIOS[name], work_dir)
+        project_config = ProjectConfig(config_path, 'bench')
+        parser = ConfigParser(project_config.config, 'bench-bench-12345678', 'bench', 'bench')
+
+        def process(compact=False):
+            # Full render, without reusing sections from the previous one
+            parser.invalidate_sections()
+            return parser.process(compact=compact)
+
+        def ec2():
+            parser.invalidate_sections('ec2')
+            parser.ec2()
+
+        user_data = parser.get_ec2_userdata()
+
+        timings = {
+            'process': _time(process, repeat),
+            'process_compact': _time(lambda: process(compact=True), repeat),
+            # Render again with an unchanged config
+            'process_incremental': _time(parser.process, repeat),
+            'ec2': _time(ec2, repeat),
+            'elb': _time(lambda: parser.elb(parser.base_template()), repeat),
+            's3': _time(lambda: parser.s3(parser.base_template()), repeat),
+            'mime_pack': _time(lambda: mime_packer.pack(user_data), repeat),
+        }
+        sizes = {
+            'template_bytes': len(process()),
+            'compact_template_bytes': len(process(compact=True)),
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    # ru_maxrss is in kilobytes on linux, bytes on OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {'timings': timings, 'sizes': sizes, 'peak_rss_kb': peak_rss}
+
+
+def run_scenario_subprocess(name, repeat):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--run-scenario', name, '--repeat', str(repeat)])
+    return json.loads(output.splitlines()[-1])
+
+
+def compare_to_baselines(results, baselines, tolerance):
+    """
+    Returns:
+        (list): A description of each figure that has grown by more than
+            tolerance (a fraction) over its baseline
+    """
+    regressions = []
+
+    def check(label, value, baseline):
+        if baseline and value > baseline * (1 + tolerance):
+            regressions.append("{0}: {1} is more than {2:.0%} over the baseline {3}".format(
+                label, value, tolerance, baseline))
+
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        for benchmark, timing in sorted(result['timings'].items()):
+            check("{0} {1} time relative to calibration".format(name, benchmark),
+                  timing['relative'], baseline['timings'].get(benchmark, {}).get('relative'))
+        for size, value in sorted(result['sizes'].items()):
+            check("{0} {1}".format(name, size), value, baseline['sizes'].get(size))
+        check("{0} peak_rss_kb".format(name), result['peak_rss_kb'], baseline.get('peak_rss_kb'))
+    return regressions
+
+
+def print_results(results):
+    header = "{0:<8} {1:<20} {2:>12} {3:>12} {4:>10}".format(
+        'scenario', 'benchmark', 'best (ms)', 'median (ms)', 'relative')
+    print header
+    print '-' * len(header)
+    for name in sorted(results, key=lambda n: SCENARIOS[n]['elbs']):
+        result = results[name]
+        for benchmark in BENCHMARKS:
+            timing = result['timings'][benchmark]
+            print "{0:<8} {1:<20} {2:>12.2f} {3:>12.2f} {4:>10.3f}".format(
+                name, benchmark, timing['best'] * 1000, timing['median'] * 1000, timing['relative'])
+        print "{0:<8} template {1} bytes, compact {2} bytes, peak rss {3} KB".format(
+            name, result['sizes']['template_bytes'], result['sizes']['compact_template_bytes'],
+            result['peak_rss_kb'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cloudformation template rendering")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Scenario to run, can be given more than once. All of them by default")
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="Number of times to run each benchmark")
+    parser.add_argument('--save', action='store_true',
+                        help="Store the results as the new baselines")
+    parser.add_argument('--baselines', default=BASELINES_FILE,
+                        help="Baselines file to compare against or save to")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fraction a figure can grow over its baseline before it is a regression")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        # Child process, print the results for the parent to read
+        print json.dumps(run_scenario(args.run_scenario, args.repeat))
+        return 0
+
+    scenarios = args.scenario or sorted(SCENARIOS)
+    results = dict((name, run_scenario_subprocess(name, args.repeat)) for name in scenarios)
+    print_results(results)
+
+    if args.save:
+        baselines = {}
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True, separators=(',', ': '))
+        print "\nSaved baselines to {0}".format(args.baselines)
+        return 0
+
+    if not os.path.exists(args.baselines):
+        print "\nNo baselines at {0}, run with --save to create them".format(args.baselines)
+        return 0
+    with open(args.baselines) as f:
+        baselines = json.load(f)
+    regressions = compare_to_baselines(results, baselines, args.tolerance)
+    if regressions:
+        print "\nREGRESSIONS:"
+        for regression in regressions:
+            print "  " + regression
+        return 1
+    print "\nNo regressions against {0}".format(args.baselines)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
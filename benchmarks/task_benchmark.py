@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Benchmark fab task flows end to end without AWS, by replaying a cassette
+of recorded AWS responses
+
+Record a cassette once against AWS with the cassette task:
+
+    fab application:courtfinder aws:dev environment:dev config:courtfinder-dev.yaml \\
+        cassette:/tmp/cfn-create.json,mode=record cfn_create
+
+then replay the same tasks as often as you like, offline:
+
+    python benchmarks/task_benchmark.py /tmp/cfn-create.json application:courtfinder aws:dev \\
+        environment:dev config:courtfinder-dev.yaml cfn_create
+
+Tasks are given as on the fab command line. Each run reports its wall
+time, the time the tasks would have spent sleeping between polls, which
+is skipped unless --sleep is given, and the AWS API calls made.
+
+Usage:
+    python benchmarks/task_benchmark.py CASSETTE TASK [TASK ...]
+    python benchmarks/task_benchmark.py --repeat 10 CASSETTE TASK [TASK ...]
+    python benchmarks/task_benchmark.py --latency 0.05 CASSETTE TASK [TASK ...]   # or --latency recorded
+    python benchmarks/task_benchmark.py --profile /tmp/cfn-create.prof CASSETTE TASK [TASK ...]
+"""
+
+import argparse
+import cProfile
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric.main import parse_arguments  # noqa: E402
+
+from bootstrap_cfn import api_metrics, cloudformation, config, fab_tasks, utils  # noqa: E402
+from bootstrap_cfn.cassette import Cassette  # noqa: E402
+
+
+class SkippedSleeps(object):
+    """
+    Stands in for time.sleep, adding up the time slept instead of
+    sleeping, and for the poll clock, moved on by the time slept so that
+    timeouts still work
+    """
+
+    def __init__(self):
+        self.seconds = 0
+        self._monotonic = utils._monotonic
+
+    def sleep(self, seconds):
+        self.seconds += seconds
+
+    def monotonic(self):
+        return self._monotonic() + self.seconds
+
+
+def run_tasks(cassette_path, tasks, latency=0, sleep=False, profiler=None):
+    """
+    Run fab tasks once, answering their AWS calls from a cassette
+
+    Args:
+        cassette_path(string): The cassette file
+        tasks(list): Tasks as given on the fab command line
+        latency(float or string): Seconds to wait before each response,
+            or 'recorded'
+        sleep(bool): True to really sleep between polls
+        profiler(Profile): Optional profiler to run the tasks under
+
+    Returns:
+        (dict): The wall time, time spent in skipped sleeps, number of
+            API calls and any error
+    """
+    # Start from cold caches and connections, as a new fab run would
+    api_metrics.metrics.reset()
+    cloudformation.resource_cache.invalidate()
+    cloudformation.stack_index.invalidate()
+    config._parsed_yaml.clear()
+    with utils._role_credentials_lock:
+        utils._role_credentials.clear()
+    utils.connections.clear()
+    utils.connections.use_cassette(Cassette(cassette_path, latency=latency,
+                                            region_name=fab_tasks.env.aws_region))
+
+    skipped = SkippedSleeps()
+    real_sleep, real_monotonic = time.sleep, utils._monotonic
+    if not sleep:
+        time.sleep, utils._monotonic = skipped.sleep, skipped.monotonic
+    error = None
+    start = real_monotonic()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        for name, args, kwargs, _, _, _ in parse_arguments(tasks):
+            getattr(fab_tasks, name)(*args, **kwargs)
+    except (Exception, SystemExit) as e:
+        error = "{0}: {1}".format(e.__class__.__name__, e)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        time.sleep, utils._monotonic = real_sleep, real_monotonic
+    return {'seconds': real_monotonic() - start,
+            'skipped_sleep_seconds': skipped.seconds,
+            'api_calls': sum(row['calls'] for row in api_metrics.metrics.summary()),
+            'error': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fab tasks offline from a cassette")
+    parser.add_argument('cassette', help="Cassette recorded with the cassette task")
+    parser.add_argument('tasks', nargs='+', help="Tasks to run, as on the fab command line")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of times to run the tasks")
+    parser.add_argument('--latency', default=0,
+                        help="Seconds to wait before each replayed response, or 'recorded'")
+    parser.add_argument('--sleep', action='store_true',
+                        help="Really sleep between polls instead of skipping the waits")
+    parser.add_argument('--profile',
+                        help="Write the cProfile stats of the last run to this file")
+    args = parser.parse_args()
+
+    timings = []
+    for run in range(args.repeat):
+        last = run == args.repeat - 1
+        profiler = cProfile.Profile() if args.profile and last else None
+        result = run_tasks(args.cassette, args.tasks, latency=args.latency,
+                           sleep=args.sleep, profiler=profiler)
+        print "run {0}: {1:.3f}s, {2:.1f}s of sleeps skipped, {3} API calls".format(
+            run + 1, result['seconds'], result['skipped_sleep_seconds'], result['api_calls'])
+        if result['error']:
+            print "run {0} failed: {1}".format(run + 1, result['error'])
+            return 1
+        timings.append(result['seconds'])
+        if profiler is not None:
+            profiler.dump_stats(args.profile)
+
+    timings.sort()
+    print "\nbest {0:.3f}s, median {1:.3f}s over {2} runs\n".format(
+        timings[0], timings[len(timings) // 2], len(timings))
+    print api_metrics.metrics.format_summary()
+    if args.profile:
+        print "\nProfile of the last run written to {0}".format(args.profile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import json
+import re
+import threading
+import time
+
+import boto.connection
+import boto.exception
+
+# Error codes AWS services use to say a call was throttled
+THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                          'TooManyRequestsException', 'PriorRequestNotComplete',
+                          'RequestThrottled', 'SlowDown']
+
+# Clock for call latencies, which isn't affected by changes to the system
+# time where python provides one
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class ApiMetrics(object):
+    """
+    Counts and timings of the AWS API calls made by this process, per
+    service and operation
+    """
+
+    def __init__(self):
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def record(self, service, operation, seconds, retries=0, throttles=None, error_code=None):
+        """
+        Record one API call
+
+        Args:
+            service(string): The service, e.g. cloudformation
+            operation(string): The operation, e.g. DescribeStacks
+            seconds(float): How long the call took, including any retries
+            retries(int): How many times the call was retried
+            throttles(int): How many of its attempts were throttled. By
+                default 1 if it failed with a throttling error, else 0
+            error_code(string): The error the call failed with, if it did
+        """
+        if throttles is None:
+            throttles = 1 if error_code in THROTTLING_ERROR_CODES else 0
+        with self._lock:
+            stats = self._stats(service, operation)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['throttles'] += throttles
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if error_code is not None:
+                stats['errors'] += 1
+
+    def record_retry(self, service, operation, error_code=None):
+        """
+        Record a retry of a call, for retries made outside of the call
+        that record() times, e.g. by a wrapper around a boto connection
+
+        Args:
+            service(string): The service, e.g. cloudformation
+            operation(string): The operation, e.g. DescribeStacks
+            error_code(string): The error of the attempt being retried
+        """
+        with self._lock:
+            stats = self._stats(service, operation)
+            stats['retries'] += 1
+            if error_code in THROTTLING_ERROR_CODES:
+                stats['throttles'] += 1
+
+    def _stats(self, service, operation):
+        return self._operations.setdefault((service, operation), {
+            'calls': 0, 'errors': 0, 'throttles': 0, 'retries': 0,
+            'seconds': 0.0, 'max_seconds': 0.0})
+
+    def summary(self):
+        """
+        Returns:
+            (list): A dict of the service, operation, calls, errors,
+                throttles, retries and total and maximum seconds of each
+                operation called, the slowest in total first
+        """
+        with self._lock:
+            rows = [dict(stats, service=service, operation=operation)
+                    for (service, operation), stats in self._operations.items()]
+        for row in rows:
+            row['seconds'] = round(row['seconds'], 3)
+            row['max_seconds'] = round(row['max_seconds'], 3)
+        return sorted(rows, key=lambda row: (-row['seconds'], row['service'], row['operation']))
+
+    def format_summary(self):
+        """
+        Returns:
+            (string): The summary as a table
+        """
+        rows = self.summary()
+        header = "{0:<16} {1:<36} {2:>6} {3:>6} {4:>9} {5:>7} {6:>9} {7:>9}".format(
+            'service', 'operation', 'calls', 'errors', 'throttles', 'retries', 'total (s)', 'max (s)')
+        lines = [header, '-' * len(header)]
+        for row in rows:
+            lines.append("{service:<16} {operation:<36} {calls:>6} {errors:>6} {throttles:>9} "
+                         "{retries:>7} {seconds:>9.3f} {max_seconds:>9.3f}".format(**row))
+        lines.append("{0} calls taking {1:.3f}s".format(
+            sum(row['calls'] for row in rows), sum(row['seconds'] for row in rows)))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True, separators=(',', ': '))
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+
+metrics = ApiMetrics()
+
+
+def boto_operation(conn, args, kwargs):
+    """Work out the operation a boto make_request call is for"""
+    if isinstance(conn, boto.connection.AWSQueryConnection):
+        return kwargs.get('action', args[0] if args else 'unknown')
+    # REST APIs, e.g. route53. Name the operation after the method and the
+    # last part of the path that isn't an id, e.g. "POST rrset"
+    method = kwargs.get('method', args[0] if args else 'GET')
+    path = kwargs.get('path', args[1] if len(args) > 1 else '/')
+    parts = [part for part in path.split('?')[0].split('/') if re.match(r'^[a-z]+$', part)]
+    return "{0} {1}".format(method, parts[-1] if parts else '/')
+
+
+def boto_error_code(response):
+    """Get the error code of a failed boto response, leaving it readable"""
+    # boto's HTTPResponse caches the body, so the caller can still read it
+    match = re.search(r'<Code>([^<]+)</Code>', response.read() or '')
+    return match.group(1) if match else str(response.status)
+
+
+def instrument_connection(conn, service_name):
+    """
+    Record every call a boto connection makes in metrics
+
+    Args:
+        conn(AWSAuthConnection): The connection
+        service_name(string): The service, e.g. cloudformation
+
+    Returns:
+        The connection
+    """
+    # connect_to_region returns None for regions the service isn't in
+    if conn is None:
+        return conn
+    make_request = conn.make_request
+
+    def instrumented_make_request(*args, **kwargs):
+        operation = boto_operation(conn, args, kwargs)
+        error_code = None
+        start = _monotonic()
+        try:
+            response = make_request(*args, **kwargs)
+            if getattr(response, 'status', 200) >= 300:
+                error_code = boto_error_code(response)
+            return response
+        except boto.exception.BotoServerError as e:
+            error_code = e.error_code or str(e.status)
+            raise
+        except Exception as e:
+            error_code = e.__class__.__name__
+            raise
+        finally:
+            metrics.record(service_name, operation, _monotonic() - start, error_code=error_code)
+
+    conn.make_request = instrumented_make_request
+    return conn
+
+
+def instrument_client(client):
+    """
+    Record every call a boto3 client makes in metrics, with the retries
+    botocore made for it
+
+    Returns:
+        The client
+    """
+    service_name = client.meta.service_model.service_name
+
+    def start_call(context, **kwargs):
+        context['bootstrap_cfn_start'] = _monotonic()
+
+    def seconds(context):
+        start = context.get('bootstrap_cfn_start')
+        return _monotonic() - start if start is not None else 0.0
+
+    def check_throttled(response, request_dict, **kwargs):
+        # Called after every attempt, before botocore decides whether to
+        # retry it
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            context = request_dict['context']
+            context['bootstrap_cfn_throttles'] = context.get('bootstrap_cfn_throttles', 0) + 1
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        error_code = None
+        if http_response.status_code >= 300:
+            error_code = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        throttles = max(context.get('bootstrap_cfn_throttles', 0),
+                        1 if error_code in THROTTLING_ERROR_CODES else 0)
+        metrics.record(service_name, model.name, seconds(context), retries=retries,
+                       throttles=throttles, error_code=error_code)
+
+    def after_call_error(exception, context, **kwargs):
+        # The model isn't passed for connection errors, only the event name
+        operation = kwargs.get('event_name', '').split('.')[-1]
+        metrics.record(service_name, operation, seconds(context), error_code=exception.__class__.__name__)
+
+    # Start the clock when the parameters are built rather than on
+    # before-call, as handlers that answer before-call (e.g. a Stubber)
+    # stop the others from running
+    client.meta.events.register('before-parameter-build', start_call)
+    client.meta.events.register('needs-retry', check_throttled)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+    return client
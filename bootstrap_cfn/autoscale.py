@@ -1,21 +1,21 @@
 import logging
+import math
 
 import boto.ec2.autoscale
 
-import boto3
-
 from bootstrap_cfn import utils
 
-from bootstrap_cfn.errors import AutoscalingGroupNotFound, AutoscalingInstanceCountError
+from bootstrap_cfn.errors import AutoscalingGroupNotFound, AutoscalingInstanceCountError, CfnTimeoutError
 
 
 class Autoscale:
 
+    conn_asg = utils.PooledConnection(boto.ec2.autoscale)
+
     def __init__(self, aws_profile_name, aws_region_name='eu-west-1'):
         self.group = None
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
-        self.conn_asg = utils.connect_to_aws(boto.ec2.autoscale, self)
 
     def set_autoscaling_group(self, name):
         for grp in self.get_all_autoscaling_groups():
@@ -54,18 +54,23 @@ class Autoscale:
             all_asgs += response
         return all_asgs
 
-    def cycle_instances(self, termination_delay=None):
+    def cycle_instances(self, termination_delay=None, batch_size=1, surge=False):
         """
-        Cycle all the instances in an autoscaling group, waiting for the
-        specified delay before terminating each instance that was replaced
+        Cycle all the instances in an autoscaling group, batch_size at a
+        time, waiting for the specified delay before terminating each
+        batch of instances that was replaced
 
         Args:
-            termination_delay(int): The delay in seconds between the new instance becoming
-                healthy and in-service, and the termination of the old one its replacing.
+            termination_delay(int): The delay in seconds between the new instances becoming
+                healthy and in-service, and the termination of the old ones they're replacing.
+            batch_size(int or string): The number of instances to replace at once, or a
+                percentage of the group, e.g. '25%'
+            surge(bool): Add a replacement for every instance before terminating any of
+                the old ones, the same as a batch_size of 100%
         """
 
         logger = logging.getLogger("bootstrap-cfn")
-        client = boto3.client('autoscaling')
+        client = utils.connections.client('autoscaling')
 
         # Use the type of health check the ASG is using to determine a sensible default for termination
         # delay. The ELB check is more nuanced and should know what a healthy service really looks like.
@@ -82,17 +87,25 @@ class Autoscale:
 
         # save the number of instances before starting the upgrade
         num_instances = len(current_instance_ids)
+        if surge:
+            batch_size = num_instances
+        batch_size = self.get_batch_size(batch_size, num_instances)
+        logger.info("cycle_instances: Replacing {} instances at a time".format(batch_size))
 
         # get the ASG HealthCheckGracePeriod
         health_check_grace_period = self.group.health_check_period
         logger.info("ASG HealthCheckGracePeriod: %s" % health_check_grace_period)
 
-        # Iterate through the current instances, replacing current instances with new ones
-        for current_instance_id in current_instance_ids:
-            # Set the desired instances +1 and wait for it to be created
-            logger.info("cycle_instances: Creating new instance...")
-            self.set_autoscaling_desired_capacity(len(current_instance_ids) + 1)
-            self.wait_for_instances(len(current_instance_ids) + 1)
+        # Iterate through the current instances a batch at a time, replacing current instances
+        # with new ones. Every batch waits for one grace period and termination delay.
+        for start in range(0, num_instances, batch_size):
+            batch = current_instance_ids[start:start + batch_size]
+            expected_instances = num_instances + len(batch)
+
+            # Set the desired instances + the batch size and wait for them to be created
+            logger.info("cycle_instances: Creating {} new instances...".format(len(batch)))
+            self.set_autoscaling_desired_capacity(expected_instances)
+            self.wait_for_instances(expected_instances)
 
             # wait for the same time as the "HealthCheckGracePeriod" in the ASG
             logger.info("Waiting %ss - HealthCheckGracePeriod" % health_check_grace_period)
@@ -100,34 +113,60 @@ class Autoscale:
             logger.info("End of waiting period")
 
             # check if the number of healthy instances is = to the number of expected instances, where
-            # expected instances is num_instances + 1
+            # expected instances is num_instances + the batch size
             new_curr_inst_ids = [instance.get('InstanceId') for instance in self.get_healthy_instances()]
             logger.info("new instance list %r" % new_curr_inst_ids)
-            if len(new_curr_inst_ids) != num_instances + 1:
+            if len(new_curr_inst_ids) != expected_instances:
                 logger.error("Expected %s instances, found %s." %
-                             (num_instances + 1, len(new_curr_inst_ids)))
-                raise AutoscalingInstanceCountError(self.group.name, num_instances + 1, new_curr_inst_ids)
+                             (expected_instances, len(new_curr_inst_ids)))
+                raise AutoscalingInstanceCountError(self.group.name, expected_instances, new_curr_inst_ids)
             else:
                 logger.info("Expected %s instances, found %s." %
-                            (num_instances + 1, len(new_curr_inst_ids)))
+                            (expected_instances, len(new_curr_inst_ids)))
 
-            # If we have a delay before termination defined, delay before terminating the current instance
-            logger.info("cycle_instances: Terminating recycled instance {} after {} seconds..."
-                        .format(current_instance_id, termination_delay))
+            # If we have a delay before termination defined, delay before terminating the current instances
+            logger.info("cycle_instances: Terminating recycled instances {} after {} seconds..."
+                        .format(batch, termination_delay))
             if termination_delay:
                 logger.info("Waiting %ss - termination_delay" % termination_delay)
                 utils.sleep_countdown(termination_delay)
                 logger.info("End of waiting period")
-            client.terminate_instance_in_auto_scaling_group(
-                InstanceId=current_instance_id,
-                ShouldDecrementDesiredCapacity=True
-            )
+            for current_instance_id in batch:
+                client.terminate_instance_in_auto_scaling_group(
+                    InstanceId=current_instance_id,
+                    ShouldDecrementDesiredCapacity=True
+                )
         new_instance_ids = [instance.get('InstanceId') for instance in self.get_healthy_instances()]
         logger.info("cycle_instances: {} instances recycled, {}"
                     .format(len(current_instance_ids), current_instance_ids))
         logger.info("cycle_instances: {} instances created, {}"
                     .format(len(new_instance_ids), new_instance_ids))
 
+    def get_batch_size(self, batch_size, num_instances):
+        """
+        Work out how many instances to replace at once, keeping the group
+        within its MaxSize while the replacements are added
+
+        Args:
+            batch_size(int or string): A number of instances, or a
+                percentage of the group, e.g. '25%'
+            num_instances(int): The number of instances in the group
+
+        Returns:
+            (int): The number of instances to replace at once, at least 1
+        """
+        if str(batch_size).endswith('%'):
+            size = int(math.ceil(num_instances * float(str(batch_size)[:-1]) / 100))
+        else:
+            size = int(batch_size)
+        max_size = self.group.max_size
+        if max_size is not None and num_instances + size > max_size:
+            logging.getLogger("bootstrap-cfn").warning(
+                "cycle_instances: Replacing {} instances at a time would take the group over its "
+                "MaxSize of {}".format(size, max_size))
+            size = max_size - num_instances
+        return max(1, min(size, num_instances))
+
     def set_autoscaling_desired_capacity(self, capacity):
         """
         Set the desired instances count on an autoscaling group
@@ -136,7 +175,7 @@ class Autoscale:
             capacity(int): The target size of the instances in the
                 autoscaling group.
         """
-        client = boto3.client('autoscaling')
+        client = utils.connections.client('autoscaling')
         logging.getLogger("bootstrap-cfn").info("set_autoscaling_desired_capacity: Setting capacity to {}"
                                                 .format(capacity))
         client.set_desired_capacity(
@@ -153,29 +192,32 @@ class Autoscale:
         Args:
             expected_instance_count(int): The target size of the instances in the
                 autoscaling group.
-            retry_delay(int): The time in seconds between checks on the number of
-                instances.
-            retry_max(int): The maximum number of retries on checking the instance
-                count before failing.
+            retry_delay(int): The longest time in seconds between checks on the
+                number of instances.
+            retry_max(int): The maximum number of retry_delay periods to wait
+                for the instance count before failing.
         Exceptions:
             AutoscalingInstanceCountError: On target instance count not reached in
-                retry_delay * retry_count time.
+                retry_delay * retry_max time.
         """
         logger = logging.getLogger("bootstrap-cfn")
-        instances = self.get_healthy_instances()
-        count = 0
-        while (len(instances) != expected_instance_count and count < retry_max):
-            count += 1
-            logger.info("cycle_instances: Waiting {} seconds for instances (attempt {}/{})..."
-                        .format(retry_delay, count, retry_max))
-            if count == retry_max:
-                logger.critical("wait_for_instances:Failed to find {} healthy instances,\n{}"
-                                .format(expected_instance_count, self.get_instances_list()))
-                raise AutoscalingInstanceCountError(self.group.name, expected_instance_count, instances)
-            utils.sleep_countdown(retry_delay)
-            instances = self.get_healthy_instances()
+        found = {}
+
+        def instances_ready():
+            found['instances'] = self.get_healthy_instances()
+            return len(found['instances']) == expected_instance_count
+
+        logger.info("wait_for_instances: Waiting up to {} seconds for {} instances..."
+                    .format(retry_delay * retry_max, expected_instance_count))
+        try:
+            utils.Poller(retry_delay * retry_max, max_interval=retry_delay).wait(instances_ready)
+        except CfnTimeoutError:
+            logger.critical("wait_for_instances:Failed to find {} healthy instances,\n{}"
+                            .format(expected_instance_count, self.get_instances_list()))
+            raise AutoscalingInstanceCountError(self.group.name, expected_instance_count,
+                                                found['instances'])
         logger.info("wait_for_instances: Found {} instances,\n{}"
-                    .format(len(instances), self.get_instances_list()))
+                    .format(len(found['instances']), self.get_instances_list()))
 
     def get_healthy_instances(self):
         instances = [instance for instance in self.get_instances()
@@ -187,7 +229,7 @@ class Autoscale:
         """
         Get all instances in an autoscaling group
         """
-        client = boto3.client('autoscaling')
+        client = utils.connections.client('autoscaling')
         groups = client.describe_auto_scaling_groups(AutoScalingGroupNames=[self.group.name]).get('AutoScalingGroups')
         if not len(groups) > 0:
             logging.getLogger("bootstrap-cfn").critical("cycle_instances: Could not describe autoscaling group")
@@ -0,0 +1,158 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from bootstrap_cfn import errors
+from bootstrap_cfn.config import ConfigParser, ProjectConfig
+from bootstrap_cfn.template_cache import SectionCache, TemplateCache
+
+# Rendering doesn't talk to cloudformation so there's no real stack name,
+# this stands in for one. The last part becomes the stack id.
+STACK_NAME_FORMAT = "{application}-{environment}-render"
+
+SUMMARY_FILE = 'summary.json'
+
+
+def list_environments(config_file):
+    """
+    Get the names of the environments defined in a project config file
+
+    Args:
+        config_file(string): Path to the project's YAML config
+
+    Returns:
+        (list): The environment names, sorted
+    """
+    return sorted(ProjectConfig.load_yaml(config_file) or {})
+
+
+def render_environment(config_file, environment, output_dir,
+                       passwords=None, application=None,
+                       parser_class=ConfigParser, cache_dir=None):
+    """
+    Render the template for one environment and write it to
+    <output_dir>/<environment>.json
+
+    Any error is caught and reported in the result rather than raised, so
+    that one broken environment doesn't stop the others being rendered.
+    Environments without a vpc section are refused, since rendering them
+    looks up a free VPC CIDR block in AWS.
+
+    Returns:
+        (dict): The environment, whether it rendered, how long it took in
+            seconds and either the template path or the error
+    """
+    start = time.time()
+    result = {'environment': environment}
+    try:
+        yaml_cache_dir = os.path.join(cache_dir, 'yaml') if cache_dir else None
+        project_config = ProjectConfig(config_file,
+                                       environment,
+                                       passwords=passwords,
+                                       cache_dir=yaml_cache_dir)
+        if 'vpc' not in project_config.config:
+            raise errors.CfnConfigError("Environment {0} has no vpc section, rendering it would "
+                                        "look up a free VPC CIDR block in AWS".format(environment))
+        stack_name = STACK_NAME_FORMAT.format(application=application or 'app',
+                                              environment=environment)
+        parser = parser_class(project_config.config, stack_name,
+                              environment=environment, application=application)
+        if cache_dir:
+            parser.template_cache = TemplateCache(os.path.join(cache_dir, 'templates'))
+            parser.section_cache = SectionCache(os.path.join(cache_dir, 'sections'))
+        template_body = parser.process()
+        template_path = os.path.join(output_dir, '{0}.json'.format(environment))
+        with open(template_path, 'w') as f:
+            f.write(template_body)
+        result.update(ok=True, template=template_path)
+    except (Exception, SystemExit) as e:
+        # Some config errors sys.exit() after printing the problem, which
+        # would otherwise kill the pool worker
+        if isinstance(e, SystemExit):
+            error = "exited with status {0}".format(e.code)
+        else:
+            error = str(e)
+        logging.error("bootstrap-cfn::render_environment: Failed to render environment %s: %s"
+                      % (environment, error))
+        result.update(ok=False, error=error, traceback=traceback.format_exc())
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def _render_environment_worker(kwargs):
+    # Pool.imap_unordered only passes a single argument
+    return render_environment(**kwargs)
+
+
+def render_environments(config_file, output_dir, environments=None,
+                        passwords=None, application=None,
+                        parser_class=ConfigParser, cache_dir=None,
+                        processes=None):
+    """
+    Render the templates for several environments of a project config in a
+    process pool, writing one template per environment and a summary.json
+    of timings and failures to output_dir
+
+    Nothing is looked up in AWS, so every environment must set its VPC
+    address ranges in a vpc section. Those that don't are reported as
+    failed.
+
+    Args:
+        config_file(string): Path to the project's YAML config
+        output_dir(string): Directory to write the templates and summary to,
+            created if it doesn't exist
+        environments(list): The environments to render, all of those in the
+            config file by default
+        passwords(string): Optional path to the project's passwords YAML
+        application(string): The application name, as used in user data
+        parser_class(class): The ConfigParser (sub)class to render with, it
+            must be importable by the worker processes
+        cache_dir(string): Optional directory to cache parsed YAML,
+            rendered templates and template sections in
+        processes(int): Number of worker processes, defaults to the number
+            of CPUs. With 1 everything is rendered in this process.
+
+    Returns:
+        (dict): The summary, as written to summary.json
+    """
+    if environments is None:
+        environments = list_environments(config_file)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = [dict(config_file=config_file,
+                 environment=environment,
+                 output_dir=output_dir,
+                 passwords=passwords,
+                 application=application,
+                 parser_class=parser_class,
+                 cache_dir=cache_dir)
+            for environment in environments]
+
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs)) or 1
+    start = time.time()
+    if processes == 1:
+        results = map(_render_environment_worker, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = list(pool.imap_unordered(_render_environment_worker, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    results = sorted(results, key=lambda r: r['environment'])
+    summary = {
+        'config': config_file,
+        'processes': processes,
+        'seconds': round(time.time() - start, 3),
+        'rendered': [r['environment'] for r in results if r['ok']],
+        'failed': [r['environment'] for r in results if not r['ok']],
+        'environments': dict((r['environment'], r) for r in results),
+    }
+    with open(os.path.join(output_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=4, sort_keys=True, separators=(',', ': '))
+    return summary
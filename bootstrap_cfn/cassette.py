@@ -0,0 +1,382 @@
+import io
+import json
+import os
+import re
+import threading
+import time
+from xml.sax.saxutils import escape, unescape
+
+import boto.connection
+
+import boto3
+
+from botocore.awsrequest import AWSResponse
+from botocore.parsers import create_parser
+from botocore.response import StreamingBody
+
+from bootstrap_cfn import api_metrics, errors
+
+CASSETTE_VERSION = 1
+
+# Keep the real sleep for injected latency, so that it still applies when
+# a benchmark replaces time.sleep to skip the waits between polls
+_sleep = time.sleep
+
+# Clock for the time AWS takes to answer, which isn't affected by changes
+# to the system time where python provides one
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Credentials for the connections a replay makes, which never reach AWS
+REPLAY_CREDENTIALS = {'aws_access_key_id': 'replay', 'aws_secret_access_key': 'replay'}
+
+# Request parameters and response fields whose values are never saved,
+# e.g. the private key of an uploaded certificate or an RDS password in
+# a template
+SECRET_FIELDS = frozenset(['PrivateKey', 'CertificateBody', 'CertificateChain',
+                           'SecretAccessKey', 'SessionToken', 'MasterUserPassword',
+                           'Password', 'AuthToken'])
+
+# Fields holding a whole template or object body, which is saved with
+# its secrets redacted
+BODY_FIELDS = frozenset(['TemplateBody', 'Body'])
+
+REDACTED = 'REDACTED'
+
+_XML_SECRET = re.compile(r'<({0})>.*?</\1>'.format('|'.join(sorted(SECRET_FIELDS))), re.S)
+_XML_BODY = re.compile(r'<({0})>(.*?)</\1>'.format('|'.join(sorted(BODY_FIELDS))), re.S)
+
+
+def _normalise(request):
+    """
+    Make a request comparable with one loaded from a cassette, turning
+    anything JSON can't hold, e.g. datetimes or file objects, into strings
+    """
+    return json.loads(json.dumps(request, sort_keys=True, default=str))
+
+
+def _text(body):
+    if isinstance(body, bytes):
+        return body.decode('utf-8', 'replace')
+    return body or u''
+
+
+def _no_echo_parameters(template):
+    parameters = template.get('Parameters') if isinstance(template, dict) else None
+    if not isinstance(parameters, dict):
+        return set()
+    return set(name for name, parameter in parameters.items()
+               if isinstance(parameter, dict) and str(parameter.get('NoEcho')).lower() == 'true')
+
+
+def _redact_parameters(parameters, no_echo):
+    """
+    Redact the values of stack parameters that are NoEcho in the
+    template, or all of them when the template isn't in the request
+    """
+    redacted = []
+    for parameter in parameters:
+        if (isinstance(parameter, dict) and 'ParameterValue' in parameter and
+                (no_echo is None or parameter.get('ParameterKey') in no_echo)):
+            parameter = dict(parameter, ParameterValue=REDACTED)
+        redacted.append(parameter)
+    return redacted
+
+
+def _redact_value(value, no_echo=None):
+    """
+    Redact the secrets in request parameters or a parsed JSON document
+
+    Args:
+        no_echo(set): Names of the NoEcho stack parameters, None if the
+            template they are defined in isn't known
+    """
+    if isinstance(value, list):
+        return [_redact_value(item, no_echo) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if 'TemplateBody' in value:
+        template = value['TemplateBody']
+        if not isinstance(template, dict):
+            try:
+                template = json.loads(template)
+            except (TypeError, ValueError):
+                template = None
+        no_echo = _no_echo_parameters(template)
+    template_parameters = _no_echo_parameters(value)
+    redacted = {}
+    for key, item in value.items():
+        # boto flattens query parameters, e.g. Parameters.member.1.ParameterValue
+        field = key.split('.')[-1]
+        if field in SECRET_FIELDS:
+            item = REDACTED
+        elif field in BODY_FIELDS and isinstance(item, basestring):
+            item = redact_text(item)
+        elif field == 'ParameterValue' and key != field:
+            name = value.get(key[:-len('Value')] + 'Key')
+            if no_echo is None or name in no_echo:
+                item = REDACTED
+        elif key == 'Parameters' and isinstance(item, list):
+            item = _redact_parameters(item, no_echo)
+        elif key == 'Parameters' and template_parameters:
+            # A template's parameters section, with NoEcho defaults
+            item = dict((name, dict(parameter, Default=REDACTED)
+                         if name in template_parameters and 'Default' in parameter else parameter)
+                        for name, parameter in item.items())
+        else:
+            item = _redact_value(item, no_echo)
+        redacted[key] = item
+    return redacted
+
+
+def redact_text(text):
+    """
+    Redact the secrets in a JSON or XML request or response body. Other
+    text is returned as it is.
+    """
+    stripped = text.lstrip()
+    if stripped.startswith(('{', '[')):
+        try:
+            document = json.loads(text)
+        except ValueError:
+            return text
+        return json.dumps(_redact_value(document), sort_keys=True)
+    if stripped.startswith('<'):
+        text = _XML_SECRET.sub(lambda m: '<{0}>{1}</{0}>'.format(m.group(1), REDACTED), text)
+        return _XML_BODY.sub(_redact_xml_body, text)
+    return text
+
+
+def _redact_xml_body(match):
+    body = unescape(match.group(2), {'&quot;': '"', '&apos;': "'"})
+    redacted = redact_text(body)
+    if redacted == body:
+        return match.group(0)
+    return '<{0}>{1}</{0}>'.format(match.group(1), escape(redacted))
+
+
+class CassetteResponse(object):
+    """A recorded response, standing in for boto's HTTPResponse"""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self, amt=None):
+        return self.body
+
+    def getheader(self, name, default=None):
+        for header, value in self.headers.items():
+            if header.lower() == name.lower():
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+
+class _RawBody(object):
+    """The raw response botocore reads an AWSResponse's content from"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self):
+        yield self.body
+
+
+class Cassette(object):
+    """
+    Records the AWS API responses of a run to a file, or replays them from
+    it without touching the network
+
+    Secrets in the requests and responses, such as certificate private
+    keys, passwords in templates and NoEcho stack parameters, are
+    redacted before they are saved (SECRET_FIELDS), and the file is only
+    readable by its owner.
+
+    Every response is stored with the service, operation and request
+    parameters it answered. A replay answers each call with the first
+    unused response recorded for the same request, falling back to the
+    next unused response for the same operation when the parameters
+    differ, e.g. in generated change set names. Calls made more often
+    than when recorded, such as status polls, get the last matching
+    response again.
+    """
+
+    def __init__(self, path, mode='replay', latency=0, region_name='eu-west-1'):
+        """
+        Args:
+            path(string): The cassette file
+            mode(string): 'record' to call AWS and save the responses,
+                'replay' to answer calls from the file
+            latency(float or string): Seconds to wait before each replayed
+                response, or 'recorded' to wait as long as AWS took
+            region_name(string): The region replayed boto3 clients use
+        """
+        if mode not in ('record', 'replay'):
+            raise errors.BootstrapCfnError("Unknown cassette mode '{0}', expected record or replay".format(mode))
+        self.path = path
+        self.mode = mode
+        self.latency = latency if latency == 'recorded' else float(latency or 0)
+        self.region_name = region_name
+        self.interactions = []
+        self._used = set()
+        self._by_operation = {}
+        self._lock = threading.Lock()
+        if self.replaying:
+            self.load()
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise errors.BootstrapCfnError("Cassette {0} does not exist".format(self.path))
+        with open(self.path) as f:
+            self.interactions = json.load(f)['interactions']
+        self._by_operation = {}
+        for index, interaction in enumerate(self.interactions):
+            key = (interaction['service'], interaction['operation'])
+            self._by_operation.setdefault(key, []).append(index)
+
+    def save(self):
+        with self._lock:
+            interactions = list(self.interactions)
+        tmp_path = "{0}.tmp".format(self.path)
+        # Only readable by us, as responses can still hold account details
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'version': CASSETTE_VERSION, 'interactions': interactions},
+                      f, indent=2, sort_keys=True, separators=(',', ': '))
+        os.rename(tmp_path, self.path)
+
+    def record(self, service_name, operation, request, status, reason, headers, body, seconds):
+        with self._lock:
+            self.interactions.append({
+                'service': service_name,
+                'operation': operation,
+                'request': _redact_value(_normalise(request)),
+                'status': status,
+                'reason': reason,
+                'headers': dict(headers),
+                'body': redact_text(_text(body)),
+                'seconds': round(seconds, 3),
+            })
+
+    def play(self, service_name, operation, request):
+        """
+        Find the recorded response to a call, waiting for the latency
+
+        Returns:
+            (dict): The recorded interaction
+
+        Raises:
+            CassetteError: Nothing was recorded for the operation
+        """
+        # Redacted as when recorded, so that the request still matches
+        request = _redact_value(_normalise(request))
+        with self._lock:
+            indexes = self._by_operation.get((service_name, operation))
+            if not indexes:
+                raise errors.CassetteError(service_name, operation, self.path)
+            unused = [i for i in indexes if i not in self._used]
+            matching = [i for i in indexes if self.interactions[i]['request'] == request]
+            index = next((i for i in unused if i in matching), None)
+            if index is None:
+                index = unused[0] if unused else (matching or indexes)[-1]
+            self._used.add(index)
+            interaction = self.interactions[index]
+        latency = interaction['seconds'] if self.latency == 'recorded' else self.latency
+        if latency:
+            _sleep(latency)
+        return interaction
+
+    def connect(self, module, region_name):
+        """Connect to a boto service for replaying, without credentials"""
+        return module.connect_to_region(region_name=region_name, **REPLAY_CREDENTIALS)
+
+    def session(self):
+        """A boto3 session for replaying, without credentials"""
+        return boto3.session.Session(region_name=self.region_name, **REPLAY_CREDENTIALS)
+
+    def wrap_connection(self, conn, service_name):
+        """
+        Record or replay the calls of a boto connection
+
+        Returns:
+            The connection
+        """
+        # connect_to_region returns None for regions the service isn't in
+        if conn is None:
+            return conn
+        make_request = conn.make_request
+
+        def cassette_make_request(*args, **kwargs):
+            operation = api_metrics.boto_operation(conn, args, kwargs)
+            request = self._boto_request(conn, args, kwargs)
+            if self.replaying:
+                interaction = self.play(service_name, operation, request)
+                return CassetteResponse(interaction['status'], interaction['reason'],
+                                        interaction['headers'], interaction['body'].encode('utf-8'))
+            start = _monotonic()
+            response = make_request(*args, **kwargs)
+            # boto's HTTPResponse caches the body, so the caller can still read it
+            self.record(service_name, operation, request, response.status, response.reason,
+                        response.getheaders(), response.read(), _monotonic() - start)
+            return response
+
+        conn.make_request = cassette_make_request
+        return conn
+
+    def _boto_request(self, conn, args, kwargs):
+        if isinstance(conn, boto.connection.AWSQueryConnection):
+            params = kwargs.get('params', args[1] if len(args) > 1 else {})
+            return {'params': params}
+        path = kwargs.get('path', args[1] if len(args) > 1 else '/')
+        data = kwargs.get('data', args[3] if len(args) > 3 else '')
+        return {'path': path, 'body': redact_text(_text(data))}
+
+    def wrap_client(self, client):
+        """
+        Record or replay the calls of a boto3 client
+
+        Returns:
+            The client
+        """
+        service_name = client.meta.service_model.service_name
+
+        def remember_params(params, context, **kwargs):
+            context['bootstrap_cfn_request'] = {'params': _normalise(params)}
+            context['bootstrap_cfn_cassette_start'] = _monotonic()
+
+        def replay(model, context, **kwargs):
+            interaction = self.play(service_name, model.name, context['bootstrap_cfn_request'])
+            body = interaction['body'].encode('utf-8')
+            http_response = AWSResponse(None, interaction['status'], interaction['headers'], _RawBody(body))
+            response_dict = {'status_code': interaction['status'],
+                             'headers': http_response.headers,
+                             'body': body}
+            if model.has_streaming_output:
+                response_dict['body'] = StreamingBody(io.BytesIO(body), len(body))
+            parsed = create_parser(model.metadata['protocol']).parse(response_dict, model.output_shape)
+            return http_response, parsed
+
+        def record(http_response, parsed, model, context, **kwargs):
+            body = http_response.content
+            if model.has_streaming_output:
+                # Reading the content used up the stream the caller reads
+                payload = model.output_shape.serialization.get('payload')
+                if payload and payload in parsed:
+                    parsed[payload] = StreamingBody(io.BytesIO(body), len(body))
+            self.record(service_name, model.name, context.get('bootstrap_cfn_request'),
+                        http_response.status_code, None, http_response.headers, body,
+                        _monotonic() - context.get('bootstrap_cfn_cassette_start', 0))
+
+        client.meta.events.register('before-parameter-build', remember_params)
+        if self.replaying:
+            client.meta.events.register('before-call', replay)
+        else:
+            client.meta.events.register('after-call', record)
+        return client
@@ -1,50 +1,587 @@
 
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+
 import boto.cloudformation
+import boto.exception
+
+from bootstrap_cfn import errors, utils
+
+# The largest template body cloudformation accepts inline, anything bigger
+# has to be uploaded to s3 and passed as a TemplateURL
+MAX_TEMPLATE_BODY_SIZE = 51200
+
+# How long the presigned URL of an uploaded template is valid for, it only
+# needs to last until cloudformation has fetched it
+TEMPLATE_URL_EXPIRY = 3600
+
+# Stack statuses that mean the last operation on the stack has finished,
+# every other status ends in _IN_PROGRESS
+STACK_SETTLED_STATUSES = [
+    'CREATE_COMPLETE', 'CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+    'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED',
+    'DELETE_COMPLETE', 'DELETE_FAILED',
+    'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_COMPLETE', 'IMPORT_ROLLBACK_FAILED',
+]
+
+# Settled statuses where the operation succeeded
+STACK_SUCCESS_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE', 'IMPORT_COMPLETE']
+
+
+def stack_settled(status):
+    """
+    Returns:
+        (boolean): True if a stack in this status isn't changing. Statuses
+            cloudformation adds in future are taken to be settled unless
+            they end in _IN_PROGRESS.
+    """
+    return status in STACK_SETTLED_STATUSES or not status.endswith('_IN_PROGRESS')
+
+
+# How long stack resources fetched from cloudformation are reused for
+RESOURCE_CACHE_TTL = 60
+
+
+class StackResource(dict):
+    """
+    A stack resource as returned by boto3, e.g. resource['PhysicalResourceId'],
+    which can also be read with the attribute names of boto's
+    StackResourceSummary, e.g. resource.physical_resource_id
+    """
+
+    def __getattr__(self, name):
+        key = ''.join(part.capitalize() for part in name.split('_'))
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class StackResourceCache(object):
+    """
+    Per-process cache of the resources of stacks, keyed on the stack name
+    or id they were looked up with
+
+    Entries expire after ttl seconds, and are dropped by invalidate() when
+    we change a stack.
+    """
+
+    def __init__(self, ttl=RESOURCE_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, stack_name_or_id, fetch):
+        """
+        Get the resources of a stack, calling fetch(stack_name_or_id) if
+        they aren't cached or have expired
+
+        Returns:
+            (list): The stack's resources
+        """
+        now = utils._monotonic()
+        with self._lock:
+            entry = self._entries.get(stack_name_or_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            return list(entry[1])
+        resources = fetch(stack_name_or_id)
+        with self._lock:
+            self._entries[stack_name_or_id] = (now, resources)
+        return list(resources)
+
+    def invalidate(self, stack_name_or_id=None):
+        """
+        Drop the cached resources of a stack, whether they were looked up by
+        its name or its id, or of every stack if none is given
+        """
+        with self._lock:
+            if stack_name_or_id is None:
+                self._entries.clear()
+                return
+            # Stack ids are ARNs ending in stack/<name>/<uuid>
+            name = stack_name_or_id.split('/')[1] if stack_name_or_id.startswith('arn:') else stack_name_or_id
+            for key in list(self._entries):
+                if key in (stack_name_or_id, name) or '/{0}/'.format(name) in key:
+                    del self._entries[key]
+
+
+resource_cache = StackResourceCache()
+
+
+def fetch_stack_resources(stack_name_or_id, client=None):
+    """
+    Get every resource of a stack from cloudformation, uncached
+
+    Args:
+        stack_name_or_id (string): Name or id used to identify the stack
+        client: Optional boto3 cloudformation client
+
+    Returns:
+        (list): StackResource for each of the stack's resources
+    """
+    client = client or utils.connections.client('cloudformation')
+    resources = []
+    for page in client.get_paginator('list_stack_resources').paginate(StackName=stack_name_or_id):
+        resources.extend(StackResource(r) for r in page['StackResourceSummaries'])
+    return resources
+
+
+def get_stack_resources(stack_name_or_id, client=None):
+    """
+    Get every resource of a stack, from resource_cache if they were fetched
+    in the last RESOURCE_CACHE_TTL seconds
+
+    Returns:
+        (list): StackResource for each of the stack's resources
+    """
+    return resource_cache.get(stack_name_or_id,
+                              lambda name: fetch_stack_resources(name, client))
+
+
+# Every stack status except DELETE_COMPLETE, for list_stacks to filter on so
+# that deleted stacks aren't sent back
+LIVE_STACK_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE',
+    'REVIEW_IN_PROGRESS',
+    'IMPORT_IN_PROGRESS', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_IN_PROGRESS',
+    'IMPORT_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+]
+
+
+class StackIndex(object):
+    """
+    Index of the live stacks in the account, for looking stacks up by name
+    without describing every stack each time
+
+    The stacks are listed once, with list_stacks filtered to
+    LIVE_STACK_STATUSES and following every page, and kept until
+    invalidate() is called, e.g. when we create or delete a stack.
+    """
+
+    def __init__(self, client=None):
+        """
+        Args:
+            client: Optional boto3 cloudformation client, the default
+                session's by default
+        """
+        self.client = client
+        self._stacks = None
+        self._names = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._stacks is None:
+                client = self.client or utils.connections.client('cloudformation')
+                stacks = []
+                paginator = client.get_paginator('list_stacks')
+                for page in paginator.paginate(StackStatusFilter=LIVE_STACK_STATUSES):
+                    stacks.extend(page['StackSummaries'])
+                stacks.sort(key=lambda stack: stack['StackName'])
+                self._stacks = stacks
+                self._names = [stack['StackName'] for stack in stacks]
+            return self._stacks, self._names
+
+    @property
+    def stacks(self):
+        """(list): The StackSummaries of every live stack, sorted by name"""
+        return list(self._load()[0])
+
+    def with_prefix(self, prefix):
+        """
+        Returns:
+            (list): The StackSummaries of the stacks whose names start with
+                prefix, sorted by name
+        """
+        stacks, names = self._load()
+        start = bisect.bisect_left(names, prefix)
+        matches = []
+        for stack in stacks[start:]:
+            if not stack['StackName'].startswith(prefix):
+                break
+            matches.append(stack)
+        return matches
+
+    def search(self, term):
+        """
+        Returns:
+            (list): The StackSummaries of the stacks whose ids contain term
+        """
+        return [stack for stack in self._load()[0] if term in stack['StackId']]
+
+    def invalidate(self):
+        """Forget the stacks, so they are listed again on the next lookup"""
+        with self._lock:
+            self._stacks = None
+            self._names = None
+
+
+stack_index = StackIndex()
+
+
+class StackWaiter(object):
+    """
+    Wait for a stack operation to finish, with one status lookup per poll
+
+    Moves from waiting for the operation to start, to in progress, to
+    settled. Given the status from before the operation, that status is
+    taken to mean the operation hasn't started yet rather than that it has
+    finished, until the stack is seen in any other status.
+    """
+
+    WAITING = 'waiting'
+    IN_PROGRESS = 'in progress'
+    SETTLED = 'settled'
+
+    def __init__(self, cfn, stack_name, from_status=None):
+        """
+        Args:
+            cfn(Cloudformation): The Cloudformation connection object
+            stack_name(string): The stack name or id
+            from_status(string): Optional status of the stack before the
+                operation was started
+        """
+        self.cfn = cfn
+        self.stack_name = stack_name
+        self.from_status = from_status
+        self.state = self.WAITING
+        self.status = None
+
+    def poll(self):
+        """
+        Look up the stack status once and move to the next state
+
+        Returns:
+            (boolean): True once the stack has settled
+        """
+        status = self.cfn.get_stack_status(self.stack_name)
+        # A stack that doesn't exist any more has been deleted
+        self.status = status or 'DELETE_COMPLETE'
+        if not stack_settled(self.status):
+            self.state = self.IN_PROGRESS
+        elif self.state == self.IN_PROGRESS or self.status != self.from_status:
+            self.state = self.SETTLED
+        if self.state == self.SETTLED:
+            logging.info("bootstrap-cfn::StackWaiter: Stack {0} settled in {1}"
+                         .format(self.stack_name, self.status))
+            return True
+        return False
+
+    @property
+    def succeeded(self):
+        return self.state == self.SETTLED and self.status in STACK_SUCCESS_STATUSES
+
+    def wait(self, timeout=3600, interval=30):
+        """
+        Poll until the stack has settled
 
-import boto3
+        Returns:
+            (string): The final stack status, DELETE_COMPLETE if the stack
+                no longer exists
 
-from bootstrap_cfn import utils
+        Exceptions:
+            CfnTimeoutError: The stack didn't settle within timeout seconds
+        """
+        utils.Poller(timeout, max_interval=interval).wait(self.poll)
+        return self.status
 
 
 class Cloudformation:
 
-    conn_cfn = None
+    conn_cfn = utils.PooledConnection(boto.cloudformation)
     aws_region_name = None
     aws_profile_name = None
+    # boto3 client, for the calls boto doesn't support
+    _cfn_client = None
 
     def __init__(self, aws_profile_name, aws_region_name='eu-west-1'):
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
-        self.conn_cfn = utils.connect_to_aws(boto.cloudformation, self)
 
-    def create(self, stack_name, template_body, tags):
+    def create(self, stack_name, template_body, tags, template_bucket=None):
+        """
+        Create a stack, uploading the template to s3 first if it is too big
+        to send inline
+
+        Args:
+            stack_name(string): The name of the stack
+            template_body(string): The JSON template
+            tags(dict): Tags for the stack
+            template_bucket(string): The s3 bucket to upload templates over
+                MAX_TEMPLATE_BODY_SIZE bytes to
+
+        Raises:
+            CfnTemplateTooLargeError: The template is too big to send inline
+                and no template_bucket was given
+        """
+        template_args = self.template_args(stack_name, template_body, template_bucket)
+        resource_cache.invalidate(stack_name)
+        stack_index.invalidate()
         stack = self.conn_cfn.create_stack(stack_name=stack_name,
-                                           template_body=template_body,
                                            capabilities=['CAPABILITY_IAM'],
-                                           tags=tags)
+                                           tags=tags,
+                                           **template_args)
         return stack
 
+    def template_args(self, stack_name, template_body, template_bucket=None):
+        """
+        Get how to pass a template to cloudformation, inline as template_body
+        if it fits, otherwise uploaded to s3 and passed as template_url
+
+        Returns:
+            (dict): Either {'template_body': ...} or {'template_url': ...}
+        """
+        if len(template_body) <= MAX_TEMPLATE_BODY_SIZE:
+            return {'template_body': template_body}
+        if not template_bucket:
+            raise errors.CfnTemplateTooLargeError(len(template_body), MAX_TEMPLATE_BODY_SIZE)
+        logging.info("bootstrap-cfn::Cloudformation: Template is %s bytes, over the %s byte "
+                     "inline limit, uploading it to s3 bucket %s"
+                     % (len(template_body), MAX_TEMPLATE_BODY_SIZE, template_bucket))
+        return {'template_url': self.upload_template(template_bucket, stack_name, template_body)}
+
+    def upload_template(self, bucket, stack_name, template_body):
+        """
+        Upload a template to s3 for cloudformation to read
+
+        The s3 endpoint can be pointed at a local stand-in by setting
+        BOOTSTRAP_CFN_S3_ENDPOINT_URL.
+
+        Args:
+            bucket(string): The bucket to upload to
+            stack_name(string): The stack the template is for, used as
+                the key prefix
+            template_body(string): The JSON template
+
+        Returns:
+            (string): A presigned URL cloudformation can read the template from
+        """
+        client = utils.connections.client('s3',
+                                          region_name=self.aws_region_name,
+                                          endpoint_url=utils.endpoint_url('s3'))
+        key = "{0}/{1}.json".format(stack_name, hashlib.sha1(template_body).hexdigest())
+        client.put_object(Bucket=bucket,
+                          Key=key,
+                          Body=template_body,
+                          ContentType='application/json')
+        return client.generate_presigned_url('get_object',
+                                             Params={'Bucket': bucket, 'Key': key},
+                                             ExpiresIn=TEMPLATE_URL_EXPIRY)
+
+    @property
+    def cfn_client(self):
+        """
+        The boto3 cloudformation client. Its endpoint can be pointed at a
+        local stand-in by setting BOOTSTRAP_CFN_CLOUDFORMATION_ENDPOINT_URL.
+        """
+        if self._cfn_client is None:
+            self._cfn_client = utils.connections.client('cloudformation',
+                                                        region_name=self.aws_region_name,
+                                                        endpoint_url=utils.endpoint_url('cloudformation'))
+        return self._cfn_client
+
+    def get_template(self, stack_name):
+        """
+        Get the template a stack is currently running
+
+        Returns:
+            (dict): The deployed template
+        """
+        template = self.cfn_client.get_template(StackName=stack_name)['TemplateBody']
+        if isinstance(template, basestring):
+            template = json.loads(template)
+        return template
+
+    @staticmethod
+    def diff_templates(deployed, rendered):
+        """
+        Compare a deployed template with a newly rendered one
+
+        Args:
+            deployed(dict): The template the stack is running
+            rendered(dict): The template we want it to run
+
+        Returns:
+            (dict): Lists of the logical ids of resources 'added', 'removed'
+                and 'modified', and of the other top level 'sections' (eg.
+                Outputs) that differ. All empty if nothing has changed.
+        """
+        deployed_resources = deployed.get('Resources', {})
+        rendered_resources = rendered.get('Resources', {})
+        return {
+            'added': sorted(set(rendered_resources) - set(deployed_resources)),
+            'removed': sorted(set(deployed_resources) - set(rendered_resources)),
+            'modified': sorted(title for title in set(deployed_resources) & set(rendered_resources)
+                               if deployed_resources[title] != rendered_resources[title]),
+            'sections': sorted(key for key in set(deployed) | set(rendered)
+                               if key != 'Resources' and deployed.get(key) != rendered.get(key)),
+        }
+
+    def create_change_set(self, stack_name, template_body, tags, template_bucket=None,
+                          timeout=600, interval=5):
+        """
+        Create a change set to update a stack to a new template, and wait
+        for cloudformation to work out the changes
+
+        Args:
+            stack_name(string): The name of the stack
+            template_body(string): The JSON template
+            tags(dict): Tags for the stack
+            template_bucket(string): The s3 bucket to upload templates over
+                MAX_TEMPLATE_BODY_SIZE bytes to
+
+        Returns:
+            (tuple): The change set id and the list of resource changes
+                (dicts with Action, LogicalResourceId, ResourceType and
+                Replacement). If there are no changes the change set is
+                deleted and the list is empty.
+
+        Raises:
+            CfnChangeSetError: Cloudformation couldn't create the change set
+        """
+        template_args = self.template_args(stack_name, template_body, template_bucket)
+        if 'template_url' in template_args:
+            template_args = {'TemplateURL': template_args['template_url']}
+        else:
+            template_args = {'TemplateBody': template_args['template_body']}
+        change_set_id = self.cfn_client.create_change_set(
+            StackName=stack_name,
+            ChangeSetName='bootstrap-cfn-{0}'.format(time.strftime('%Y%m%d%H%M%S')),
+            Capabilities=['CAPABILITY_IAM'],
+            Tags=[{'Key': k, 'Value': v} for k, v in sorted(tags.items())],
+            **template_args)['Id']
+
+        def change_set_created():
+            change_set = self.describe_change_set(change_set_id)
+            if change_set['Status'] in ['CREATE_COMPLETE', 'FAILED']:
+                return change_set
+        change_set = utils.timeout(timeout, interval)(change_set_created)()
+
+        if change_set['Status'] == 'FAILED':
+            reason = change_set.get('StatusReason', '')
+            if "didn't contain changes" in reason or 'No updates are to be performed' in reason:
+                self.delete_change_set(change_set_id)
+                return change_set_id, []
+            raise errors.CfnChangeSetError(stack_name, reason)
+        changes = [c['ResourceChange'] for c in change_set['Changes'] if c.get('Type') == 'Resource']
+        return change_set_id, changes
+
+    def describe_change_set(self, change_set_id):
+        """
+        Get a change set, with all its pages of changes
+
+        Returns:
+            (dict): The DescribeChangeSet response, with every change
+        """
+        change_set = self.cfn_client.describe_change_set(ChangeSetName=change_set_id)
+        changes = change_set.get('Changes', [])
+        next_token = change_set.get('NextToken')
+        while next_token:
+            page = self.cfn_client.describe_change_set(ChangeSetName=change_set_id, NextToken=next_token)
+            changes.extend(page.get('Changes', []))
+            next_token = page.get('NextToken')
+        change_set['Changes'] = changes
+        return change_set
+
+    def execute_change_set(self, change_set_id):
+        # The change set id doesn't say which stack it is for
+        resource_cache.invalidate()
+        return self.cfn_client.execute_change_set(ChangeSetName=change_set_id)
+
+    def delete_change_set(self, change_set_id):
+        return self.cfn_client.delete_change_set(ChangeSetName=change_set_id)
+
+    def update(self, stack_name, template_body, tags, template_bucket=None):
+        """
+        Update a stack in place to a new template through a change set,
+        so only the resources that have changed are touched
+
+        Returns:
+            (string): The id of the change set being executed, None if
+                there was nothing to change
+        """
+        change_set_id, changes = self.create_change_set(stack_name, template_body, tags, template_bucket)
+        if not changes:
+            return None
+        self.execute_change_set(change_set_id)
+        return change_set_id
+
     def delete(self, stack_name):
+        resource_cache.invalidate(stack_name)
+        stack_index.invalidate()
         stack = self.conn_cfn.delete_stack(stack_name)
         return stack
 
     def stack_done(self, stack_id):
-        stack_events = self.conn_cfn.describe_stack_events(stack_id)
-        if stack_events[0].resource_type == 'AWS::CloudFormation::Stack'\
-                and stack_events[0].resource_status in ['CREATE_COMPLETE', 'CREATE_FAILED', 'ROLLBACK_COMPLETE']:
-            return True
-        return False
+        ''' Returns True if the stack exists and isn't changing'''
+        status = self.get_stack_status(stack_id)
+        return status is not None and stack_settled(status)
 
-    def wait_for_stack_done(self, stack_id, timeout=3600, interval=30):
-        return utils.timeout(timeout, interval)(self.stack_done)(stack_id)
+    def wait_for_stack_done(self, stack_id, timeout=3600, interval=30, from_status=None):
+        """
+        Wait for a create, update or delete of the stack to finish
+
+        Args:
+            from_status(string): Optional status of the stack before the
+                operation, see StackWaiter
+
+        Returns:
+            (string): The final stack status, DELETE_COMPLETE if the stack
+                no longer exists
+        """
+        return StackWaiter(self, stack_id, from_status).wait(timeout, interval)
 
     def get_last_stack_event(self, stack_id):
         return self.conn_cfn.describe_stack_events(stack_id)[0]
 
+    def get_stack_status(self, stack_name):
+        """
+        Look up the status of a single stack
+
+        Args:
+            stack_name(string): The stack name or id
+
+        Returns:
+            (string): The stack status, or None if the stack doesn't exist.
+                A deleted stack, which can still be described by its id,
+                counts as not existing.
+        """
+        try:
+            stacks = self.conn_cfn.describe_stacks(stack_name)
+        except boto.exception.BotoServerError as e:
+            if 'does not exist' in (e.message or ''):
+                return None
+            raise
+        for stack in stacks:
+            if stack_name in (stack.stack_name, stack.stack_id):
+                if stack.stack_status == 'DELETE_COMPLETE':
+                    return None
+                return stack.stack_status
+        return None
+
     def stack_missing(self, stack_name):
         ''' Returns True if stack not found'''
-        stacks = self.conn_cfn.describe_stacks()
-        return stack_name not in [s.stack_name for s in stacks]
+        return self.get_stack_status(stack_name) is None
+
+    def stack_finished(self, stack_name):
+        """
+        Check whether the stack is missing or done with one status lookup,
+        for polling loops that stop on either
+
+        Returns:
+            (boolean): True if the stack doesn't exist or isn't changing
+        """
+        status = self.get_stack_status(stack_name)
+        return status is None or stack_settled(status)
 
     def wait_for_stack_missing(self, stack_id, timeout=3600, interval=30):
         return utils.timeout(timeout, interval)(self.stack_missing)(stack_id)
@@ -61,7 +598,7 @@ class Cloudformation:
                 load balancers for this stack
         """
         resource_type = 'AWS::ElasticLoadBalancing::LoadBalancer'
-        return get_resource_type(stack_name_or_id, resource_type)
+        return self.get_resource_type(stack_name_or_id, resource_type)
 
     def get_resource_type(self, stack_name_or_id, resource_type=None):
         """
@@ -73,15 +610,9 @@ class Cloudformation:
             resources: Set of stack resources containing only
                 the resource type for this stack
         """
-        # get the stack
-        resources = []
-        stack = self.conn_cfn.describe_stacks(stack_name_or_id)
-        if stack:
-            resources = stack[0].list_resources()
-            if resource_type:
-                # get the resources
-                resources = filter(lambda x: x.resource_type == resource_type,
-                                   resources)
+        resources = get_stack_resources(stack_name_or_id, self.cfn_client)
+        if resource_type:
+            resources = [r for r in resources if r['ResourceType'] == resource_type]
         return resources
 
 
@@ -98,10 +629,8 @@ def get_resource_type(stack_name_or_id,
         resources: Set of stack resources containing only
             the resource type for this stack
     """
-    client = boto3.client('cloudformation')
-    all_resources = client.describe_stack_resources(StackName=stack_name_or_id)
-    resources = [resource for resource in all_resources['StackResources'] if resource['ResourceType'] == resource_type]
-    return resources
+    resources = get_stack_resources(stack_name_or_id)
+    return [resource for resource in resources if resource['ResourceType'] == resource_type]
 
 
 def get_stack_ids_by_name(stack_name_search_term):
@@ -115,7 +644,17 @@ def get_stack_ids_by_name(stack_name_search_term):
         stack_ids: Set of stack ids containing only
             the stacks matching the search term.
     """
-    client = boto3.client('cloudformation')
-    all_stacks = client.describe_stacks()
-    stacks = [stack for stack in all_stacks['Stacks'] if stack_name_search_term in stack['StackId']]
-    return stacks
+    return stack_index.search(stack_name_search_term)
+
+
+def get_stacks_by_prefix(stack_name_prefix):
+    """
+    Collect up the stacks whose names start with a prefix
+
+    Args:
+        stack_name_prefix (string): The start of the stack names
+
+    Returns:
+        (list): The StackSummaries of the matching stacks, sorted by name
+    """
+    return stack_index.with_prefix(stack_name_prefix)
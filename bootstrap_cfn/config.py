@@ -1,10 +1,15 @@
+import functools
+import hashlib
 import json
 import logging
+import marshal
 import os
 import sys
+import tempfile
 import textwrap
+from copy import deepcopy
 
-from troposphere import Base64, FindInMap, GetAZs, GetAtt, Join, Output, Ref, Tags, Template
+from troposphere import AWSObject, Base64, FindInMap, GetAZs, GetAtt, Join, Output, Ref, Tags, Template
 from troposphere.autoscaling import AutoScalingGroup, BlockDeviceMapping, \
     EBSBlockDevice, LaunchConfiguration, Tag
 from troposphere.ec2 import InternetGateway, Route, RouteTable, SecurityGroup, \
@@ -23,25 +28,36 @@ import yaml
 
 from bootstrap_cfn import errors, mime_packer, utils
 
+# Use libyaml when PyYAML has been built against it, it's a lot faster
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed YAML files for this process, keyed on path with the
+# (mtime, size) of the file when it was parsed
+_parsed_yaml = {}
+
 
 class ProjectConfig:
 
     config = None
+    # Per top level key, where each merged value came from
+    config_sources = None
 
     def __init__(self,
                  config,
                  environment,
                  passwords=None,
-                 defaults=os.path.join(os.path.dirname(__file__), 'config_defaults.yaml')):
+                 defaults=os.path.join(os.path.dirname(__file__), 'config_defaults.yaml'),
+                 cache_dir=None):
         try:
             self.config = {}
+            self.config_sources = {}
             # Load all the necessary config files and defaults
-            config_defaults = self.load_yaml(defaults).get(environment,
-                                                           self.load_yaml(defaults)['default'])
-            user_config = self.load_yaml(config)[environment]
+            all_defaults = self.load_yaml(defaults, cache_dir)
+            config_defaults = all_defaults.get(environment, all_defaults['default'])
+            user_config = self.load_yaml(config, cache_dir)[environment]
             passwords_config = {}
             if passwords:
-                passwords_config = self.load_yaml(passwords).get(environment, {})
+                passwords_config = self.load_yaml(passwords, cache_dir).get(environment, {})
 
             # Validate all the settings we have loaded in
             logging.info('bootstrap-cfn:: Validating default settings for environment %s in file %s'
@@ -62,23 +78,89 @@ class ProjectConfig:
             for config_key in all_user_config_keys:
                 # we're going to merge in order of,
                 # defaults <- user_config <- secrets_config
-
-                # Catch badly formatted yaml where we get NoneType values,
-                # merging in these will overwrite all the other config
-                self.config[config_key] = config_defaults.get(config_key, {})
-                # Overwrite defaults with user_config values
-                self.config[config_key] = utils.dict_merge(self.config[config_key],
-                                                           user_config.get(config_key, {}))
-                # Overwrite user config with password config values
-                self.config[config_key] = utils.dict_merge(self.config[config_key],
-                                                           passwords_config.get(config_key, {}))
+                # sharing anything that isn't overridden rather than copying it
+                self.config[config_key], self.config_sources[config_key] = utils.merge_layers(
+                    [config_defaults.get(config_key, {}),
+                     user_config.get(config_key, {}),
+                     passwords_config.get(config_key, {})],
+                    names=['defaults', 'user', 'passwords'])
         except KeyError:
             raise errors.BootstrapCfnError("Environment " + environment + " not found")
 
+    def config_source(self, *path):
+        """
+        Get which config layer a value came from
+
+        Args:
+            path(string): The keys leading to the value, eg. 'rds', 'storage'
+
+        Returns:
+            (string): One of 'defaults', 'user' or 'passwords', None if the
+                top level key isn't in the config
+        """
+        if not path or path[0] not in self.config_sources:
+            return None
+        return utils.layer_source(self.config_sources[path[0]], path[1:])
+
+    @staticmethod
+    def load_yaml(fp, cache_dir=None):
+        """
+        Load a YAML file, parsing it at most once per process while it is
+        unchanged
+
+        Args:
+            fp(string): The path of the YAML file
+            cache_dir(string): Optional directory to also keep parsed files
+                in, so that other processes can skip parsing them
+
+        Returns:
+            The parsed YAML, None if the file doesn't exist. This is a copy
+            that the caller is free to modify.
+        """
+        if not os.path.exists(fp):
+            return None
+        path = os.path.abspath(fp)
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+        cached = _parsed_yaml.get(path)
+        if cached is None or cached[0] != signature:
+            data = None
+            cache_file = None
+            if cache_dir:
+                cache_key = hashlib.sha1(repr((path, signature))).hexdigest()
+                cache_file = os.path.join(cache_dir, '{0}.marshal'.format(cache_key))
+                try:
+                    with open(cache_file, 'rb') as f:
+                        data = marshal.load(f)
+                except (IOError, EOFError, ValueError, TypeError):
+                    data = None
+            if data is None:
+                with open(path) as f:
+                    data = yaml.load(f, Loader=YAML_LOADER)
+                if cache_file:
+                    ProjectConfig._write_yaml_cache(cache_file, data)
+            cached = (signature, data)
+            _parsed_yaml[path] = cached
+        return deepcopy(cached[1])
+
     @staticmethod
-    def load_yaml(fp):
-        if os.path.exists(fp):
-            return yaml.load(open(fp).read())
+    def _write_yaml_cache(cache_file, data):
+        # marshal only holds plain data, so loading a cache file can't run
+        # code the way unpickling can. Configs holding anything else, e.g.
+        # dates, just aren't cached on disk.
+        try:
+            serialized = marshal.dumps(data)
+        except ValueError:
+            return
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        # Parsed configs include passwords, so only we can read them
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(serialized)
+        os.rename(tmp_path, cache_file)
 
     @staticmethod
     def validate_configuration_settings(configuration_settings):
@@ -103,9 +185,69 @@ class ProjectConfig:
                                             % (key))
 
 
+class IndexedTemplate(Template):
+    """
+    A troposphere Template that also indexes its resources by type as they
+    are added, so type lookups don't have to scan every resource.
+    """
+
+    def __init__(self):
+        super(IndexedTemplate, self).__init__()
+        self.resources_by_type = {}
+
+    def add_resource(self, resource):
+        added = super(IndexedTemplate, self).add_resource(resource)
+        for r in (resource if isinstance(resource, list) else [resource]):
+            self.resources_by_type.setdefault(r.resource_type, []).append(r)
+        return added
+
+
+def section_builder(func=None, config_keys=None):
+    """
+    Decorator for ConfigParser methods that build a section of the template
+    without arguments. The result is kept on the parser with a digest of the
+    config it was built from, and reused until that config changes. So a
+    section is only built once per render however many other sections ask for
+    it, and later renders only rebuild the sections whose config changed.
+
+    Args:
+        config_keys(tuple): The top level config keys the section is built
+            from, eg. ('ec2',). By default any change to the config rebuilds
+            the section.
+
+    Subclasses can decorate their own builders too, as @section_builder or
+    @section_builder(config_keys=(...)), and should call invalidate_sections()
+    if a builder uses anything besides the config data, stack name,
+    environment and application.
+    """
+    if func is None:
+        return functools.partial(section_builder, config_keys=config_keys)
+
+    @functools.wraps(func)
+    def wrapper(self):
+        sections = self.__dict__.setdefault('_sections', {})
+        digest = self._section_digest(config_keys)
+        built = sections.get(func.__name__)
+        if built is None or built[0] != digest:
+            cached = self._load_section(func.__name__, digest)
+            if cached is not None:
+                built = (digest, cached[0])
+            else:
+                built = (digest, func(self))
+                self._store_section(func.__name__, digest, built[1])
+            sections[func.__name__] = built
+        return built[1]
+    return wrapper
+
+
 class ConfigParser(object):
 
     config = {}
+    # Optional template_cache.TemplateCache used to skip repeat renders
+    template_cache = None
+    # Optional template_cache.SectionCache used to skip rebuilding sections
+    # built by an earlier run
+    section_cache = None
 
     def __init__(self, data, stack_name, environment=None, application=None):
         self.stack_name = stack_name
@@ -115,7 +257,38 @@ class ConfigParser(object):
         self.environment = environment
         self.application = application
 
-    def process(self):
+    def process(self, compact=False):
+        """
+        Render the full cloudformation template for the config
+
+        Args:
+            compact(bool): True to serialize without indentation or spacing,
+                which is what we send to cloudformation, False for the
+                human readable form
+
+        Returns:
+            (string): The JSON template body
+        """
+        cache_key = None
+        if self.template_cache is not None:
+            cache_key = self.template_cache.key(self, compact=compact)
+            if cache_key:
+                cached_template = self.template_cache.get(cache_key)
+                if cached_template is not None:
+                    return cached_template
+
+        self._config_digests = {}
+        try:
+            template_body = self._render(compact)
+        finally:
+            self._config_digests = None
+        if cache_key:
+            self.template_cache.set(cache_key, template_body)
+        return template_body
+
+    def _render(self, compact):
+        # Sections are only rebuilt if their config has changed since the
+        # last render
         template = self.base_template()
 
         vpc = self.vpc()
@@ -128,28 +301,247 @@ class ConfigParser(object):
         map(template.add_resource, ec2)
 
         if 'elb' in self.data:
-            self.elb(template)
+            self._add_template_section(template, 'elb', ('elb', 'ssl'))
 
         if 'rds' in self.data:
-            self.rds(template)
+            self._add_template_section(template, 'rds', ('rds',))
 
         if 'elasticache' in self.data:
-            self.elasticache(template)
+            self._add_template_section(template, 'elasticache', ('elasticache',))
 
         if 's3' in self.data:
-            self.s3(template)
+            self._add_template_section(template, 's3', ('s3',),
+                                       files=self._s3_policy_files())
+
+        # The ASG may have been kept from a previous render, so link it to
+        # this render's ELBs (or none)
+        self._attach_elbs(template)
 
-        template = json.loads(template.to_json())
+        template = self._template_to_dict(template)
         if 'includes' in self.data:
             for inc_path in self.data['includes']:
                 inc = json.load(open(inc_path))
-                template = utils.dict_merge(template, inc)
-        return json.dumps(
-            template, sort_keys=True, indent=4, separators=(',', ': '))
+                template, _ = utils.merge_layers([template, inc])
+        return self.serialize_template(template, compact=compact)
+
+    def _section_digest(self, config_keys=None, files=()):
+        """
+        Get a digest of everything a section is built from
+
+        Args:
+            config_keys(tuple): The top level config keys the section uses,
+                None for the whole config
+            files(list): Paths of files the section reads in
+
+        Returns:
+            (string): The hex digest
+        """
+        if config_keys is None:
+            config_keys = sorted(self.data.keys())
+        digest = hashlib.sha1(repr((
+            # Which sections are enabled changes the iam policy and
+            # what other sections link to
+            sorted(self.data.keys()),
+            self.stack_name,
+            self.environment,
+            self.application)))
+        for key in config_keys:
+            digest.update(key)
+            digest.update(self._config_digest(key))
+        for path in files:
+            digest.update(path)
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def _config_digest(self, key):
+        # During process() each key is only hashed once, as the config
+        # can't change mid-render
+        config_digests = self.__dict__.get('_config_digests')
+        if config_digests is not None and key in config_digests:
+            return config_digests[key]
+        # Not sorting keys lets json use its C encoder. The same config
+        # could in theory hash differently, which only costs a rebuild.
+        value_digest = hashlib.sha1(json.dumps(self.data.get(key), default=repr)).digest()
+        if config_digests is not None:
+            config_digests[key] = value_digest
+        return value_digest
+
+    def _add_template_section(self, template, name, config_keys, files=()):
+        """
+        Add a section whose builder adds its resources and outputs straight
+        to the template, eg. elb(template). What the builder added is kept
+        with a digest of its config and added again as is by later renders,
+        until that config changes.
+
+        Args:
+            template: The troposphere.Template object
+            name(string): The name of the builder method, eg. 'elb'
+            config_keys(tuple): The top level config keys the section uses
+            files(list): Paths of files the section reads in
+        """
+        builder = getattr(self, name)
+        if getattr(template, 'resources_by_type', None) is None:
+            # Can't tell which resources the builder added
+            builder(template)
+            return
+        sections = self.__dict__.setdefault('_sections', {})
+        digest = self._section_digest(config_keys, files)
+        built = sections.get(name)
+        if built is None or built[0] != digest:
+            cached = self._load_section(name, digest)
+            if cached is not None:
+                built = sections[name] = (digest, cached[0], cached[1])
+        if built is not None and built[0] == digest:
+            map(template.add_resource, built[1])
+            template.add_output(built[2])
+            return
+
+        resource_counts = dict((t, len(r)) for t, r in template.resources_by_type.iteritems())
+        output_titles = set(template.outputs)
+        builder(template)
+        resources = []
+        for resource_type, type_resources in template.resources_by_type.iteritems():
+            resources.extend(type_resources[resource_counts.get(resource_type, 0):])
+        outputs = [o for title, o in template.outputs.iteritems() if title not in output_titles]
+        sections[name] = (digest, resources, outputs)
+        self._store_section(name, digest, resources, outputs)
+
+    def _load_section(self, name, digest):
+        """
+        Returns:
+            (tuple): The resources and outputs of the section from the
+                section cache, None if there's no cache or it misses
+        """
+        if self.section_cache is None:
+            return None
+        return self.section_cache.get(self.section_cache.key(self, name, digest))
+
+    def _store_section(self, name, digest, resources, outputs=()):
+        # Only sections of resources can be stored, not eg. the OS data
+        if self.section_cache is None or not isinstance(resources, list):
+            return
+        if not all(isinstance(r, AWSObject) for r in resources):
+            return
+        self.section_cache.set(self.section_cache.key(self, name, digest), resources, outputs)
+
+    def _s3_policy_files(self):
+        s3_data = self.data.get('s3')
+        if not isinstance(s3_data, dict):
+            return []
+        paths = [bucket['policy'] for bucket in s3_data.get('buckets', []) if 'policy' in bucket]
+        if 'policy' in s3_data:
+            paths.append(s3_data['policy'])
+        return paths
+
+    def invalidate_sections(self, *names):
+        """
+        Forget built sections so that they are rebuilt on next use
+
+        Args:
+            names(string): The builder method names to forget, eg. 'vpc'.
+                All sections are forgotten if none are given.
+        """
+        sections = self.__dict__.setdefault('_sections', {})
+        if not names:
+            sections.clear()
+        for name in names:
+            sections.pop(name, None)
+
+    @classmethod
+    def _template_to_dict(cls, template):
+        """
+        Convert a troposphere template into plain python dicts and lists in
+        a single pass, so that includes can be merged into it and it can be
+        serialized once without a to_json/loads round trip.
+
+        Args:
+            template:
+                The troposphere.Template object
+
+        Returns:
+            (dict): The template in the same form as troposphere's to_json
+        """
+        t = {}
+        if template.description:
+            t['Description'] = template.description
+        if template.metadata:
+            t['Metadata'] = template.metadata
+        if template.conditions:
+            t['Conditions'] = template.conditions
+        if template.mappings:
+            t['Mappings'] = template.mappings
+        if template.outputs:
+            t['Outputs'] = template.outputs
+        if template.parameters:
+            t['Parameters'] = template.parameters
+        if template.version:
+            t['AWSTemplateFormatVersion'] = template.version
+        t['Resources'] = template.resources
+        return cls._to_plain(t)
+
+    @classmethod
+    def _to_plain(cls, obj):
+        # Same conversion troposphere's awsencode does while encoding, but
+        # building new containers so the troposphere objects are untouched
+        if hasattr(obj, 'JSONrepr'):
+            return cls._to_plain(obj.JSONrepr())
+        if isinstance(obj, dict):
+            return dict((k, cls._to_plain(v)) for k, v in obj.iteritems())
+        if isinstance(obj, (list, tuple)):
+            return [cls._to_plain(v) for v in obj]
+        return obj
+
+    @staticmethod
+    def serialize_template(template, compact=False):
+        """
+        Serialize a template dictionary to JSON
+
+        Args:
+            template(dict): The template in plain dictionary form
+            compact(bool): True for the smallest output, False to indent it
+
+        Returns:
+            (string): The JSON template body
+        """
+        if compact:
+            return json.dumps(template, sort_keys=True, separators=(',', ':'))
+        return json.dumps(template, sort_keys=True, indent=4, separators=(',', ': '))
+
+    @staticmethod
+    def size_report(template_body):
+        """
+        Break down the size of a template by resource
+
+        Args:
+            template_body(string): The JSON template
+
+        Returns:
+            (dict): The 'total' size in bytes of the template body, the
+                'compact' size it would be when minified, the compact size
+                of each top level 'sections' and 'resources' as a list of
+                (logical id, resource type, bytes), largest first
+        """
+        template = json.loads(template_body)
+
+        def compact_size(value):
+            return len(json.dumps(value, separators=(',', ':')))
+
+        resources = []
+        for title, resource in template.get('Resources', {}).iteritems():
+            # Counting the "title": prefix too
+            resources.append((title, resource.get('Type'), compact_size({title: resource}) - 2))
+        resources.sort(key=lambda r: (-r[2], r[0]))
+        return {
+            'total': len(template_body),
+            'compact': compact_size(template),
+            'sections': dict((k, compact_size(v)) for k, v in template.iteritems()),
+            'resources': resources,
+        }
 
     def base_template(self):
         from bootstrap_cfn import vpc
-        t = Template()
+        t = IndexedTemplate()
 
         # Get the OS specific data
         os_data = self._get_os_data()
@@ -208,6 +600,7 @@ class ConfigParser(object):
 
         return t
 
+    @section_builder(config_keys=())
     def vpc(self):
 
         vpc = VPC(
@@ -310,6 +703,7 @@ class ConfigParser(object):
         # return json.loads(json.dumps(dict((r.title, r) for r in resources), cls=awsencode))
         return resources
 
+    @section_builder(config_keys=())
     def iam(self):
         role = Role(
             "BaseHostRole",
@@ -551,23 +945,26 @@ class ConfigParser(object):
         if 'db-engine' in self.data['rds'] and self.data['rds']['db-engine'].startswith("sqlserver"):
             required_fields.pop('db-name')
 
-        if 'identifier' in self.data['rds']:
+        # Work on a copy so that rendering again doesn't add the stack
+        # id to the identifier twice
+        rds_data = dict(self.data['rds'])
+        if 'identifier' in rds_data:
             # update identifier name
-            self.data['rds']['identifier'] = "{}-{}".format(self.data['rds']['identifier'], self.stack_id)
-            logging.info("identifier was updated to {}".format(self.data['rds']['identifier']))
-            print "identifier was updated to {}".format(self.data['rds']['identifier'])
+            rds_data['identifier'] = "{}-{}".format(rds_data['identifier'], self.stack_id)
+            logging.info("identifier was updated to {}".format(rds_data['identifier']))
+            print "identifier was updated to {}".format(rds_data['identifier'])
 
         # TEST FOR REQUIRED FIELDS AND EXIT IF MISSING ANY
         for yaml_key, rds_prop in required_fields.iteritems():
-            if yaml_key not in self.data['rds']:
+            if yaml_key not in rds_data:
                 print "\n\n[ERROR] Missing RDS fields [%s]" % yaml_key
                 sys.exit(1)
             else:
-                rds_instance.__setattr__(rds_prop, self.data['rds'][yaml_key])
+                rds_instance.__setattr__(rds_prop, rds_data[yaml_key])
 
         for yaml_key, rds_prop in optional_fields.iteritems():
-            if yaml_key in self.data['rds']:
-                rds_instance.__setattr__(rds_prop, self.data['rds'][yaml_key])
+            if yaml_key in rds_data:
+                rds_instance.__setattr__(rds_prop, rds_data[yaml_key])
 
         # Add resources and outputs
         map(template.add_resource, resources)
@@ -746,7 +1143,8 @@ class ConfigParser(object):
             load_balancer = LoadBalancer(
                 "ELB" + safe_name,
                 Subnets=[Ref("SubnetA"), Ref("SubnetB"), Ref("SubnetC")],
-                Listeners=elb['listeners'],
+                # Copied, as HTTPS listeners get the certificate added
+                Listeners=[dict(listener) for listener in elb['listeners']],
                 Scheme=elb['scheme'],
                 ConnectionDrainingPolicy=ConnectionDrainingPolicy(
                     Enabled=True,
@@ -1010,6 +1408,7 @@ class ConfigParser(object):
             'content': self.HOSTNAME_BOOTHOOK_TEMPLATE.format(hostname=hostname)
         }
 
+    @section_builder(config_keys=('ec2',))
     def ec2(self):
         # LOAD STACK TEMPLATE
         data = self.data['ec2']
@@ -1105,8 +1504,9 @@ class ConfigParser(object):
         # Add a name tag for easy ec2 instance identification in the AWS console
         if data['tags'].get("Name", None) is None:
             ec2_tags.append(self._get_default_resource_name_tag(type="ec2"))
-        # Get all tags from the config
-        for k, v in data['tags'].items():
+        # Get all tags from the config, in key order so the template
+        # doesn't depend on how the config dict was built up
+        for k, v in sorted(data['tags'].items()):
             if k not in deprecated_tags:
                 ec2_tags.append(Tag(k, v, True))
             else:
@@ -1151,26 +1551,44 @@ class ConfigParser(object):
 
     @classmethod
     def _find_resources(cls, template, resource_type):
-        f = lambda x: x.resource_type == resource_type
-        return filter(f, template.resources.values())
+        """
+        Get the resources of a type from the template, in the order they were
+        added when the template is an IndexedTemplate
+
+        Args:
+            template: The troposphere.Template object
+            resource_type(string): The resource type identifier
+
+        Returns:
+            (list): The matching resources
+        """
+        resources_by_type = getattr(template, 'resources_by_type', None)
+        if resources_by_type is not None:
+            return list(resources_by_type.get(resource_type, []))
+        return [r for r in template.resources.values() if r.resource_type == resource_type]
 
     @classmethod
     def _get_elb_canonical_name(cls, elb_yaml_name):
         return 'ELB-{}'.format(elb_yaml_name.replace('.', ''))
 
     def _attach_elbs(self, template):
-        if 'elb' not in self.data:
-            return template
         asgs = self._find_resources(template,
                                     'AWS::AutoScaling::AutoScalingGroup')
         if len(asgs) > 0:
-            elbs = self._find_resources(template,
-                                        'AWS::ElasticLoadBalancing::LoadBalancer')
-            asgs[0].LoadBalancerNames = [Ref(x) for x in elbs]
+            elbs = []
+            if 'elb' in self.data:
+                elbs = self._find_resources(template,
+                                            'AWS::ElasticLoadBalancing::LoadBalancer')
+            if elbs:
+                asgs[0].LoadBalancerNames = [Ref(x) for x in elbs]
+            else:
+                # Drop any ELBs attached by an earlier render
+                asgs[0].properties.pop('LoadBalancerNames', None)
             template.resources[asgs[0].title] = asgs[0]
 
         return template
 
+    @section_builder(config_keys=('ec2',))
     def _get_os_data(self):
         """
         Get details about the OS from the config data
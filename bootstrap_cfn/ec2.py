@@ -7,6 +7,7 @@ from bootstrap_cfn import utils
 class EC2:
 
     conn_cfn = None
+    conn_ec2 = utils.PooledConnection(boto.ec2)
     aws_region_name = None
     aws_profile_name = None
 
@@ -14,8 +15,6 @@ class EC2:
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
 
-        self.conn_ec2 = utils.connect_to_aws(boto.ec2, self)
-
         self.cfn = cloudformation.Cloudformation(
             aws_profile_name=aws_profile_name,
             aws_region_name=aws_region_name
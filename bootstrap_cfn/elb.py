@@ -17,6 +17,7 @@ class ELB:
 
     cfn = None
     iam = None
+    conn_elb = utils.PooledConnection(boto.ec2.elb)
     aws_region_name = None
     aws_profile_name = None
 
@@ -24,8 +25,6 @@ class ELB:
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
 
-        self.conn_elb = utils.connect_to_aws(boto.ec2.elb, self)
-
         self.iam = iam.IAM(aws_profile_name, aws_region_name)
         self.cfn = cloudformation.Cloudformation(
             aws_profile_name, aws_region_name
@@ -19,6 +19,21 @@ class CfnHostnamePatternError(BootstrapCfnError):
     pass
 
 
+class CfnChangeSetError(BootstrapCfnError):
+    def __init__(self, stack_name, reason):
+        super(CfnChangeSetError, self).__init__(
+            "Could not create a change set for stack {0}: {1}".format(stack_name, reason)
+        )
+
+
+class CfnTemplateTooLargeError(BootstrapCfnError):
+    def __init__(self, size, limit):
+        super(CfnTemplateTooLargeError, self).__init__(
+            "Template is {0} bytes, over the {1} byte limit for sending it inline. "
+            "Set a bucket to upload it to, e.g 'template_bucket:my-templates-bucket'".format(size, limit)
+        )
+
+
 class NoCredentialsError(BootstrapCfnError):
     def __init__(self):
         super(NoCredentialsError, self).__init__(
@@ -113,3 +128,9 @@ class UpdateDNSRecordError(BootstrapCfnError):
     def __init__(self):
         msg = "Error updating dns record. "
         super(UpdateDNSRecordError, self).__init__(msg)
+
+
+class CassetteError(BootstrapCfnError):
+    def __init__(self, service_name, operation, path):
+        msg = ("No response to {} {} was recorded in cassette {}. ".format(service_name, operation, path))
+        super(CassetteError, self).__init__(msg)
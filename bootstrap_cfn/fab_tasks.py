@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import atexit
+import json
 import logging
 import os
 import sys
@@ -8,11 +10,13 @@ import uuid
 import boto3
 
 from fabric.api import env, task
-from fabric.colors import green, red
+from fabric.colors import green, red, yellow
 from fabric.utils import abort
 
+from bootstrap_cfn import api_metrics, batch, stream, timeline, utils
 from bootstrap_cfn.autoscale import Autoscale
-from bootstrap_cfn.cloudformation import Cloudformation
+from bootstrap_cfn.cassette import Cassette
+from bootstrap_cfn.cloudformation import Cloudformation, MAX_TEMPLATE_BODY_SIZE, StackWaiter
 from bootstrap_cfn.config import ConfigParser, ProjectConfig
 from bootstrap_cfn.elb import ELB
 from bootstrap_cfn.errors import (ActiveTagExistConflictError, BootstrapCfnError,
@@ -21,6 +25,7 @@ from bootstrap_cfn.errors import (ActiveTagExistConflictError, BootstrapCfnError
                                   TagRecordNotFoundError, UpdateDNSRecordError, ZoneIDNotFoundError)
 from bootstrap_cfn.iam import IAM
 from bootstrap_cfn.r53 import R53
+from bootstrap_cfn.template_cache import SectionCache, TemplateCache
 from bootstrap_cfn.utils import tail
 from bootstrap_cfn.vpc import VPC
 
@@ -33,6 +38,9 @@ env.setdefault('config')
 env.setdefault('stack_passwords')
 env.setdefault('blocking', True)
 env.setdefault('aws_region', 'eu-west-1')
+env.setdefault('cache_dir', None)
+env.setdefault('template_bucket', None)
+env.setdefault('api_stats', '')
 
 # GLOBAL VARIABLES
 TIMEOUT = 3600
@@ -62,6 +70,9 @@ def aws(profile_name):
         variable to
     """
     env.aws = str(profile_name).lower()
+    # Replayed runs don't need the profile to exist
+    if utils.connections.cassette is not None and utils.connections.cassette.replaying:
+        return
     # Setup boto so we actually use this environment
     boto3.setup_default_session(profile_name=env.aws,
                                 region_name=env.aws_region)
@@ -168,6 +179,120 @@ def blocking(block):
     env.blocking = str(block).lower() in ("yes", "true", "t", "1")
 
 
+@task
+def cache(cache_dir):
+    """
+    Set the directory to cache rendered templates in
+
+    Sets the environment variable 'cache_dir'. When set, parsed YAML
+    config files, rendered cloudformation templates and the template
+    sections they are built from are stored under it and reused by later
+    runs whose inputs are unchanged.
+
+    Args:
+        cache_dir(string): The string to set the
+        variable to
+    """
+    env.cache_dir = os.path.expanduser(str(cache_dir))
+
+
+@task
+def template_bucket(bucket_name):
+    """
+    Set the s3 bucket to upload large templates to
+
+    Sets the environment variable 'template_bucket'. Templates too big
+    to send to cloudformation inline are uploaded to this bucket and
+    the stack created from there.
+
+    Args:
+        bucket_name(string): The string to set the
+        variable to
+    """
+    env.template_bucket = str(bucket_name)
+
+
+@task
+def api_stats(output=None):
+    """
+    Set how the AWS API calls made by the run are reported when it exits
+
+    Sets the environment variable 'api_stats'. By default every run that
+    calls AWS prints the number of calls, errors, throttles, retries and
+    the time taken by each service and operation. This writes them as
+    JSON to output instead, or turns the summary off.
+
+    Args:
+        output(string): Optional file to write the JSON summary to
+            instead of printing it, or 'off' for no summary
+    """
+    if output and str(output).lower() in ('off', 'no', 'false', 'f', '0'):
+        env.api_stats = 'off'
+    else:
+        env.api_stats = os.path.expanduser(str(output)) if output else ''
+
+
+@task
+def api_limits(limits=None, retries=None):
+    """
+    Set the AWS API calls per second allowed to each service
+
+    The limits are shared by every thread of the run. Throttled calls
+    are retried with backoff up to retries times. Run it before any
+    task that connects to AWS.
+
+    Args:
+        limits(string): Semicolon separated service=calls per second,
+            e.g. 'cloudformation=2;route53=5;default=10'
+        retries(int): Optional times to retry a throttled call
+    """
+    utils.throttle.configure(utils.parse_rate_limits(limits or ''),
+                             max_retries=int(retries) if retries else None)
+    # Connections already made keep the retries they were made with
+    utils.connections.clear()
+
+
+@task
+def cassette(path, mode='replay', latency=0):
+    """
+    Record the AWS API responses of the run to a file, or replay them
+
+    Recording calls AWS as usual and saves every response to path when
+    the run exits. Replaying answers every call from path instead,
+    without credentials or network, e.g. to benchmark or profile a task
+    offline. Run it before any task that connects to AWS.
+
+    Args:
+        path(string): The cassette file
+        mode(string): record or replay
+        latency(string): Seconds to wait before each replayed response,
+            or 'recorded' to wait as long as AWS took
+    """
+    recording = Cassette(os.path.expanduser(str(path)), mode=str(mode).lower(),
+                         latency=latency, region_name=env.aws_region)
+    utils.connections.use_cassette(recording)
+    if not recording.replaying:
+        atexit.register(recording.save)
+
+
+def report_api_stats():
+    """
+    Print the AWS API call summary to stderr, or write it to the 'api_stats'
+    file, unless 'api_stats' is off or the run made no calls
+    """
+    if env.api_stats == 'off' or not api_metrics.metrics.summary():
+        return
+    if env.api_stats:
+        api_metrics.metrics.write_json(env.api_stats)
+        print >> sys.stderr, "AWS API call summary written to {0}".format(env.api_stats)
+    else:
+        print >> sys.stderr, "\nAWS API calls:"
+        print >> sys.stderr, api_metrics.metrics.format_summary()
+
+
+atexit.register(report_api_stats)
+
+
 @task
 def user(username):
     """
@@ -484,16 +609,23 @@ def get_basic_config():
     Returns the basic unparsed configuration file for the project
     """
     _validate_fabric_env()
+    yaml_cache_dir = None
+    if env.cache_dir:
+        yaml_cache_dir = os.path.join(env.cache_dir, 'yaml')
     project_config = ProjectConfig(
         env.config,
         env.environment,
-        passwords=env.stack_passwords)
+        passwords=env.stack_passwords,
+        cache_dir=yaml_cache_dir)
     return project_config.config
 
 
 def get_config():
     Parser = env.get('cloudformation_parser', ConfigParser)
     cfn_config = Parser(get_basic_config(), get_stack_name(), environment=env.environment, application=env.application)
+    if env.cache_dir:
+        cfn_config.template_cache = TemplateCache(os.path.join(env.cache_dir, 'templates'))
+        cfn_config.section_cache = SectionCache(os.path.join(env.cache_dir, 'sections'))
     return cfn_config
 
 
@@ -548,13 +680,14 @@ def cfn_delete(force=False, pre_delete_callbacks=None):
         r53_conn.delete_record(zone_name, zone_id, elb, stack_id, stack_tag, txt_tag_record)
         # Wait for stacks to delete
         print 'Waiting for stack to delete.'
+        waiter = StackWaiter(cfn, stack_name, from_status=cfn.get_stack_status(stack_name))
         cfn.delete(stack_name)
         if not env.blocking:
             print 'Running in non blocking mode. Exiting.'
             sys.exit(0)
-        tail(cfn, stack_name)
+        tail(cfn, stack_name, done=waiter.poll)
 
-        if cfn.stack_missing(stack_name):
+        if waiter.status == 'DELETE_COMPLETE':
             print green("Stack successfully deleted")
         else:
             print red("Stack deletion was unsuccessful")
@@ -610,7 +743,8 @@ def cfn_create(test=False):
     # print cfn_config.process()
     # Inject security groups in stack template and create stacks.
     try:
-        stack = cfn.create(stack_name, cfn_config.process(), tags=get_cloudformation_tags())
+        stack = cfn.create(stack_name, cfn_config.process(compact=True), tags=get_cloudformation_tags(),
+                           template_bucket=env.template_bucket)
     except Exception:
         # cleanup ssl certificates if any
         if 'ssl' in cfn_config.data:
@@ -625,10 +759,10 @@ def cfn_create(test=False):
         print 'Running in non blocking mode. Exiting.'
         sys.exit(0)
 
-    tail(cfn, stack_name)
-    stack_evt = cfn.get_last_stack_event(stack)
+    waiter = StackWaiter(cfn, stack)
+    tail(cfn, stack_name, done=waiter.poll)
 
-    if stack_evt.resource_status == 'CREATE_COMPLETE':
+    if waiter.status == 'CREATE_COMPLETE':
         print green('Successfully built stack {0}.'.format(stack))
     else:
         # So delete the SSL cert that we uploaded
@@ -638,6 +772,234 @@ def cfn_create(test=False):
     return True
 
 
+@task
+def cfn_update(force=False):
+    """
+    Update the AWS cloudformation stack in place
+
+    The template is rendered from the config and compared with the one
+    the stack is running. If they differ a change set is created, the
+    changes are shown, highlighting resources that will be replaced,
+    and once confirmed the change set is executed so that only the
+    changed resources are updated.
+
+    SSL certificates are not changed, use update_certs for those.
+
+    Configs without a vpc section keep the VPC address ranges of the
+    deployed stack, rather than picking a free range as cfn_create does,
+    which would replace the VPC and everything in it.
+
+    Args:
+        force(bool): True to apply the changes without asking for
+            confirmation
+    """
+    stack_name = get_stack_name()
+    cfn_config = get_config()
+    cfn = get_connection(Cloudformation)
+    deployed_template = cfn.get_template(stack_name)
+    if 'vpc' not in cfn_config.data:
+        subnet_config = deployed_template.get('Mappings', {}).get('SubnetConfig', {}).get('VPC')
+        if not subnet_config:
+            abort(red("Stack {0} has no SubnetConfig mapping to take the VPC address ranges from, "
+                      "add a vpc section to the config".format(stack_name)))
+        cfn_config.data['vpc'] = dict(subnet_config)
+    template_body = cfn_config.process(compact=True)
+
+    diff = cfn.diff_templates(deployed_template, json.loads(template_body))
+    if not any(diff.values()):
+        print green("Stack {0} is already up to date".format(stack_name))
+        return True
+    for title in diff['added']:
+        print green("+ {0}".format(title))
+    for title in diff['removed']:
+        print red("- {0}".format(title))
+    for title in diff['modified']:
+        print yellow("~ {0}".format(title))
+    for section in diff['sections']:
+        print yellow("~ {0} section".format(section))
+
+    change_set_id, changes = cfn.create_change_set(stack_name, template_body, get_cloudformation_tags(),
+                                                   template_bucket=env.template_bucket)
+    if not changes:
+        print green("Cloudformation found no resources to change in stack {0}".format(stack_name))
+        return True
+
+    print "\nChanges to stack {0}:".format(stack_name)
+    for change in changes:
+        replacement = change.get('Replacement')
+        line = "{0:<8} {1} ({2})".format(change['Action'], change['LogicalResourceId'], change['ResourceType'])
+        if replacement == 'True':
+            print red(line + " WILL BE REPLACED")
+        elif replacement == 'Conditional':
+            print yellow(line + " may be replaced")
+        else:
+            print line
+
+    if not force:
+        x = raw_input("Apply these changes to {0}? (y/n)\n".format(stack_name))
+        if x not in ['y', 'Y', 'Yes', 'yes']:
+            cfn.delete_change_set(change_set_id)
+            sys.exit(1)
+    waiter = StackWaiter(cfn, stack_name, from_status=cfn.get_stack_status(stack_name))
+    cfn.execute_change_set(change_set_id)
+    print green("\nSTACK {0} UPDATING...\n").format(stack_name)
+
+    if not env.blocking:
+        print 'Running in non blocking mode. Exiting.'
+        sys.exit(0)
+
+    tail(cfn, stack_name, done=waiter.poll, history=False)
+    if waiter.status == 'UPDATE_COMPLETE':
+        print green('Successfully updated stack {0}.'.format(stack_name))
+    else:
+        abort('Failed to update stack {0}: {1}'.format(stack_name, waiter.status))
+    return True
+
+
+@task
+def cfn_tail(stacks=None, rate=2, history=True):
+    """
+    Follow the events of one or more stacks at once
+
+    Events from every stack are interleaved, prefixed with the stack
+    name, until all of them have finished. Exits non-zero if any of
+    them failed.
+
+    Args:
+        stacks(string): Optional semicolon separated list of stack
+            names, e.g. 'app1-dev-1234abcd;app2-dev-5678abcd'. The
+            current stack by default
+        rate(float): API calls per second shared between the stacks
+        history(bool): False to only show new events
+    """
+    if stacks:
+        stack_names = [s.strip() for s in stacks.split(';') if s.strip()]
+    else:
+        stack_names = [get_stack_name()]
+    cfn = get_connection(Cloudformation)
+    results = stream.stream_stacks(cfn, stack_names,
+                                   rate=float(rate),
+                                   history=str(history).lower() in ("yes", "true", "t", "1"))
+
+    print "\nSummary:"
+    for name in stack_names:
+        result = results[name]
+        line = "{0}: {1} after {2}s ({3} events)".format(
+            name, result['status'] or 'MISSING', result['seconds'], result['events'])
+        if result.get('error'):
+            line += " - {0}".format(result['error'])
+        print green(line) if result['ok'] else red(line)
+    failed = [name for name in stack_names if not results[name]['ok']]
+    if failed:
+        abort(red("Stacks did not complete: {0}".format(", ".join(failed))))
+    return True
+
+
+@task
+def cfn_timeline(output=None, stack=None, top=10):
+    """
+    Show how long each resource of a stack took to create, update or
+    delete
+
+    Fetches the stack's whole event history once and prints the critical
+    path of its last operation and the slowest resource types.
+
+    Args:
+        output(string): Optional file to write the duration of every
+            resource operation to, as CSV if it ends in .csv, otherwise
+            as NDJSON
+        stack(string): Optional stack name. The current stack by default
+        top(int): Number of resource types to show
+    """
+    stack_name = stack or get_stack_name()
+    cfn = get_connection(Cloudformation)
+    rows = timeline.resource_timeline(timeline.fetch_events(cfn, stack_name))
+    if not rows:
+        abort(red("No events found for stack {0}".format(stack_name)))
+
+    print "Critical path:"
+    for row in timeline.critical_path(rows):
+        print "  {0:>7.0f}s  {1:<40} {2:<40} {3}".format(
+            row['seconds'], row['logical_resource_id'], row['resource_type'], row['status'])
+    print "\nSlowest resource types:"
+    for summary in timeline.resource_type_summary(rows)[:int(top)]:
+        print "  {0:<40} {1:>3} x, max {2:>6.0f}s, mean {3:>6.0f}s, total {4:>7.0f}s".format(
+            summary['resource_type'], summary['count'], summary['max_seconds'],
+            summary['mean_seconds'], summary['seconds'])
+    if output:
+        timeline.export(rows, os.path.expanduser(str(output)))
+        print "\nTimeline of {0} resource operations written to {1}".format(len(rows), output)
+    return rows
+
+
+@task
+def render_all(output_dir, environments=None, processes=None):
+    """
+    Render the templates for every environment in the config file
+
+    Renders in a pool of processes without touching AWS, writing
+    <environment>.json for each environment and a summary.json of
+    timings and failures to output_dir. Environments without a vpc
+    section would need AWS to pick their address ranges, so they are
+    reported as failed. Exits non-zero if any environment failed to
+    render.
+
+    Args:
+        output_dir(string): The directory to write the templates to
+        environments(string): Optional semicolon separated list of
+            environments to render, e.g. 'dev;staging'. All of them
+            by default
+        processes(int): Number of processes to render in, defaults
+            to the number of CPUs
+    """
+    if env.config is None:
+        sys.exit("\n[ERROR] Please specify a config file, e.g 'config:/tmp/sample-application.yaml'")
+    if environments:
+        environments = [e.strip().lower() for e in environments.split(';') if e.strip()]
+    summary = batch.render_environments(
+        env.config,
+        output_dir,
+        environments=environments,
+        passwords=env.stack_passwords,
+        application=env.application,
+        parser_class=env.get('cloudformation_parser', ConfigParser),
+        cache_dir=env.cache_dir,
+        processes=int(processes) if processes else None)
+
+    for name in summary['rendered']:
+        print green("{0}: rendered in {1}s".format(name, summary['environments'][name]['seconds']))
+    for name in summary['failed']:
+        print red("{0}: FAILED - {1}".format(name, summary['environments'][name]['error']))
+    print "Rendered {0} of {1} environments in {2}s".format(
+        len(summary['rendered']), len(summary['environments']), summary['seconds'])
+    if summary['failed']:
+        abort(red("Failed to render: {0}".format(", ".join(summary['failed']))))
+    return True
+
+
+@task
+def template_size(top=10):
+    """
+    Show the size of the template and the resources taking up most of it
+
+    Cloudformation only accepts templates up to 51200 bytes inline,
+    bigger ones are uploaded to the bucket set by template_bucket.
+
+    Args:
+        top(int): How many of the largest resources to list
+    """
+    cfn_config = get_config()
+    report = ConfigParser.size_report(cfn_config.process(compact=True))
+    colour = green if report['compact'] <= MAX_TEMPLATE_BODY_SIZE else red
+    print colour("Template is {0} bytes minified, the inline limit is {1} bytes".format(
+        report['compact'], MAX_TEMPLATE_BODY_SIZE))
+    for section, size in sorted(report['sections'].items(), key=lambda s: -s[1]):
+        print "{0:>10} {1}".format(size, section)
+    print "\nLargest resources:"
+    for title, resource_type, size in report['resources'][:int(top)]:
+        print "{0:>10} {1} ({2})".format(size, title, resource_type)
+
+
 @task
 def update_certs():
     """
@@ -752,13 +1114,17 @@ def set_autoscaling_desired_capacity(capacity, block=True):
 
 
 @task
-def cycle_instances(delay=None):
+def cycle_instances(delay=None, batch=1, surge=False):
     """
     Cycle the instances in the autoscaling group
 
     Args:
         delay(int): Number of seconds between new instance
             becoming healthy and killing the old one.
+        batch(string): Number of instances to replace at once, or
+            a percentage of the group, e.g. '25%'
+        surge(bool): Add all the replacements before terminating
+            any of the old instances
     """
     asg = get_connection(Autoscale)
     if not asg.group:
@@ -767,7 +1133,9 @@ def cycle_instances(delay=None):
         termination_delay = int(delay)
     else:
         termination_delay = None
-    asg.cycle_instances(termination_delay=termination_delay)
+    asg.cycle_instances(termination_delay=termination_delay,
+                        batch_size=batch,
+                        surge=str(surge).lower() in ("yes", "true", "t", "1"))
 
 
 @task
@@ -14,6 +14,7 @@ from bootstrap_cfn import utils
 class IAM:
 
     conn_cfn = None
+    conn_iam = utils.PooledConnection(boto.iam)
     aws_region_name = None
     aws_profile_name = None
 
@@ -21,8 +22,6 @@ class IAM:
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
 
-        self.conn_iam = utils.connect_to_aws(boto.iam, self)
-
     def upload_ssl_certificate(self, ssl_config, stack_name):
         for cert_name, ssl_data in ssl_config.items():
             self.upload_certificate(cert_name,
@@ -1,4 +1,5 @@
 import gzip
+import hashlib
 
 from StringIO import StringIO
 from contextlib import closing
@@ -45,8 +46,22 @@ def get_type(content, deftype):
     return(rtype)
 
 
+def get_boundary(parts):
+    """
+    Derive the MIME boundary from the parts instead of picking a random one,
+    so packing the same parts always gives the same user data and rendering
+    a template again doesn't change its launch configuration
+    """
+    digest = hashlib.sha1()
+    for arg in parts:
+        if isinstance(arg, basestring):
+            arg = {'content': arg}
+        digest.update(repr((arg.get('mime_type'), arg['content'])))
+    return '=' * 15 + digest.hexdigest() + '=='
+
+
 def pack(parts, opts={}):
-    outer = MIMEMultipart()
+    outer = MIMEMultipart(boundary=get_boundary(parts))
 
     for arg in parts:
         if isinstance(arg, basestring):
@@ -71,7 +86,8 @@ def pack(parts, opts={}):
 
     with closing(StringIO()) as buff:
         if opts.get('compress', False):
-            gfile = gzip.GzipFile(fileobj=buff)
+            # A fixed mtime keeps the output the same between runs
+            gfile = gzip.GzipFile(fileobj=buff, mode='wb', mtime=0)
             gfile.write(outer.as_string().encode())
             gfile.close()
         else:
@@ -20,6 +20,7 @@ class R53(object):
     }
 
     conn_cfn = None
+    conn_r53 = utils.PooledConnection(boto.route53)
     aws_region_name = None
     aws_profile_name = None
 
@@ -27,8 +28,6 @@ class R53(object):
         self.aws_profile_name = aws_profile_name
         self.aws_region_name = aws_region_name
 
-        self.conn_r53 = utils.connect_to_aws(boto.route53, self)
-
     def get_hosted_zone_id(self, zone_name):
         """
         Args:
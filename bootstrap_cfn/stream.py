@@ -0,0 +1,143 @@
+import logging
+import sys
+import threading
+import time
+
+from fabric.colors import blue, cyan, magenta, white
+
+from bootstrap_cfn import utils
+from bootstrap_cfn.cloudformation import STACK_SUCCESS_STATUSES, stack_settled
+
+# Colours for the stack name prefixes, chosen so they don't clash with the
+# green/yellow/red of the statuses
+PREFIX_COLOURS = [cyan, magenta, blue, white]
+
+
+class StackStreamer(object):
+    """
+    Follow the events of several stacks at once, one thread per stack
+
+    Events from all the stacks are interleaved on the output as they
+    arrive, each line prefixed with its stack's name. The event and status
+    calls of every stack take from one shared RateLimiter, so following
+    more stacks slows each one down rather than adding to the API calls
+    made.
+    """
+
+    def __init__(self, stack, stack_names, rate=2, burst=5, interval=2,
+                 timeout=3600, history=True, out=sys.stdout):
+        """
+        Args:
+            stack(Cloudformation): The Cloudformation connection object
+            stack_names(list): The names or ids of the stacks to follow
+            rate(float): API calls per second shared by all the stacks
+            burst(int): Most API calls that can be made at once
+            interval(int): Seconds between polls of each stack
+            timeout(int): Seconds to follow each stack before giving up
+            history(bool): False to skip the events from before we started
+            out(file): Where to write the events
+        """
+        self.stack = stack
+        self.stack_names = list(stack_names)
+        self.rate_limiter = utils.RateLimiter(rate, burst)
+        self.interval = interval
+        self.timeout = timeout
+        self.history = history
+        self.out = out
+        self.results = {}
+        self.output_lock = threading.Lock()
+        width = max([len(name) for name in self.stack_names] or [0])
+        self.prefixes = dict(
+            (name, PREFIX_COLOURS[i % len(PREFIX_COLOURS)]("[{0}] ".format(name.ljust(width))))
+            for i, name in enumerate(self.stack_names))
+
+    def run(self):
+        """
+        Follow every stack until it has finished, is missing or times out
+
+        Returns:
+            (dict): The result of each stack keyed on its name, see follow()
+        """
+        threads = []
+        for name in self.stack_names:
+            thread = threading.Thread(target=self.follow, args=(name,), name=name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Join with a timeout so that Ctrl-C still interrupts us
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return self.results
+
+    def follow(self, stack_name):
+        """
+        Print the events of one stack until it has finished, storing the
+        final status, whether it succeeded, the number of events and how
+        long it took in seconds in results[stack_name]
+
+        A stack that disappears while we follow it has been deleted, so
+        its status is DELETE_COMPLETE. Only a stack that was never there
+        has no status.
+        """
+        start = utils._monotonic()
+        result = {'status': None, 'ok': False, 'events': 0}
+        seen = False
+        tailer = utils.EventTailer(self.stack, stack_name, rate_limiter=self.rate_limiter)
+        try:
+            if not self.history:
+                tailer.skip_history()
+            while True:
+                # Check the status before fetching the events, so that we
+                # have every event up to the one that finished the stack
+                self.rate_limiter.acquire()
+                status = self.stack.get_stack_status(stack_name)
+                if status is not None:
+                    seen = True
+                elif seen:
+                    status = 'DELETE_COMPLETE'
+                events = tailer.new_events()
+                self.emit(stack_name, events)
+                result['events'] += len(events)
+                if status is None or stack_settled(status):
+                    break
+                if utils._monotonic() - start >= self.timeout:
+                    result['error'] = "timed out after {0} seconds".format(self.timeout)
+                    break
+                time.sleep(self.interval)
+            result['status'] = status
+            result['ok'] = 'error' not in result and status in STACK_SUCCESS_STATUSES
+        except Exception as e:
+            logging.getLogger("bootstrap-cfn").exception(
+                "bootstrap-cfn::StackStreamer: Failed to follow stack {0}".format(stack_name))
+            result['error'] = str(e)
+        result['seconds'] = round(utils._monotonic() - start, 1)
+        self.results[stack_name] = result
+
+    def emit(self, stack_name, events):
+        if not events:
+            return
+        prefix = self.prefixes[stack_name]
+        with self.output_lock:
+            for e in events:
+                self.out.write(utils.format_event(e, prefix) + "\n")
+            self.out.flush()
+
+
+def stream_stacks(stack, stack_names, **kwargs):
+    """
+    Follow the events of several stacks at once until they have all
+    finished
+
+    Args:
+        stack(Cloudformation): The Cloudformation connection object
+        stack_names(list): The names or ids of the stacks to follow
+        kwargs: Passed on to StackStreamer
+
+    Returns:
+        (dict): The result of each stack keyed on its name, with its final
+            status (None if it never existed), whether it succeeded, the
+            number of events shown, how long it took in seconds and any
+            error
+    """
+    return StackStreamer(stack, stack_names, **kwargs).run()
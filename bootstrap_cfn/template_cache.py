@@ -0,0 +1,252 @@
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import pkg_resources
+
+import troposphere
+from troposphere import AWSObject, Output, awsencode
+
+# Modules besides the parser class whose code changes the rendered template
+RENDER_MODULES = ['bootstrap_cfn.mime_packer', 'bootstrap_cfn.utils', 'bootstrap_cfn.vpc']
+
+
+class TemplateCache(object):
+    """
+    On-disk cache of rendered cloudformation templates.
+
+    Entries are content addressed, the key is a hash of everything that
+    goes into a render: the merged project config, the stack name,
+    environment and application, the bytes of every include and s3 policy
+    file, the source of the parser class doing the rendering and of the
+    other modules used to render, and the troposphere and bootstrap_cfn
+    versions. If any of those change we get a new key, so entries never
+    need invalidating.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir(string): The directory to store rendered templates in,
+                created on first write if it does not exist
+        """
+        self.cache_dir = cache_dir
+
+    def key(self, parser, **render_options):
+        """
+        Work out the cache key for a parser's render
+
+        Args:
+            parser(ConfigParser): The parser about to render a template
+            render_options: Any extra options that change the rendered output
+
+        Returns:
+            (string): The hex digest identifying the render, None if the
+                render can't be cached
+        """
+        data = parser.data
+        if 'vpc' not in data:
+            # Without a vpc section the base template picks a free CIDR block
+            # from the live account, so the output isn't a function of the config
+            logging.info("bootstrap-cfn::TemplateCache: No vpc section in config, "
+                         "not caching the template")
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'config': data,
+            'stack_name': parser.stack_name,
+            'environment': parser.environment,
+            'application': parser.application,
+            'options': render_options,
+            'versions': self._versions(),
+        }, sort_keys=True, default=repr))
+        for path in self._referenced_files(data):
+            digest.update(path)
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        for source_file in self._parser_sources(parser):
+            with open(source_file, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            (string): The cached template body, None on a cache miss
+        """
+        try:
+            with open(self._path(key)) as f:
+                body = f.read()
+        except IOError:
+            return None
+        logging.info("bootstrap-cfn::TemplateCache: Using cached template %s" % key)
+        return body
+
+    def set(self, key, body):
+        """
+        Store a template body, written atomically so that concurrent renders
+        never see a partial file
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(body)
+        os.rename(tmp_path, self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{0}.json'.format(key))
+
+    @staticmethod
+    def _referenced_files(data):
+        """
+        Get the paths of the files a render reads in, in a stable order
+        """
+        paths = list(data.get('includes', []))
+        s3_data = data.get('s3')
+        if isinstance(s3_data, dict):
+            if 'policy' in s3_data:
+                paths.append(s3_data['policy'])
+            for bucket_config in s3_data.get('buckets', []):
+                if 'policy' in bucket_config:
+                    paths.append(bucket_config['policy'])
+        return paths
+
+    @staticmethod
+    def _parser_sources(parser):
+        """
+        Get the source files of the parser class and its bases, and of the
+        other modules used to render, so that a code change to any of them
+        produces a new key
+        """
+        sources = [klass for klass in inspect.getmro(type(parser)) if klass is not object]
+        sources += [importlib.import_module(name) for name in RENDER_MODULES]
+        source_files = []
+        for source in sources:
+            source_file = inspect.getsourcefile(source)
+            if source_file and source_file not in source_files:
+                source_files.append(source_file)
+        return source_files
+
+    @staticmethod
+    def _versions():
+        """
+        Get the versions of the libraries whose code isn't in the key, so
+        that an upgrade produces a new key
+        """
+        try:
+            bootstrap_cfn_version = pkg_resources.get_distribution('bootstrap_cfn').version
+        except pkg_resources.DistributionNotFound:
+            bootstrap_cfn_version = None
+        return {'troposphere': troposphere.__version__, 'bootstrap_cfn': bootstrap_cfn_version}
+
+
+class SectionCache(object):
+    """
+    On-disk cache of built template sections, so that a run only rebuilds
+    the sections whose config changed since an earlier run, even when the
+    template as a whole has to be rendered again.
+
+    Entries are keyed on the digest of the config a section is built from
+    (ConfigParser._section_digest) together with the source of the parser
+    code and the library versions, as for TemplateCache. Sections are
+    stored as the JSON of their resources and outputs, which are rebuilt as
+    troposphere objects when loaded.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir(string): The directory to store sections in, created
+                on first write if it does not exist
+        """
+        self.cache_dir = cache_dir
+        self._code_digests = {}
+
+    def key(self, parser, name, digest):
+        """
+        Args:
+            parser(ConfigParser): The parser building the section
+            name(string): The section's builder method name, eg. 'elb'
+            digest(string): The section's config digest
+
+        Returns:
+            (string): The hex digest identifying the built section
+        """
+        parser_class = type(parser)
+        code_digest = self._code_digests.get(parser_class)
+        if code_digest is None:
+            code = hashlib.sha256(json.dumps(TemplateCache._versions(), sort_keys=True))
+            for source_file in TemplateCache._parser_sources(parser):
+                with open(source_file, 'rb') as f:
+                    code.update(f.read())
+            code_digest = self._code_digests[parser_class] = code.hexdigest()
+        return hashlib.sha256(json.dumps([name, digest, code_digest])).hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            (tuple): The section's resources and outputs as troposphere
+                objects, None on a cache miss
+        """
+        try:
+            with open(self._path(key)) as f:
+                section = json.load(f)
+        except (IOError, ValueError):
+            return None
+        resource_classes = self._resource_classes()
+        resources = []
+        for title, resource in section['resources']:
+            resource_class = resource_classes.get(resource['Type'])
+            if resource_class is None:
+                # The module defining the type hasn't been imported
+                return None
+            obj = resource_class.from_dict(title, resource.get('Properties', {}))
+            for attribute, value in resource.iteritems():
+                if attribute not in ('Type', 'Properties'):
+                    obj.resource[attribute] = value
+            resources.append(obj)
+        outputs = [Output.from_dict(title, properties) for title, properties in section['outputs']]
+        logging.info("bootstrap-cfn::SectionCache: Using cached section %s" % key)
+        return resources, outputs
+
+    def set(self, key, resources, outputs=()):
+        """
+        Store a section, written atomically so that concurrent renders
+        never see a partial file
+        """
+        body = json.dumps({
+            'resources': [(r.title, r.resource) for r in resources],
+            'outputs': [(o.title, o.properties) for o in outputs],
+        }, cls=awsencode)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(body)
+        os.rename(tmp_path, self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{0}.json'.format(key))
+
+    @staticmethod
+    def _resource_classes():
+        """
+        Get the troposphere resource classes of every loaded troposphere
+        module by their resource type
+        """
+        classes = {}
+        for name, module in sys.modules.items():
+            if module is None or not name.startswith('troposphere.'):
+                continue
+            for value in vars(module).values():
+                if (inspect.isclass(value) and issubclass(value, AWSObject) and
+                        getattr(value, 'resource_type', None)):
+                    classes[value.resource_type] = value
+        return classes
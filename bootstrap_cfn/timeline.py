@@ -0,0 +1,188 @@
+import csv
+import json
+
+from bootstrap_cfn import utils
+
+# Fields of each timeline row, in the order they are exported
+TIMELINE_FIELDS = ['stack_name', 'logical_resource_id', 'physical_resource_id', 'resource_type',
+                   'operation', 'status', 'start', 'end', 'seconds']
+
+# Timestamps are to the second, so a resource can appear to start up to a
+# second before the one it waited for finished
+CRITICAL_PATH_TOLERANCE = 1
+
+
+def fetch_events(stack, stack_name):
+    """
+    Get a stack's whole event history
+
+    Args:
+        stack(Cloudformation): The Cloudformation connection object
+        stack_name(string): The stack name or id
+
+    Returns:
+        (list): The events, oldest first
+    """
+    return utils.EventTailer(stack, stack_name).new_events()
+
+
+def resource_timeline(events):
+    """
+    Work out how long each operation on each resource took from a stack's
+    events
+
+    Each *_IN_PROGRESS event is paired with the next *_COMPLETE or
+    *_FAILED event of the same operation on the same resource, e.g.
+    CREATE_IN_PROGRESS with CREATE_COMPLETE. The stack itself has rows
+    too, with its name as the logical resource id. A stack's cleanup,
+    e.g. UPDATE_COMPLETE_CLEANUP_IN_PROGRESS, has no completion status
+    of its own and ends with the stack's next *_COMPLETE or *_FAILED
+    event, e.g. UPDATE_COMPLETE.
+
+    Args:
+        events(list): The stack events, oldest first
+
+    Returns:
+        (list): A dict per operation with TIMELINE_FIELDS, in the order
+            they started. Operations that haven't finished have no end
+            or seconds.
+    """
+    rows = []
+    started = {}
+    for e in events:
+        status = e.resource_status
+        if status.endswith('_IN_PROGRESS'):
+            operation = status[:-len('_IN_PROGRESS')]
+            key = (e.logical_resource_id, operation)
+            # Some resources log more than one event while in progress
+            if key not in started:
+                row = {
+                    'stack_name': e.stack_name,
+                    'logical_resource_id': e.logical_resource_id,
+                    'physical_resource_id': e.physical_resource_id,
+                    'resource_type': e.resource_type,
+                    'operation': operation,
+                    'status': status,
+                    'start': e.timestamp,
+                    'end': None,
+                    'seconds': None,
+                }
+                started[key] = row
+                rows.append(row)
+        elif status.endswith('_COMPLETE') or status.endswith('_FAILED'):
+            operation = status.rsplit('_', 1)[0]
+            finished = [started.pop((e.logical_resource_id, operation), None)]
+            finished.extend(started.pop(key) for key in list(started)
+                            if key[0] == e.logical_resource_id and _is_cleanup(started[key]))
+            for row in finished:
+                if row is None:
+                    # It started before the history we have
+                    continue
+                row['status'] = status
+                row['physical_resource_id'] = e.physical_resource_id or row['physical_resource_id']
+                row['end'] = e.timestamp
+                row['seconds'] = (e.timestamp - row['start']).total_seconds()
+    return rows
+
+
+def _is_cleanup(row):
+    return row['operation'].endswith('_CLEANUP')
+
+
+def _is_stack(row):
+    return row['logical_resource_id'] == row['stack_name']
+
+
+def critical_path(rows):
+    """
+    Find the chain of resources that held up the stack's last operation
+
+    Cloudformation starts a resource once everything it depends on has
+    finished, so working back from the last resource to finish, each
+    resource's predecessor is taken to be the one that finished last
+    before it started. Resources deleted in the stack's cleanup after an
+    update are left out, as the update has finished by then.
+
+    Args:
+        rows(list): The timeline, from resource_timeline()
+
+    Returns:
+        (list): The rows on the critical path, first started first
+    """
+    finished = [row for row in rows if row['end'] is not None and not _is_stack(row)]
+    stack_rows = [row for row in rows if _is_stack(row) and not _is_cleanup(row)]
+    if stack_rows:
+        # Only the stack's last operation, not earlier updates or its cleanup
+        window_start = stack_rows[-1]['start']
+        cleanups = [row['start'] for row in rows
+                    if _is_stack(row) and _is_cleanup(row) and row['start'] >= window_start]
+        finished = [row for row in finished
+                    if row['start'] >= window_start and not (cleanups and row['start'] >= cleanups[0])]
+    if not finished:
+        return []
+    path = [max(finished, key=lambda row: row['end'])]
+    while True:
+        current = path[-1]
+        earlier = [row for row in finished
+                   if row['end'] < current['end'] and
+                   (row['end'] - current['start']).total_seconds() <= CRITICAL_PATH_TOLERANCE]
+        if not earlier:
+            break
+        path.append(max(earlier, key=lambda row: row['end']))
+    path.reverse()
+    return path
+
+
+def resource_type_summary(rows):
+    """
+    Returns:
+        (list): A dict per resource type with the number of operations
+            and the total, mean and maximum seconds they took, the
+            slowest first. The stack itself is left out.
+    """
+    types = {}
+    for row in rows:
+        if row['seconds'] is None or _is_stack(row):
+            continue
+        summary = types.setdefault(row['resource_type'], {
+            'resource_type': row['resource_type'], 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        summary['count'] += 1
+        summary['seconds'] += row['seconds']
+        summary['max_seconds'] = max(summary['max_seconds'], row['seconds'])
+    for summary in types.values():
+        summary['mean_seconds'] = round(summary['seconds'] / summary['count'], 1)
+    return sorted(types.values(), key=lambda s: (-s['max_seconds'], s['resource_type']))
+
+
+def _export_row(row):
+    exported = dict(row)
+    for field in ('start', 'end'):
+        if exported[field] is not None:
+            exported[field] = exported[field].isoformat()
+    return exported
+
+
+def write_ndjson(rows, path):
+    """Write the timeline with one JSON object per line"""
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(_export_row(row), sort_keys=True) + "\n")
+
+
+def write_csv(rows, path):
+    """Write the timeline as CSV, with a header row"""
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, TIMELINE_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(_export_row(row))
+
+
+def export(rows, path):
+    """
+    Write the timeline as CSV if path ends in .csv, otherwise as NDJSON
+    """
+    if path.lower().endswith('.csv'):
+        write_csv(rows, path)
+    else:
+        write_ndjson(rows, path)
@@ -1,63 +1,585 @@
+import datetime
+import hashlib
+import json
+import logging
 import os
+import random
 import sys
+import threading
 import time
 
 from copy import deepcopy
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import boto.exception
 import boto.provider
 import boto.sts
 
+import boto3
+
+from botocore.config import Config
+
 import bootstrap_cfn.errors as errors
+from bootstrap_cfn import api_metrics
+
+
+# Clock for poll deadlines, which isn't affected by changes to the system
+# time. python 2 has no time.monotonic, but os.times() has the real time
+# elapsed since a fixed point in the past, in clock ticks (1/100s on linux).
+# Windows leaves that at 0, so time.time is all there is there.
+if hasattr(time, 'monotonic'):
+    _monotonic = time.monotonic
+elif os.times()[4]:
+    def _monotonic():
+        return os.times()[4]
+else:
+    _monotonic = time.time
+
+
+class Poller(object):
+    """
+    Call a function until it returns something truthy or a deadline passes
+
+    Polls quickly at first and then backs off exponentially, with some
+    jitter so that several waits don't poll in step, up to max_interval
+    between calls. How long the last wait took is kept in elapsed and
+    attempts, and logged.
+    """
+
+    def __init__(self, timeout, initial_interval=1, max_interval=30,
+                 backoff=2, jitter=0.1):
+        """
+        Args:
+            timeout(int): Seconds to wait before giving up
+            initial_interval(int): Seconds to wait after the first call
+            max_interval(int): Longest to wait between calls, in seconds
+            backoff(int): What to multiply the interval by after each call
+            jitter(float): Fraction of the interval to randomly add or take
+                away from each wait
+        """
+        self.timeout = timeout
+        self.initial_interval = min(initial_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.elapsed = None
+        self.attempts = 0
+
+    def wait(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) until it returns something truthy
+
+        Returns:
+            The result of the successful call
+
+        Exceptions:
+            CfnTimeoutError: func didn't succeed before the timeout
+        """
+        logger = logging.getLogger("bootstrap-cfn")
+        name = getattr(func, '__name__', repr(func))
+        start = _monotonic()
+        deadline = start + self.timeout
+        interval = self.initial_interval
+        self.attempts = 0
+        while True:
+            self.attempts += 1
+            result = func(*args, **kwargs)
+            now = _monotonic()
+            self.elapsed = now - start
+            if result:
+                logger.info("bootstrap-cfn::Poller: {0} succeeded after {1:.1f} seconds ({2} attempts)"
+                            .format(name, self.elapsed, self.attempts))
+                return result
+            if now >= deadline:
+                raise errors.CfnTimeoutError("Timeout in {0} after {1:.0f} seconds ({2} attempts)"
+                                             .format(name, self.elapsed, self.attempts))
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(max(0, min(delay, deadline - now)))
+            interval = min(interval * self.backoff, self.max_interval)
 
 
 def timeout(timeout, interval):
+    """
+    Decorate a function to poll it until it returns something truthy, for
+    at most timeout seconds and at most interval seconds apart
+
+    Exceptions:
+        CfnTimeoutError: The function didn't succeed in time
+    """
     def decorate(func):
         def wrapper(*args, **kwargs):
-            attempts = 0
-            while True:
-                result = func(*args, **kwargs)
-                if result:
-                    return result
-                if attempts >= timeout / interval:
-                    raise errors.CfnTimeoutError("Timeout in {0}".format(func.__name__))
-                attempts += 1
-                time.sleep(interval)
+            return Poller(timeout, max_interval=interval).wait(func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
         return wrapper
     return decorate
 
 
-def connect_to_aws(module, instance):
+def endpoint_url(service_name):
+    """
+    Get the endpoint override for an AWS service, set in the environment as
+    BOOTSTRAP_CFN_<SERVICE>_ENDPOINT_URL. This lets a local stand-in be used
+    in place of the real service, e.g.
+    BOOTSTRAP_CFN_S3_ENDPOINT_URL=http://localhost:9000
+
+    Args:
+        service_name(string): The boto3 service name, e.g 's3'
+
+    Returns:
+        (string): The endpoint URL, None to use the normal AWS endpoint
+    """
+    return os.environ.get('BOOTSTRAP_CFN_{0}_ENDPOINT_URL'.format(service_name.upper())) or None
+
+
+# Reuse assumed role credentials until this many seconds before they expire
+CREDENTIALS_EXPIRY_MARGIN = 300
+
+# Assumed role credentials keyed on (profile, role)
+_role_credentials = {}
+_role_credentials_lock = threading.Lock()
+
+
+def _role_arn(profile_name):
+    """
+    Get the role connections for a profile assume, None if they use the
+    profile's own credentials
+    """
+    # Check if we have a AWS_ROLE_ARN_ID set, if so we will attempt
+    # to assume a role and connect no matter whether we're on the
+    # cross-account profile or not.
+    if (profile_name == 'cross-account' or
+            os.environ.get('AWS_ROLE_ARN_ID', False)):
+        return os.environ['AWS_ROLE_ARN_ID']
+    return None
+
+
+def _assume_role(profile_name, region_name, role_arn):
+    sts = boto.sts.connect_to_region(
+        region_name=region_name,
+        profile_name=profile_name
+    )
+    role = sts.assume_role(
+        role_arn=role_arn,
+        role_session_name="AssumeRoleSession1"
+    )
+    return {'access_key': role.credentials.access_key,
+            'secret_key': role.credentials.secret_key,
+            'session_token': role.credentials.session_token,
+            'expiration': role.credentials.expiration}
+
+
+def _credentials_expiring(credentials):
+    """
+    Returns:
+        (boolean): True if the credentials expire within
+            CREDENTIALS_EXPIRY_MARGIN seconds
+    """
+    # e.g. 2016-01-01T12:00:00Z or 2016-01-01T12:00:00.000Z
+    expiration = datetime.datetime.strptime(credentials['expiration'][:19], '%Y-%m-%dT%H:%M:%S')
+    margin = datetime.timedelta(seconds=CREDENTIALS_EXPIRY_MARGIN)
+    return expiration - margin <= datetime.datetime.utcnow()
+
+
+def _disk_cached_credentials(cache_dir, key, assume):
+    """
+    Get credentials from the on-disk cache, calling assume() and storing
+    the result if they aren't there or are expiring
+
+    The cache file is only read and written while holding an exclusive lock,
+    so that fab processes running at once assume the role once between
+    them.
+    """
+    if fcntl is None:
+        logging.warning("bootstrap-cfn::assume_role_credentials: No file locking on this "
+                        "platform, not caching credentials on disk")
+        return assume()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    path = os.path.join(cache_dir, hashlib.sha1(repr(key)).hexdigest() + '.json')
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as f:
+                    credentials = json.load(f)
+                if not _credentials_expiring(credentials):
+                    return credentials
+            except (IOError, ValueError, KeyError):
+                pass
+            credentials = assume()
+            # Only readable by us, and swapped in whole
+            tmp_path = '{0}.{1}'.format(path, os.getpid())
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(credentials, f)
+            os.rename(tmp_path, path)
+            return credentials
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def assume_role_credentials(profile_name, region_name, role_arn):
+    """
+    Get temporary credentials for a role, assuming it with STS only when
+    we don't already have credentials for it that are good for another
+    CREDENTIALS_EXPIRY_MARGIN seconds
+
+    Credentials are kept in memory for the life of the process. If
+    BOOTSTRAP_CFN_CREDENTIALS_CACHE is set to a directory they are also
+    kept there, so that later and concurrent fab runs can reuse them.
+
+    Returns:
+        (dict): The access_key, secret_key, session_token and expiration
+    """
+    key = (profile_name, role_arn)
+    with _role_credentials_lock:
+        credentials = _role_credentials.get(key)
+        if credentials is None or _credentials_expiring(credentials):
+            def assume():
+                return _assume_role(profile_name, region_name, role_arn)
+
+            cache_dir = os.environ.get('BOOTSTRAP_CFN_CREDENTIALS_CACHE')
+            if cache_dir:
+                credentials = _disk_cached_credentials(cache_dir, key, assume)
+            else:
+                credentials = assume()
+            _role_credentials[key] = credentials
+        return credentials
+
+
+def _connect_to_aws(module, profile_name, region_name, credentials=None):
     try:
-        # Check if we have a AWS_ROLE_ARN_ID set, if so we will attempt
-        # to assume a role and connect no matter whether we're on the
-        # cross-account profile or not.
-        if (instance.aws_profile_name == 'cross-account' or
-                os.environ.get('AWS_ROLE_ARN_ID', False)):
-            sts = boto.sts.connect_to_region(
-                region_name=instance.aws_region_name,
-                profile_name=instance.aws_profile_name
-            )
-            role = sts.assume_role(
-                role_arn=os.environ['AWS_ROLE_ARN_ID'],
-                role_session_name="AssumeRoleSession1"
-            )
+        role_arn = _role_arn(profile_name)
+        if role_arn:
+            if credentials is None:
+                credentials = assume_role_credentials(profile_name, region_name, role_arn)
             conn = module.connect_to_region(
-                region_name=instance.aws_region_name,
-                aws_access_key_id=role.credentials.access_key,
-                aws_secret_access_key=role.credentials.secret_key,
-                security_token=role.credentials.session_token
+                region_name=region_name,
+                aws_access_key_id=credentials['access_key'],
+                aws_secret_access_key=credentials['secret_key'],
+                security_token=credentials['session_token']
             )
             return conn
         conn = module.connect_to_region(
-            region_name=instance.aws_region_name,
-            profile_name=instance.aws_profile_name
+            region_name=region_name,
+            profile_name=profile_name
         )
         return conn
     except boto.exception.NoAuthHandlerFound:
         raise errors.NoCredentialsError()
     except boto.provider.ProfileNotFoundError as e:
-        raise errors.ProfileNotFoundError(instance.aws_profile_name)
+        raise errors.ProfileNotFoundError(profile_name)
+
+
+# AWS API calls per second allowed to each service, shared by every
+# connection and client in the process. 'default' is used for services
+# without a limit of their own.
+DEFAULT_API_RATE_LIMITS = {'default': 10, 'cloudformation': 5, 'route53': 5}
+
+# How many times to retry a throttled call before giving up
+THROTTLE_MAX_RETRIES = 8
+
+
+def parse_rate_limits(limits):
+    """
+    Parse API rate limits, e.g. 'cloudformation=2;route53=5;default=10'
+
+    Returns:
+        (dict): The calls per second keyed on service name
+    """
+    rates = {}
+    for limit in limits.replace(',', ';').split(';'):
+        if not limit.strip():
+            continue
+        service_name, _, rate = limit.partition('=')
+        try:
+            rates[service_name.strip()] = float(rate)
+        except ValueError:
+            raise errors.BootstrapCfnError(
+                "Invalid API rate limit '{0}', expected service=calls per second".format(limit))
+    return rates
+
+
+class ApiThrottle(object):
+    """
+    Keeps the AWS API calls of every thread under a rate per service, and
+    retries calls that are throttled anyway
+
+    Each service has a RateLimiter shared by all its connections and
+    clients. boto connections retry throttled calls here, backing off
+    exponentially with full jitter. boto3 clients leave the retries to
+    botocore's standard retry mode, and take a token for each attempt.
+    """
+
+    def __init__(self, limits=None, max_retries=THROTTLE_MAX_RETRIES,
+                 base_delay=0.5, max_delay=20):
+        """
+        Args:
+            limits(dict): Calls per second keyed on service name, overriding
+                DEFAULT_API_RATE_LIMITS
+            max_retries(int): Times to retry a throttled call
+            base_delay(float): Most seconds to wait before the first retry
+            max_delay(float): Most seconds to wait before any retry
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rates = dict(DEFAULT_API_RATE_LIMITS)
+        self.max_retries = max_retries
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.configure(limits)
+
+    def configure(self, limits=None, max_retries=None):
+        """
+        Change the rate limits and retries. Limits that aren't given keep
+        their current value.
+        """
+        with self._lock:
+            self.rates.update(limits or {})
+            if max_retries is not None:
+                self.max_retries = int(max_retries)
+            self._limiters = {}
+
+    def limiter(self, service_name):
+        """
+        Returns:
+            (RateLimiter): The limiter shared by every call to the service
+        """
+        with self._lock:
+            if service_name not in self._limiters:
+                rate = self.rates.get(service_name, self.rates['default'])
+                self._limiters[service_name] = RateLimiter(rate, burst=max(1, int(rate)))
+            return self._limiters[service_name]
+
+    def backoff(self, attempt):
+        """
+        Returns:
+            (float): Seconds to wait before retrying attempt (from 0)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def client_config(self):
+        """
+        Returns:
+            (Config): botocore config retrying throttled calls
+        """
+        return Config(retries={'mode': 'standard', 'max_attempts': self.max_retries})
+
+    def wrap_connection(self, conn, service_name):
+        """
+        Rate limit a boto connection and retry its throttled calls
+
+        Returns:
+            The connection
+        """
+        # connect_to_region returns None for regions the service isn't in
+        if conn is None:
+            return conn
+        make_request = conn.make_request
+
+        def throttled_make_request(*args, **kwargs):
+            attempt = 0
+            while True:
+                self.limiter(service_name).acquire()
+                try:
+                    response = make_request(*args, **kwargs)
+                    if getattr(response, 'status', 200) < 300:
+                        return response
+                    error_code = api_metrics.boto_error_code(response)
+                    if error_code not in api_metrics.THROTTLING_ERROR_CODES or attempt >= self.max_retries:
+                        return response
+                except boto.exception.BotoServerError as e:
+                    error_code = e.error_code
+                    if error_code not in api_metrics.THROTTLING_ERROR_CODES or attempt >= self.max_retries:
+                        raise
+                operation = api_metrics.boto_operation(conn, args, kwargs)
+                delay = self.backoff(attempt)
+                logging.getLogger("bootstrap-cfn").info(
+                    "bootstrap-cfn::ApiThrottle: {0} {1} throttled, retrying in {2:.1f}s"
+                    .format(service_name, operation, delay))
+                api_metrics.metrics.record_retry(service_name, operation, error_code)
+                time.sleep(delay)
+                attempt += 1
+
+        conn.make_request = throttled_make_request
+        return conn
+
+    def wrap_client(self, client):
+        """
+        Rate limit every attempt a boto3 client makes, retries included
+
+        Returns:
+            The client
+        """
+        service_name = client.meta.service_model.service_name
+
+        def acquire(**kwargs):
+            # Returning nothing lets the request be sent
+            self.limiter(service_name).acquire()
+
+        client.meta.events.register('before-send', acquire)
+        return client
+
+
+throttle = ApiThrottle(parse_rate_limits(os.environ.get('BOOTSTRAP_CFN_API_RATE_LIMITS', '')))
+
+# boto modules whose names aren't the service name boto3 uses
+BOTO_SERVICE_NAMES = {'autoscale': 'autoscaling'}
+
+
+class ConnectionPool(object):
+    """
+    AWS connections and clients shared by every class for the life of the
+    process, so that a run reuses its TCP/TLS connections and resolves
+    credentials once. Their calls are limited by throttle and recorded in
+    api_metrics.metrics.
+
+    boto connections are keyed on (service, profile, region, role), and
+    those made with assumed role credentials are made again once
+    assume_role_credentials renews them. boto3 clients and resources come
+    from the default session, which the aws fab task sets to the profile,
+    and are keyed on that session, the service, region and endpoint.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.cassette = None
+        self._sessions = {}
+
+    def use_cassette(self, cassette):
+        """
+        Record the calls of every connection and client made from now on
+        to a cassette, or replay them from it
+
+        Args:
+            cassette(Cassette): The cassette, or None to go back to AWS
+        """
+        with self._lock:
+            self.cassette = cassette
+            self._connections.clear()
+
+    def connection(self, module, profile_name, region_name):
+        """
+        Get a boto connection, e.g. connection(boto.ec2, 'dev', 'eu-west-1')
+
+        Args:
+            module(module): The boto service module
+            profile_name(string): The AWS profile
+            region_name(string): The AWS region
+        """
+        # The connect function is part of the key so that replacing it, as
+        # the tests do, doesn't hand out connections made by the old one
+        role_arn = _role_arn(profile_name)
+        key = ('boto', module.__name__, module.connect_to_region,
+               profile_name, region_name, role_arn)
+        replaying = self.cassette is not None and self.cassette.replaying
+        # Connections keep the credentials they were made with, so one made
+        # with assumed role credentials is only good until they're renewed
+        credentials = None
+        if role_arn and not replaying:
+            credentials = assume_role_credentials(profile_name, region_name, role_arn)
+        service_name = module.__name__.split('.')[-1]
+        service_name = BOTO_SERVICE_NAMES.get(service_name, service_name)
+
+        def connect():
+            if replaying:
+                conn = self.cassette.connect(module, region_name)
+            else:
+                conn = _connect_to_aws(module, profile_name, region_name, credentials)
+            conn = throttle.wrap_connection(conn, service_name)
+            if self.cassette is not None:
+                conn = self.cassette.wrap_connection(conn, service_name)
+            return api_metrics.instrument_connection(conn, service_name)
+        return self._get(key, connect, credentials and credentials['access_key'])
+
+    def client(self, service_name, region_name=None, endpoint_url=None):
+        """
+        Get a boto3 client, e.g. client('ec2')
+        """
+        session = self._session()
+        key = ('client', session, service_name, region_name, endpoint_url)
+
+        def connect():
+            client = throttle.wrap_client(session.client(
+                service_name, region_name=region_name, endpoint_url=endpoint_url,
+                config=throttle.client_config()))
+            if self.cassette is not None:
+                self.cassette.wrap_client(client)
+            return api_metrics.instrument_client(client)
+        return self._get(key, connect)
+
+    def resource(self, service_name, region_name=None):
+        """
+        Get a boto3 resource, e.g. resource('ec2')
+        """
+        session = self._session()
+        key = ('resource', session, service_name, region_name)
+
+        def connect():
+            resource = session.resource(service_name, region_name=region_name,
+                                        config=throttle.client_config())
+            throttle.wrap_client(resource.meta.client)
+            if self.cassette is not None:
+                self.cassette.wrap_client(resource.meta.client)
+            api_metrics.instrument_client(resource.meta.client)
+            return resource
+        return self._get(key, connect)
+
+    def _session(self):
+        if self.cassette is not None and self.cassette.replaying:
+            if self.cassette not in self._sessions:
+                self._sessions[self.cassette] = self.cassette.session()
+            return self._sessions[self.cassette]
+        return boto3._get_default_session()
+
+    def clear(self):
+        """Forget every connection, so new ones are made"""
+        with self._lock:
+            self._connections.clear()
+
+    def _get(self, key, connect, version=None):
+        """
+        Get the connection for key, calling connect() to make it if there
+        isn't one or the one there was made for a different version of its
+        credentials
+        """
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is None or entry[0] != version:
+                entry = self._connections[key] = (version, connect())
+            return entry[1]
+
+
+connections = ConnectionPool()
+
+
+def connect_to_aws(module, instance):
+    """
+    Get the shared boto connection to a service for an instance's
+    aws_profile_name and aws_region_name
+    """
+    return connections.connection(module, instance.aws_profile_name, instance.aws_region_name)
+
+
+class PooledConnection(object):
+    """
+    Class attribute that gets an instance's connection to a service from the
+    pool each time it's used, so that instances which live for a long time,
+    e.g. while tailing a stack, pick up the new connection made when assumed
+    role credentials are renewed. Setting the attribute on an instance, e.g.
+    to a mock, overrides it.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return connect_to_aws(self.module, instance)
 
 
 def dict_merge(target, *args):
@@ -79,62 +601,280 @@ def dict_merge(target, *args):
     return target
 
 
-def tail(stack, stack_name):
-    from fabric.colors import green, red, yellow
-    """Show and then tail the event log"""
-
-    def colorize(e):
-        if e.endswith("_IN_PROGRESS"):
-            return yellow(e)
-        elif e.endswith("_FAILED") or e.startswith("ROLLBACK"):
-            return red(e)
-        elif e.endswith("_COMPLETE"):
-            return green(e)
+def merge_layers(layers, names=None):
+    """
+    Merge layers of config, later layers overriding earlier ones, following
+    the same rules as dict_merge. Unlike dict_merge nothing is copied or
+    modified in place: only the dictionaries on the path to an overridden
+    value are new, everything else is shared with the layers.
+
+    Args:
+        layers(list): The layers to merge, lowest priority first
+        names(list): Names for the layers, used to report where values
+            came from. Defaults to the layer indexes.
+
+    Returns:
+        (tuple): The merged value, and a dictionary mapping key paths
+            (tuples) to the name of the layer that set that value. Use
+            layer_source() to look up the layer for any path.
+    """
+    if names is None:
+        names = range(len(layers))
+    sources = {(): names[0]}
+    merged = layers[0]
+    for layer, name in zip(layers[1:], names[1:]):
+        merged = _merge_layer(merged, layer, name, (), sources)
+    return merged, sources
+
+
+def _merge_layer(base, layer, name, path, sources):
+    if not isinstance(layer, dict):
+        _set_source(sources, path, name)
+        return layer
+    if not layer:
+        return base
+    if not isinstance(base, dict) or not base:
+        _set_source(sources, path, name)
+        return layer
+    merged = dict(base)
+    for k, v in layer.iteritems():
+        if k in merged and isinstance(merged[k], dict):
+            # As with dict_merge, a non-dict value never replaces a dict
+            if isinstance(v, dict):
+                merged[k] = _merge_layer(merged[k], v, name, path + (k,), sources)
         else:
-            return e
+            merged[k] = v
+            _set_source(sources, path + (k,), name)
+    return merged
+
+
+def _set_source(sources, path, name):
+    # Anything recorded below this path came from a layer we've now replaced
+    for recorded_path in [p for p in sources if len(p) > len(path) and p[:len(path)] == path]:
+        del sources[recorded_path]
+    sources[path] = name
+
+
+def layer_source(sources, path):
+    """
+    Get the name of the layer a merged value came from
+
+    Args:
+        sources(dict): The sources returned by merge_layers
+        path(tuple): The keys leading to the value
+
+    Returns:
+        The name of the layer that set the value
+    """
+    path = tuple(path)
+    for i in xrange(len(path), -1, -1):
+        if path[:i] in sources:
+            return sources[path[:i]]
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting how often something can be done, shared between
+    threads
+
+    Tokens are added at rate per second, up to burst of them saved up, and
+    each acquire() takes one, waiting for it if there are none.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate(float): Tokens added per second
+            burst(int): Most tokens that can be saved up
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = _monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+
+        Returns:
+            (float): How long we waited in seconds
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = _monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class EventTailer(object):
+    """
+    Fetch a stack's events incrementally
+
+    Keeps the id and timestamp of the newest event it has returned as a
+    watermark. Cloudformation returns events newest first, so each fetch
+    only pages back until it reaches the watermark, which is normally
+    within the first page.
+    """
+
+    def __init__(self, stack, stack_name, page_interval=1, rate_limiter=None):
+        """
+        Args:
+            stack(Cloudformation): The Cloudformation connection object
+            stack_name(string): The stack name or id
+            page_interval(int): Seconds to wait between fetching pages, when
+                more than one page of new events is needed
+            rate_limiter(RateLimiter): Optional limiter to take a token from
+                before each call, when it is shared with other callers
+        """
+        self.stack = stack
+        self.stack_name = stack_name
+        self.page_interval = page_interval
+        self.rate_limiter = rate_limiter
+        self.last_event_id = None
+        self.last_timestamp = None
+
+    def _describe_stack_events(self, next_token=None):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return self.stack.conn_cfn.describe_stack_events(self.stack_name, next_token)
+
+    def new_events(self):
+        """
+        Get the events since the last call, all the stack's events on the
+        first call
+
+        Returns:
+            (list): The new events, oldest first
+        """
+        new = []
+        next_token = None
+        while True:
+            try:
+                events = self._describe_stack_events(next_token)
+            except boto.exception.BotoServerError:
+                # The stack has gone, or doesn't exist yet
+                break
+            reached_watermark = False
+            for e in events:
+                if self._seen(e):
+                    reached_watermark = True
+                    break
+                new.append(e)
+            next_token = getattr(events, 'next_token', None)
+            if reached_watermark or next_token is None:
+                break
+            time.sleep(self.page_interval)
+        if new:
+            self.last_event_id = new[0].event_id
+            self.last_timestamp = new[0].timestamp
+        new.reverse()
+        return new
+
+    def skip_history(self):
+        """
+        Move the watermark to the newest event, so that only events from
+        now on are returned
+        """
+        try:
+            events = self._describe_stack_events()
+        except boto.exception.BotoServerError:
+            return
+        if events:
+            self.last_event_id = events[0].event_id
+            self.last_timestamp = events[0].timestamp
+
+    def _seen(self, e):
+        if self.last_event_id is None:
+            return False
+        if e.event_id == self.last_event_id:
+            return True
+        # In case the watermark event itself can't be found
+        return e.timestamp < self.last_timestamp
+
+
+def colorize_status(status):
+    """Colour a stack or resource status by whether it is in progress,
+    failed or complete"""
+    from fabric.colors import green, red, yellow
+    if status.endswith("_IN_PROGRESS"):
+        return yellow(status)
+    elif status.endswith("_FAILED") or status.startswith("ROLLBACK"):
+        return red(status)
+    elif status.endswith("_COMPLETE"):
+        return green(status)
+    else:
+        return status
+
+
+def format_event(e, prefix=''):
+    """
+    Format a stack event for the terminal
+
+    Args:
+        e(StackEvent): The event
+        prefix(string): Put in front of each line, e.g. the stack name
+
+    Returns:
+        (string): The event status, resource type and id, and the status
+            reason on the next line if there is one
+    """
+    lines = ["%s%s %s %s" % (prefix, colorize_status(e.resource_status).ljust(30),
+                             e.resource_type.ljust(50), e.event_id)]
+    if e.resource_status_reason:
+        lines.append("%s%s" % (prefix, e.resource_status_reason))
+    return "\n".join(lines)
+
+
+def tail(stack, stack_name, done=None, history=True):
+    """
+    Show and then tail the event log
+
+    Stops when the stack is done or missing, or when done() returns
+    True if it is given, e.g. StackWaiter.poll. The events logged up to
+    then are still shown, so the last ones aren't lost.
+
+    Args:
+        history(bool): False to skip the events from before we started
+            tailing, e.g. when updating an existing stack
+    """
 
     def tail_print(e):
-        print("%s %s %s" % (colorize(e.resource_status).ljust(30), e.resource_type.ljust(50), e.event_id))
-        if e.resource_status_reason:
-            print(e.resource_status_reason)
-
-    # First dump the full list of events in chronological order and keep
-    # track of the events we've seen already
-    seen = set()
-    initial_events = get_events(stack, stack_name)
-    for e in initial_events:
-        tail_print(e)
-        seen.add(e.event_id)
-
-    # Now keep looping through and dump the new events
+        print(format_event(e))
+
+    # First dump the full list of events in chronological order, after
+    # which we only fetch events newer than the last one we've shown
+    tailer = EventTailer(stack, stack_name)
+    if history:
+        for e in tailer.new_events():
+            tail_print(e)
+    else:
+        tailer.skip_history()
+
+    # Now keep looping through and dump the new events, fetching them
+    # once more after the stack is done for the events that finished it
     while 1:
-        if stack.stack_missing(stack_name):
-            break
-        elif stack.stack_done(stack_name):
+        if done is not None:
+            finished = done()
+        else:
+            finished = stack.stack_finished(stack_name)
+        for e in tailer.new_events():
+            tail_print(e)
+        if finished:
             break
-        events = get_events(stack, stack_name)
-        for e in events:
-            if e.event_id not in seen:
-                tail_print(e)
-            seen.add(e.event_id)
         time.sleep(2)
 
 
 def get_events(stack, stack_name):
-    """Get the events in batches and return in chronological order"""
-    next = None
-    event_list = []
-    while 1 and not stack.stack_missing(stack_name):
-        try:
-            events = stack.conn_cfn.describe_stack_events(stack_name, next)
-        except:
-            break
-        event_list.append(events)
-        if events.next_token is None:
-            break
-        next = events.next_token
-        time.sleep(1)
-    return reversed(sum(event_list, []))
+    """Get all the stack's events, in chronological order"""
+    return EventTailer(stack, stack_name).new_events()
 
 
 def sleep_countdown(sleep_time):
@@ -1,16 +1,12 @@
 import logging
 
-import time
-
-import boto3
-
 from botocore.exceptions import ClientError
 
 import netaddr
 
-from bootstrap_cfn import cloudformation
+from bootstrap_cfn import cloudformation, utils
 
-from bootstrap_cfn.errors import CloudResourceNotFoundError
+from bootstrap_cfn.errors import CfnTimeoutError, CloudResourceNotFoundError
 
 
 class VPC:
@@ -100,7 +96,7 @@ class VPC:
         if len(peering_stack_configs) == 0:
             raise Exception
         peering_stack_config = peering_stack_configs[0]
-        ec2_resource = boto3.resource('ec2')
+        ec2_resource = utils.connections.resource('ec2')
         #  PeerOwnerId='string' can be set for peering different accoutns
         vpc_peering_connection = ec2_resource.create_vpc_peering_connection(
             VpcId=self.vpc_id,
@@ -110,7 +106,7 @@ class VPC:
                          % (vpc_peering_connection.id))
 
         # Have the peer target stack accept the peering
-        ec2_client = boto3.client('ec2')
+        ec2_client = utils.connections.client('ec2')
         ec2_client.accept_vpc_peering_connection(
             VpcPeeringConnectionId=vpc_peering_connection.id
         )
@@ -141,14 +137,14 @@ class VPC:
             status_codes(list): List of status codes to wait on
             timeout(int): The timeout period in seconds to wait before giving up
         """
-        wait_end = time.time() + timeout
-        while wait_end > time.time():
+        def in_state():
             peering_conn.reload()
-            if peering_conn.status['Code'] in status_codes:
-                return True
+            return peering_conn.status['Code'] in status_codes
 
-            time.sleep(1)
-        return False
+        try:
+            return utils.Poller(timeout, max_interval=5).wait(in_state)
+        except CfnTimeoutError:
+            return False
 
     def create_peering_routes(self,
                               peering_conn,
@@ -247,8 +243,8 @@ class VPC:
         Returns:
             (list): The VPCPeeringConnections belonging to the specified stack
         """
-        ec2_client = boto3.client('ec2')
-        ec2_resource = boto3.resource('ec2')
+        ec2_client = utils.connections.client('ec2')
+        ec2_resource = utils.connections.resource('ec2')
         peering_connections = []
         peering_connection_filter = [{'Name': 'requester-vpc-info.vpc-id', 'Values': [self.vpc_id]}]
         if status_codes:
@@ -297,17 +293,17 @@ class VPC:
             min_results=1,
             max_results=1):
         """
-        Get a set of stack names that match a search term.
+        Get a set of stacks whose names start with a search term.
 
         Args:
-            stack_name(string): The name of the stack
+            stack_name(string): The start of the stack name
             min_results(int): The minimum number of results to expect
             max_results(int): The maximum number of results to expect
 
         Returns:
-            (list): The set of stack ids found
+            (list): The summaries of the stacks found
         """
-        stack_ids = cloudformation.get_stack_ids_by_name(stack_search_name)
+        stack_ids = cloudformation.get_stacks_by_prefix(stack_search_name)
 
         if len(stack_ids) > max_results:
             self.logger.error("VPC::get_stack_name_by_match: "
@@ -339,7 +335,7 @@ class VPC:
                 it wasnt found
         """
         route_table_ids = []
-        ec2_resource = boto3.resource('ec2')
+        ec2_resource = utils.connections.resource('ec2')
         vpc = ec2_resource.Vpc(vpc_id)
         for route_table in list(vpc.route_tables.all()):
             if not logical_id_filter and not min_subnet_associations and not is_main:
@@ -374,7 +370,7 @@ class VPC:
         Returns:
             (list): The cidr range of the VPC
         """
-        ec2_resource = boto3.resource('ec2')
+        ec2_resource = utils.connections.resource('ec2')
         vpc = ec2_resource.Vpc(vpc_id)
         return [vpc.cidr_block]
 
@@ -394,7 +390,7 @@ class VPC:
             route_table_ids(list): The list of route table ids
                 to setup the route on. If None, setup on all route tables.
         """
-        ec2_client = boto3.client('ec2')
+        ec2_client = utils.connections.client('ec2')
         for route_table_id in route_table_ids:
             try:
                 self.logger.info("VPC::create_route_vpc_to_vpc_peer: Creating route in '%s'"
@@ -429,7 +425,7 @@ class VPC:
             cidr_blocks(list): The list of cidrs to remove from the
                 route table
         """
-        ec2_client = boto3.client('ec2')
+        ec2_client = utils.connections.client('ec2')
         for cidr_block in cidr_blocks:
             try:
                 ec2_client.delete_route(
@@ -561,7 +557,7 @@ def get_available_addresses():
     Returns:
         (list): List of available IPNetworks in CIDR notation
     """
-    ec2_client = boto3.client('ec2')
+    ec2_client = utils.connections.client('ec2')
     vpcs = ec2_client.describe_vpcs().get('Vpcs', [])
     vpc_cidr_mappings = {}
     for vpc in vpcs:
@@ -21,10 +21,11 @@ setup(
         'Fabric>=1.10.1',
         'PyYAML>=3.11',
         'boto>=2.36.0',
-        'boto3>=1.2.2',
+        'boto3>=1.17.0',
+        'botocore>=1.20.0',
         'dnspython>=1.12.0',
         'netaddr>=0.7.18',
-        'troposphere>=1.0.0',
+        'troposphere>=1.6.0',
     ],
     setup_requires=[
         'mock>=1.0.1',
@@ -0,0 +1,64 @@
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Clients keep their connections open, so serve each on its own thread
+    daemon_threads = True
+
+
+class LocalS3(object):
+    """
+    A minimal in-process stand-in for s3, just enough for path style
+    PutObject and GetObject. Point BOOTSTRAP_CFN_S3_ENDPOINT_URL at url.
+    """
+
+    def __init__(self):
+        # Object bodies keyed on /bucket/key
+        self.objects = {}
+        objects = self.objects
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_PUT(self):
+                if self.headers.get('Expect', '').lower() == '100-continue':
+                    self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+                length = int(self.headers.get('Content-Length', 0))
+                objects[urlparse(self.path).path] = self.rfile.read(length)
+                self._respond(200, '', ETag='"etag"')
+
+            def do_GET(self):
+                body = objects.get(urlparse(self.path).path)
+                if body is None:
+                    self._respond(404, '<Error><Code>NoSuchKey</Code></Error>')
+                else:
+                    self._respond(200, body)
+
+            def _respond(self, status, body, **headers):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,16 +1,24 @@
+import hashlib
 import os
 import tempfile
 import unittest
+import urllib2
 
 import boto.cloudformation
 import boto.ec2.autoscale
 
+import boto3
+
+from botocore.stub import Stubber
+
 import mock
 
 import yaml
 
 from bootstrap_cfn import cloudformation, errors, iam
 
+from .local_s3 import LocalS3
+
 
 class CfnTestCase(unittest.TestCase):
 
@@ -99,6 +107,212 @@ class CfnTestCase(unittest.TestCase):
             tags=test_tags)
         self.assertEqual(x, self.stack_name)
 
+    def test_cf_create_large_template_without_bucket(self):
+        cf_mock = mock.Mock()
+        boto.cloudformation.connect_to_region = cf_mock
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        template_body = '{"Description": "%s"}' % ('x' * cloudformation.MAX_TEMPLATE_BODY_SIZE)
+        with self.assertRaises(errors.CfnTemplateTooLargeError):
+            cf.create(self.stack_name, template_body, {})
+        self.assertFalse(cf_mock.return_value.create_stack.called)
+
+    def test_cf_create_large_template_from_s3(self):
+        local_s3 = LocalS3()
+        local_s3.start()
+        self.addCleanup(local_s3.stop)
+        cf_mock = mock.Mock()
+        boto.cloudformation.connect_to_region = cf_mock
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        template_body = '{"Description": "%s"}' % ('x' * cloudformation.MAX_TEMPLATE_BODY_SIZE)
+
+        environ = {'BOOTSTRAP_CFN_S3_ENDPOINT_URL': local_s3.url,
+                   'AWS_ACCESS_KEY_ID': 'testing',
+                   'AWS_SECRET_ACCESS_KEY': 'testing'}
+        with mock.patch.dict(os.environ, environ), \
+                mock.patch.object(boto3, 'DEFAULT_SESSION', None):
+            cf.create(self.stack_name, template_body, {}, template_bucket='templates')
+
+        key = '/templates/{0}/{1}.json'.format(self.stack_name, hashlib.sha1(template_body).hexdigest())
+        self.assertEqual(local_s3.objects[key], template_body)
+        create_kwargs = cf_mock.return_value.create_stack.call_args[1]
+        self.assertNotIn('template_body', create_kwargs)
+        # The URL is readable without credentials, as cloudformation needs
+        template_url = create_kwargs['template_url']
+        self.assertTrue(template_url.startswith(local_s3.url + key + '?'))
+        self.assertEqual(urllib2.urlopen(template_url).read(), template_body)
+
+    def _stubbed_client(self, cf):
+        client = boto3.client('cloudformation',
+                              region_name='eu-west-1',
+                              aws_access_key_id='testing',
+                              aws_secret_access_key='testing')
+        cf._cfn_client = client
+        stubber = Stubber(client)
+        stubber.activate()
+        self.addCleanup(stubber.deactivate)
+        return stubber
+
+    def test_diff_templates(self):
+        deployed = {'Resources': {'A': {'Type': 'x'}, 'B': {'Type': 'x'}, 'C': {'Type': 'x'}},
+                    'Outputs': {'o': {'Value': 1}}}
+        rendered = {'Resources': {'B': {'Type': 'x'}, 'C': {'Type': 'y'}, 'D': {'Type': 'x'}},
+                    'Outputs': {'o': {'Value': 2}}}
+        self.assertEqual(cloudformation.Cloudformation.diff_templates(deployed, rendered),
+                         {'added': ['D'], 'removed': ['A'], 'modified': ['C'], 'sections': ['Outputs']})
+        self.assertFalse(any(cloudformation.Cloudformation.diff_templates(deployed, deployed).values()))
+
+    def test_cf_update(self):
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        change_set_id = 'arn:aws:cloudformation:eu-west-1:123:changeSet/bootstrap-cfn-1/abc'
+        change = {'Action': 'Modify',
+                  'LogicalResourceId': 'BaseHostLaunchConfig',
+                  'ResourceType': 'AWS::AutoScaling::LaunchConfiguration',
+                  'Replacement': 'True'}
+        stubber.add_response('create_change_set', {'Id': change_set_id},
+                             {'StackName': self.stack_name,
+                              'ChangeSetName': mock.ANY,
+                              'Capabilities': ['CAPABILITY_IAM'],
+                              'Tags': [{'Key': 'Env', 'Value': 'dev'}],
+                              'TemplateBody': '{}'})
+        stubber.add_response('describe_change_set',
+                             {'Status': 'CREATE_PENDING', 'Changes': []},
+                             {'ChangeSetName': change_set_id})
+        stubber.add_response('describe_change_set',
+                             {'Status': 'CREATE_COMPLETE',
+                              'ExecutionStatus': 'AVAILABLE',
+                              'Changes': [{'Type': 'Resource', 'ResourceChange': change}]},
+                             {'ChangeSetName': change_set_id})
+        stubber.add_response('execute_change_set', {}, {'ChangeSetName': change_set_id})
+
+        with mock.patch('time.sleep'):
+            change_set_id, changes = cf.create_change_set(self.stack_name, '{}', {'Env': 'dev'})
+        self.assertEqual(changes, [change])
+        cf.execute_change_set(change_set_id)
+        stubber.assert_no_pending_responses()
+
+    def test_cf_update_without_changes(self):
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        change_set_id = 'arn:aws:cloudformation:eu-west-1:123:changeSet/bootstrap-cfn-1/abc'
+        stubber.add_response('create_change_set', {'Id': change_set_id})
+        stubber.add_response('describe_change_set',
+                             {'Status': 'FAILED',
+                              'StatusReason': "The submitted information didn't contain changes. "
+                                              "Submit different information to create a change set."})
+        stubber.add_response('delete_change_set', {}, {'ChangeSetName': change_set_id})
+
+        self.assertIsNone(cf.update(self.stack_name, '{}', {}))
+        stubber.assert_no_pending_responses()
+
+    def test_cf_update_change_set_failed(self):
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        stubber.add_response('create_change_set', {'Id': 'arn:changeSet/1'})
+        stubber.add_response('describe_change_set',
+                             {'Status': 'FAILED', 'StatusReason': 'Template format error'})
+        with self.assertRaises(errors.CfnChangeSetError):
+            cf.update(self.stack_name, '{}', {})
+
+    def test_get_template(self):
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        stubber.add_response('get_template', {'TemplateBody': '{"Resources": {}}'},
+                             {'StackName': self.stack_name})
+        self.assertEqual(cf.get_template(self.stack_name), {'Resources': {}})
+
+    def _resource_summary(self, logical_id, resource_type):
+        return {'LogicalResourceId': logical_id,
+                'PhysicalResourceId': logical_id.lower(),
+                'ResourceType': resource_type,
+                'ResourceStatus': 'CREATE_COMPLETE',
+                'LastUpdatedTimestamp': '2016-01-01T00:00:00Z'}
+
+    def test_get_resource_type_cached(self):
+        cloudformation.resource_cache.invalidate()
+        self.addCleanup(cloudformation.resource_cache.invalidate)
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        # Two pages, fetched once for both lookups
+        stubber.add_response('list_stack_resources',
+                             {'StackResourceSummaries': [self._resource_summary('ELB1', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+                                                         self._resource_summary('VPC', 'AWS::EC2::VPC')],
+                              'NextToken': 'page2'},
+                             {'StackName': self.stack_name})
+        stubber.add_response('list_stack_resources',
+                             {'StackResourceSummaries': [self._resource_summary('ELB2', 'AWS::ElasticLoadBalancing::LoadBalancer')]},
+                             {'StackName': self.stack_name, 'NextToken': 'page2'})
+
+        elbs = cf.get_stack_load_balancers(self.stack_name)
+        self.assertEqual([elb['PhysicalResourceId'] for elb in elbs], ['elb1', 'elb2'])
+        # boto style attribute names work too
+        self.assertEqual([elb.logical_resource_id for elb in elbs], ['ELB1', 'ELB2'])
+        vpcs = cf.get_resource_type(self.stack_name, 'AWS::EC2::VPC')
+        self.assertEqual([vpc.physical_resource_id for vpc in vpcs], ['vpc'])
+        stubber.assert_no_pending_responses()
+
+        # Changing the stack drops the cached resources
+        stubber.add_response('list_stack_resources', {'StackResourceSummaries': []},
+                             {'StackName': self.stack_name})
+        cf.conn_cfn = mock.Mock()
+        cf.delete(self.stack_name)
+        self.assertEqual(cf.get_stack_load_balancers(self.stack_name), [])
+        stubber.assert_no_pending_responses()
+
+    def test_resource_cache(self):
+        fetch = mock.Mock(side_effect=lambda name: [name])
+        cache = cloudformation.StackResourceCache(ttl=60)
+        stack_id = 'arn:aws:cloudformation:eu-west-1:123456789012:stack/my-stack/abc'
+        with mock.patch('bootstrap_cfn.utils._monotonic', return_value=0):
+            self.assertEqual(cache.get('my-stack', fetch), ['my-stack'])
+            self.assertEqual(cache.get(stack_id, fetch), [stack_id])
+            self.assertEqual(cache.get('my-stack', fetch), ['my-stack'])
+            self.assertEqual(fetch.call_count, 2)
+            # Invalidating by id drops the lookups by name too
+            cache.invalidate(stack_id)
+            cache.get('my-stack', fetch)
+            cache.get(stack_id, fetch)
+            self.assertEqual(fetch.call_count, 4)
+        with mock.patch('bootstrap_cfn.utils._monotonic', return_value=61):
+            cache.get('my-stack', fetch)
+            self.assertEqual(fetch.call_count, 5)
+
+    def _stack_summary(self, name):
+        return {'StackId': 'arn:aws:cloudformation:eu-west-1:123456789012:stack/{0}/abc'.format(name),
+                'StackName': name,
+                'CreationTime': '2016-01-01T00:00:00Z',
+                'StackStatus': 'CREATE_COMPLETE'}
+
+    def test_stack_index(self):
+        cf = cloudformation.Cloudformation(self.env.aws_profile)
+        stubber = self._stubbed_client(cf)
+        index = cloudformation.StackIndex(cf.cfn_client)
+        stubber.add_response('list_stacks',
+                             {'StackSummaries': [self._stack_summary('peer-dev-1234'),
+                                                 self._stack_summary('app-dev-5678')],
+                              'NextToken': 'page2'},
+                             {'StackStatusFilter': cloudformation.LIVE_STACK_STATUSES})
+        stubber.add_response('list_stacks',
+                             {'StackSummaries': [self._stack_summary('peer-dev-abcd'),
+                                                 self._stack_summary('peer-staging-1234')]},
+                             {'StackStatusFilter': cloudformation.LIVE_STACK_STATUSES,
+                              'NextToken': 'page2'})
+
+        self.assertEqual([stack['StackName'] for stack in index.with_prefix('peer-dev')],
+                         ['peer-dev-1234', 'peer-dev-abcd'])
+        self.assertEqual(index.with_prefix('zzz'), [])
+        self.assertEqual([stack['StackName'] for stack in index.search('dev-1234')],
+                         ['peer-dev-1234'])
+        self.assertEqual(len(index.stacks), 4)
+        # Listed once for every lookup
+        stubber.assert_no_pending_responses()
+
+        index.invalidate()
+        stubber.add_response('list_stacks', {'StackSummaries': []},
+                             {'StackStatusFilter': cloudformation.LIVE_STACK_STATUSES})
+        self.assertEqual(index.with_prefix('peer-dev'), [])
+        stubber.assert_no_pending_responses()
+
     def test_cf_delete(self):
         cf_mock = mock.Mock()
         cf_connect_result = mock.Mock(name='cf_connect')
@@ -163,77 +377,127 @@ class CfnTestCase(unittest.TestCase):
         x = cf.stack_missing('my-stack-name')
         self.assertFalse(x)
 
-    def test_stack_wait_for_stack_not_done(self):
-        stack_evt_mock = mock.Mock()
-        rt = mock.PropertyMock(return_value='AWS::CloudFormation::Stack')
-        rs = mock.PropertyMock(return_value='CREATE_COMPLETE_LOL')
-        type(stack_evt_mock).resource_type = rt
-        type(stack_evt_mock).resource_status = rs
-        mock_config = {'describe_stack_events.return_value': [stack_evt_mock]}
-
+    def _status_mock(self, **mock_config):
         cf_mock = mock.Mock()
         cf_connect_result = mock.Mock(name='cf_connect')
         cf_mock.return_value = cf_connect_result
         cf_connect_result.configure_mock(**mock_config)
-
         boto.cloudformation.connect_to_region = cf_mock
+        return cloudformation.Cloudformation(self.env.aws_profile)
+
+    def test_get_stack_status(self):
+        stack_mock = mock.Mock(stack_name='my-stack-name',
+                               stack_status='UPDATE_IN_PROGRESS')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertEqual(cf.get_stack_status('my-stack-name'), 'UPDATE_IN_PROGRESS')
+        # Only the one stack is described
+        cf.conn_cfn.describe_stacks.assert_called_once_with('my-stack-name')
+        self.assertFalse(cf.stack_missing('my-stack-name'))
+        self.assertFalse(cf.stack_finished('my-stack-name'))
+
+    def test_get_stack_status_does_not_exist(self):
+        error = boto.exception.BotoServerError(
+            400, 'Bad Request',
+            '<ErrorResponse><Error><Code>ValidationError</Code>'
+            '<Message>Stack with id my-stack-name does not exist</Message>'
+            '</Error></ErrorResponse>')
+        cf = self._status_mock(**{'describe_stacks.side_effect': error})
+        self.assertIsNone(cf.get_stack_status('my-stack-name'))
+        self.assertTrue(cf.stack_missing('my-stack-name'))
+        self.assertTrue(cf.stack_finished('my-stack-name'))
+
+    def test_get_stack_status_error(self):
+        error = boto.exception.BotoServerError(400, 'Bad Request', 'Rate exceeded')
+        cf = self._status_mock(**{'describe_stacks.side_effect': error})
+        with self.assertRaises(boto.exception.BotoServerError):
+            cf.get_stack_status('my-stack-name')
+
+    def test_get_stack_status_deleted(self):
+        stack_id = 'arn:aws:cloudformation:eu-west-1:123456789012:stack/my-stack-name/abc'
+        stack_mock = mock.Mock(stack_name='my-stack-name',
+                               stack_id=stack_id,
+                               stack_status='DELETE_COMPLETE')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertIsNone(cf.get_stack_status(stack_id))
+        self.assertTrue(cf.stack_missing(stack_id))
+
+    def test_stack_finished(self):
+        stack_mock = mock.Mock(stack_name='my-stack-name',
+                               stack_status='ROLLBACK_COMPLETE')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertTrue(cf.stack_finished('my-stack-name'))
+        self.assertEqual(cf.conn_cfn.describe_stacks.call_count, 1)
 
+    def test_stack_wait_for_stack_not_done(self):
+        stack_mock = mock.Mock(stack_name=self.stack_name, stack_status='CREATE_IN_PROGRESS')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
         with self.assertRaises(errors.CfnTimeoutError):
-            print cloudformation.Cloudformation(
-                self.env.aws_profile).wait_for_stack_done(self.stack_name, 1, 1)
+            print cf.wait_for_stack_done(self.stack_name, 1, 1)
 
     def test_wait_for_stack_done(self):
-        stack_evt_mock = mock.Mock()
-        rt = mock.PropertyMock(return_value='AWS::CloudFormation::Stack')
-        rs = mock.PropertyMock(return_value='CREATE_COMPLETE')
-        type(stack_evt_mock).resource_type = rt
-        type(stack_evt_mock).resource_status = rs
-        mock_config = {'describe_stack_events.return_value': [stack_evt_mock]}
-
-        cf_mock = mock.Mock()
-        cf_connect_result = mock.Mock(name='cf_connect')
-        cf_mock.return_value = cf_connect_result
-        cf_connect_result.configure_mock(**mock_config)
-
-        boto.cloudformation.connect_to_region = cf_mock
-
-        self.assertTrue(cloudformation.Cloudformation(
-            self.env.aws_profile).wait_for_stack_done(self.stack_name, 1, 1))
+        stack_mock = mock.Mock(stack_name=self.stack_name, stack_status='CREATE_COMPLETE')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertEqual(cf.wait_for_stack_done(self.stack_name, 1, 1), 'CREATE_COMPLETE')
 
     def test_stack_done(self):
-        stack_evt_mock = mock.Mock()
-        rt = mock.PropertyMock(return_value='AWS::CloudFormation::Stack')
-        rs = mock.PropertyMock(return_value='CREATE_COMPLETE')
-        type(stack_evt_mock).resource_type = rt
-        type(stack_evt_mock).resource_status = rs
-        mock_config = {'describe_stack_events.return_value': [stack_evt_mock]}
-
-        cf_mock = mock.Mock()
-        cf_connect_result = mock.Mock(name='cf_connect')
-        cf_mock.return_value = cf_connect_result
-        cf_connect_result.configure_mock(**mock_config)
-
-        boto.cloudformation.connect_to_region = cf_mock
-
-        self.assertTrue(cloudformation.Cloudformation(
-            self.env.aws_profile).stack_done(self.stack_name))
+        stack_mock = mock.Mock(stack_name=self.stack_name, stack_status='CREATE_COMPLETE')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertTrue(cf.stack_done(self.stack_name))
+        self.assertFalse(cf.conn_cfn.describe_stack_events.called)
 
     def test_stack_not_done(self):
-        stack_evt_mock = mock.Mock()
-        rt = mock.PropertyMock(return_value='AWS::CloudFormation::Stack')
-        rs = mock.PropertyMock(return_value='CREATE_COMPLETE_FAKE')
-        type(stack_evt_mock).resource_type = rt
-        type(stack_evt_mock).resource_status = rs
-
-        cf_mock = mock.Mock()
-        cf_connect_result = mock.Mock(name='cf_connect')
-        cf_mock.return_value = cf_connect_result
-        mock_config = {'describe_stack_events.return_value': [stack_evt_mock]}
-        cf_connect_result.configure_mock(**mock_config)
-        boto.cloudformation.connect_to_region = cf_mock
-
-        self.assertFalse(cloudformation.Cloudformation(
-            self.env.aws_profile).stack_done(self.stack_name))
+        stack_mock = mock.Mock(stack_name=self.stack_name, stack_status='UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+        cf = self._status_mock(**{'describe_stacks.return_value': [stack_mock]})
+        self.assertFalse(cf.stack_done(self.stack_name))
+
+    def test_stack_settled(self):
+        for status in ['CREATE_COMPLETE', 'CREATE_FAILED', 'ROLLBACK_COMPLETE',
+                       'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED',
+                       'DELETE_COMPLETE', 'DELETE_FAILED']:
+            self.assertTrue(cloudformation.stack_settled(status), status)
+        for status in ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS',
+                       'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS',
+                       'DELETE_IN_PROGRESS', 'REVIEW_IN_PROGRESS']:
+            self.assertFalse(cloudformation.stack_settled(status), status)
+
+    def _waiter(self, statuses, from_status=None):
+        stacks = [[mock.Mock(stack_name=self.stack_name, stack_status=status)] for status in statuses]
+        cf = self._status_mock(**{'describe_stacks.side_effect': stacks})
+        return cloudformation.StackWaiter(cf, self.stack_name, from_status)
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_stack_waiter_update(self, mock_sleep):
+        waiter = self._waiter(['UPDATE_COMPLETE', 'UPDATE_IN_PROGRESS',
+                               'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE'],
+                              from_status='UPDATE_COMPLETE')
+        # The old status until the update starts
+        self.assertFalse(waiter.poll())
+        self.assertEqual(waiter.state, waiter.WAITING)
+        self.assertFalse(waiter.poll())
+        self.assertEqual(waiter.state, waiter.IN_PROGRESS)
+        self.assertEqual(waiter.wait(60, 1), 'UPDATE_COMPLETE')
+        self.assertTrue(waiter.succeeded)
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_stack_waiter_update_rollback(self, mock_sleep):
+        waiter = self._waiter(['UPDATE_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS',
+                               'UPDATE_ROLLBACK_COMPLETE'], from_status='CREATE_COMPLETE')
+        self.assertEqual(waiter.wait(60, 1), 'UPDATE_ROLLBACK_COMPLETE')
+        self.assertFalse(waiter.succeeded)
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_stack_waiter_delete(self, mock_sleep):
+        error = boto.exception.BotoServerError(
+            400, 'Bad Request',
+            '<ErrorResponse><Error><Code>ValidationError</Code>'
+            '<Message>Stack with id my-stack-name does not exist</Message>'
+            '</Error></ErrorResponse>')
+        stack_mock = mock.Mock(stack_name=self.stack_name, stack_status='DELETE_IN_PROGRESS')
+        cf = self._status_mock(**{'describe_stacks.side_effect': [[stack_mock], error]})
+        waiter = cloudformation.StackWaiter(cf, self.stack_name)
+        self.assertEqual(waiter.wait(60, 1), 'DELETE_COMPLETE')
+        self.assertTrue(waiter.succeeded)
+        self.assertEqual(cf.conn_cfn.describe_stacks.call_count, 2)
 
     def test_ssl_upload(self):
         iam_mock = mock.Mock()
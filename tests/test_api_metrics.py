@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import boto.cloudformation.connection
+import boto.route53.connection
+
+import boto3
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from mock import Mock, patch
+
+from testfixtures import compare
+
+from bootstrap_cfn import api_metrics
+
+
+class TestApiMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = api_metrics.metrics
+        self.metrics.reset()
+        # Each call takes 0.5 seconds
+        self.clock = patch('bootstrap_cfn.api_metrics._monotonic',
+                           side_effect=[i * 0.5 for i in range(100)])
+        self.clock.start()
+
+    def tearDown(self):
+        self.clock.stop()
+        self.metrics.reset()
+
+    def test_summary(self):
+        self.metrics.record('cloudformation', 'DescribeStacks', 0.25)
+        self.metrics.record('cloudformation', 'DescribeStacks', 0.5, retries=2, error_code='Throttling')
+        self.metrics.record('ec2', 'DescribeVpcs', 1.0, error_code='InvalidVpcID.NotFound')
+        compare(self.metrics.summary(), [
+            {'service': 'ec2', 'operation': 'DescribeVpcs', 'calls': 1, 'errors': 1,
+             'throttles': 0, 'retries': 0, 'seconds': 1.0, 'max_seconds': 1.0},
+            {'service': 'cloudformation', 'operation': 'DescribeStacks', 'calls': 2, 'errors': 1,
+             'throttles': 1, 'retries': 2, 'seconds': 0.75, 'max_seconds': 0.5},
+        ])
+        lines = self.metrics.format_summary().splitlines()
+        self.assertTrue(lines[2].startswith('ec2'))
+        compare(lines[-1], '3 calls taking 1.750s')
+
+    def test_write_json(self):
+        self.metrics.record('cloudformation', 'DescribeStacks', 0.25)
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, 'stats.json')
+            self.metrics.write_json(path)
+            with open(path) as f:
+                compare(json.load(f), self.metrics.summary())
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_instrument_query_connection(self):
+        conn = boto.cloudformation.connection.CloudFormationConnection(
+            aws_access_key_id='access', aws_secret_access_key='secret')
+        ok = Mock(status=200)
+        throttled = Mock(status=400)
+        throttled.read.return_value = '<ErrorResponse><Error><Code>Throttling</Code></Error></ErrorResponse>'
+        conn.make_request = Mock(side_effect=[ok, throttled])
+        api_metrics.instrument_connection(conn, 'cloudformation')
+
+        self.assertIs(conn.make_request('DescribeStacks', {}, '/', 'POST'), ok)
+        self.assertIs(conn.make_request('DescribeStacks', {}, '/', 'POST'), throttled)
+        compare(self.metrics.summary(), [
+            {'service': 'cloudformation', 'operation': 'DescribeStacks', 'calls': 2, 'errors': 1,
+             'throttles': 1, 'retries': 0, 'seconds': 1.0, 'max_seconds': 0.5},
+        ])
+
+    def test_instrument_rest_connection(self):
+        conn = boto.route53.connection.Route53Connection(
+            aws_access_key_id='access', aws_secret_access_key='secret')
+        conn.make_request = Mock(side_effect=IOError)
+        api_metrics.instrument_connection(conn, 'route53')
+
+        with self.assertRaises(IOError):
+            conn.make_request('POST', '/2013-04-01/hostedzone/ABC123/rrset', {}, '')
+        summary = self.metrics.summary()
+        compare([(row['operation'], row['errors']) for row in summary], [('POST rrset', 1)])
+
+    def test_instrument_missing_connection(self):
+        self.assertIsNone(api_metrics.instrument_connection(None, 'cloudformation'))
+
+    def test_instrument_client(self):
+        client = boto3.session.Session(aws_access_key_id='access', aws_secret_access_key='secret',
+                                       region_name='eu-west-1').client('cloudformation')
+        api_metrics.instrument_client(client)
+        stubber = Stubber(client)
+        stubber.add_response('describe_stacks', {'Stacks': []})
+        stubber.add_client_error('describe_stacks', service_error_code='Throttling', http_status_code=400)
+        with stubber:
+            client.describe_stacks()
+            with self.assertRaises(ClientError):
+                client.describe_stacks()
+        compare(self.metrics.summary(), [
+            {'service': 'cloudformation', 'operation': 'DescribeStacks', 'calls': 2, 'errors': 1,
+             'throttles': 1, 'retries': 0, 'seconds': 1.0, 'max_seconds': 0.5},
+        ])
@@ -9,6 +9,7 @@ from boto.resultset import ResultSet
 import mock
 
 from bootstrap_cfn import autoscale
+from bootstrap_cfn.errors import AutoscalingInstanceCountError
 
 
 def get_all_groups(names=None, max_records=None, next_token=None):
@@ -65,3 +66,72 @@ class TestAutoscale(unittest.TestCase):
             # Test if no stack found, don't continue
             a = autoscale.Autoscale(self.env.aws_profile)
             self.assertIsNone(a.set_tag('test_key', 'test_value'))
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_wait_for_instances(self, mock_sleep):
+        with mock.patch('boto.ec2.autoscale.connect_to_region'):
+            a = autoscale.Autoscale(self.env.aws_profile)
+        healthy = {'LifecycleState': 'InService', 'HealthStatus': 'Healthy'}
+        with mock.patch.object(a, 'get_instances', side_effect=[[], [healthy], [healthy, healthy]]), \
+                mock.patch.object(a, 'get_instances_list'):
+            a.wait_for_instances(2)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @mock.patch('bootstrap_cfn.utils._monotonic', side_effect=xrange(0, 1000, 10))
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_wait_for_instances_timeout(self, mock_sleep, mock_monotonic):
+        with mock.patch('boto.ec2.autoscale.connect_to_region'):
+            a = autoscale.Autoscale(self.env.aws_profile)
+        a.group = mock.Mock()
+        a.group.name = 'test1'
+        with mock.patch.object(a, 'get_instances', return_value=[]), \
+                mock.patch.object(a, 'get_instances_list'):
+            with self.assertRaises(AutoscalingInstanceCountError):
+                a.wait_for_instances(1, retry_delay=10, retry_max=3)
+
+    def cycle(self, batch_size=1, surge=False, max_size=10):
+        """
+        Cycle a group of four instances, returning the desired capacities
+        set and the instances terminated
+        """
+        with mock.patch('boto.ec2.autoscale.connect_to_region'):
+            a = autoscale.Autoscale(self.env.aws_profile)
+        a.group = AutoScalingGroup(name='test1', max_size=max_size, health_check_period=0,
+                                   health_check_type='ELB')
+        old = [{'InstanceId': 'i-old{0}'.format(i)} for i in range(4)]
+        capacities = []
+
+        def healthy_instances():
+            # Every instance asked for comes up healthy
+            count = capacities[-1] if capacities else len(old)
+            return old + [{'InstanceId': 'i-new{0}'.format(i)} for i in range(count - len(old))]
+
+        client = mock.Mock()
+        with mock.patch.object(a, 'get_healthy_instances', side_effect=healthy_instances), \
+                mock.patch.object(a, 'set_autoscaling_desired_capacity', side_effect=capacities.append), \
+                mock.patch.object(a, 'wait_for_instances'), \
+                mock.patch.object(a, 'get_instances_list'), \
+                mock.patch('bootstrap_cfn.utils.sleep_countdown'), \
+                mock.patch('bootstrap_cfn.utils.connections.client', return_value=client):
+            a.cycle_instances(batch_size=batch_size, surge=surge)
+        terminated = [kwargs['InstanceId']
+                      for _, kwargs in client.terminate_instance_in_auto_scaling_group.call_args_list]
+        return capacities, terminated
+
+    def test_cycle_instances_one_at_a_time(self):
+        capacities, terminated = self.cycle()
+        self.assertEqual(capacities, [5, 5, 5, 5])
+        self.assertEqual(terminated, ['i-old0', 'i-old1', 'i-old2', 'i-old3'])
+
+    def test_cycle_instances_in_batches(self):
+        self.assertEqual(self.cycle(batch_size='50%')[0], [6, 6])
+        self.assertEqual(self.cycle(batch_size='3')[0], [7, 5])
+
+    def test_cycle_instances_surge(self):
+        capacities, terminated = self.cycle(surge=True)
+        self.assertEqual(capacities, [8])
+        self.assertEqual(terminated, ['i-old0', 'i-old1', 'i-old2', 'i-old3'])
+
+    def test_cycle_instances_within_max_size(self):
+        self.assertEqual(self.cycle(surge=True, max_size=6)[0], [6, 6])
+        self.assertEqual(self.cycle(batch_size=2, max_size=4)[0], [5, 5, 5, 5])
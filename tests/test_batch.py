@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from testfixtures import compare
+
+import yaml
+
+from bootstrap_cfn import batch
+from bootstrap_cfn.config import ConfigParser, ProjectConfig
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.work_dir, 'templates')
+        dev = ProjectConfig.load_yaml('tests/sample-project.yaml')['dev']
+        self.config_file = os.path.join(self.work_dir, 'project.yaml')
+        with open(self.config_file, 'w') as f:
+            yaml.safe_dump({'dev': dev, 'staging': dev, 'broken': {'vpc': dev['vpc'], 'ec2': None}}, f)
+        passwords = ProjectConfig.load_yaml('tests/sample-project-passwords.yaml')['dev']
+        self.passwords_file = os.path.join(self.work_dir, 'passwords.yaml')
+        with open(self.passwords_file, 'w') as f:
+            yaml.safe_dump({'dev': passwords, 'staging': passwords}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_list_environments(self):
+        compare(batch.list_environments(self.config_file), ['broken', 'dev', 'staging'])
+
+    def test_render_environments(self):
+        summary = batch.render_environments(self.config_file,
+                                            self.output_dir,
+                                            passwords=self.passwords_file,
+                                            application='test',
+                                            processes=2)
+        compare(summary['rendered'], ['dev', 'staging'])
+        compare(summary['failed'], ['broken'])
+        self.assertIn('ec2', summary['environments']['broken']['error'])
+
+        with open(os.path.join(self.output_dir, 'summary.json')) as f:
+            compare(json.load(f)['failed'], ['broken'])
+
+        project_config = ProjectConfig(self.config_file, 'dev',
+                                       self.passwords_file)
+        parser = ConfigParser(project_config.config, 'test-dev-render', 'dev', 'test')
+        expected = json.loads(parser.process())
+        with open(os.path.join(self.output_dir, 'dev.json')) as f:
+            rendered = json.load(f)
+        compare(rendered, expected)
+
+    def test_render_chosen_environments_in_process(self):
+        summary = batch.render_environments(self.config_file,
+                                            self.output_dir,
+                                            environments=['staging'],
+                                            passwords=self.passwords_file,
+                                            processes=1)
+        compare(summary['rendered'], ['staging'])
+        compare(summary['processes'], 1)
+        compare(sorted(os.listdir(self.output_dir)), ['staging.json', 'summary.json'])
+
+    @patch('bootstrap_cfn.vpc.get_available_cidr_block')
+    def test_render_without_vpc_is_a_failure(self, get_available_cidr_block):
+        novpc = dict(ProjectConfig.load_yaml('tests/sample-project.yaml')['dev'])
+        del novpc['vpc']
+        with open(self.config_file, 'w') as f:
+            yaml.safe_dump({'novpc': novpc}, f)
+        result = batch.render_environment(self.config_file, 'novpc', self.work_dir)
+        self.assertFalse(result['ok'])
+        self.assertIn('no vpc section', result['error'])
+        self.assertFalse(get_available_cidr_block.called)
+
+    def test_render_exit_is_a_failure(self):
+        # No passwords, so the rds section exits on a missing password
+        result = batch.render_environment(self.config_file, 'dev', self.work_dir)
+        self.assertFalse(result['ok'])
+        compare(result['error'], 'exited with status 1')
@@ -0,0 +1,170 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import boto.cloudformation.connection
+
+import boto3
+
+from mock import Mock, patch
+
+from testfixtures import compare
+
+from bootstrap_cfn import errors, utils
+from bootstrap_cfn.cassette import Cassette
+
+from .local_s3 import LocalS3
+
+DESCRIBE_STACKS_XML = """<DescribeStacksResponse xmlns="http://cloudformation.amazonaws.com/doc/2010-05-15/">
+  <DescribeStacksResult>
+    <Stacks>
+      <member>
+        <StackName>app-dev-12345678</StackName>
+        <StackStatus>CREATE_COMPLETE</StackStatus>
+      </member>
+    </Stacks>
+  </DescribeStacksResult>
+</DescribeStacksResponse>"""
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'cassette.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def cfn_connection(self):
+        return boto.cloudformation.connection.CloudFormationConnection(
+            aws_access_key_id='access', aws_secret_access_key='secret')
+
+    def test_replay_boto_connection(self):
+        recorder = Cassette(self.path, mode='record')
+        conn = self.cfn_connection()
+        response = Mock(status=200, reason='OK')
+        response.read.return_value = DESCRIBE_STACKS_XML
+        response.getheaders.return_value = [('content-type', 'text/xml')]
+        conn.make_request = Mock(return_value=response)
+        recorder.wrap_connection(conn, 'cloudformation')
+        self.assertIs(conn.make_request('DescribeStacks', {'StackName': 'app-dev-12345678'}, '/', 'POST'),
+                      response)
+        recorder.save()
+
+        conn = self.cfn_connection()
+        conn.make_request = Mock(side_effect=AssertionError("replay called AWS"))
+        Cassette(self.path).wrap_connection(conn, 'cloudformation')
+        # Parsed by boto from the recorded body
+        stacks = conn.describe_stacks('app-dev-12345678')
+        compare([(s.stack_name, s.stack_status) for s in stacks], [('app-dev-12345678', 'CREATE_COMPLETE')])
+
+    def test_replay_boto3_client(self):
+        s3 = LocalS3()
+        s3.start()
+        try:
+            session = boto3.session.Session(aws_access_key_id='access', aws_secret_access_key='secret',
+                                            region_name='eu-west-1')
+            recorder = Cassette(self.path, mode='record')
+            client = recorder.wrap_client(session.client('s3', endpoint_url=s3.url))
+            client.put_object(Bucket='templates', Key='stack.json', Body='{}')
+            compare(client.get_object(Bucket='templates', Key='stack.json')['Body'].read(), '{}')
+            recorder.save()
+        finally:
+            s3.stop()
+
+        replayer = Cassette(self.path)
+        client = replayer.wrap_client(replayer.session().client('s3', endpoint_url=s3.url))
+        compare(client.get_object(Bucket='templates', Key='stack.json')['Body'].read(), '{}')
+
+    def test_play_order(self):
+        recorder = Cassette(self.path, mode='record')
+        for status in ['CREATE_IN_PROGRESS', 'CREATE_COMPLETE']:
+            recorder.record('cloudformation', 'DescribeStacks', {'params': {'StackName': 'a'}},
+                            200, 'OK', {}, status, 0.5)
+        recorder.record('cloudformation', 'CreateChangeSet', {'params': {'ChangeSetName': 'cs-1'}},
+                        200, 'OK', {}, 'created', 0.5)
+        recorder.save()
+
+        replayer = Cassette(self.path)
+
+        def play(operation, params):
+            return replayer.play('cloudformation', operation, {'params': params})['body']
+
+        compare(play('DescribeStacks', {'StackName': 'a'}), 'CREATE_IN_PROGRESS')
+        compare(play('DescribeStacks', {'StackName': 'a'}), 'CREATE_COMPLETE')
+        # Polling longer than when recorded repeats the last answer
+        compare(play('DescribeStacks', {'StackName': 'a'}), 'CREATE_COMPLETE')
+        # A different change set name still gets the recorded response
+        compare(play('CreateChangeSet', {'ChangeSetName': 'cs-2'}), 'created')
+        with self.assertRaises(errors.CassetteError):
+            play('DeleteStack', {'StackName': 'a'})
+
+    @patch('bootstrap_cfn.cassette._sleep')
+    def test_latency(self, sleep):
+        recorder = Cassette(self.path, mode='record')
+        recorder.record('ec2', 'DescribeVpcs', {'params': {}}, 200, 'OK', {}, '', 0.25)
+        recorder.save()
+
+        Cassette(self.path, latency='0.1').play('ec2', 'DescribeVpcs', {'params': {}})
+        sleep.assert_called_once_with(0.1)
+        Cassette(self.path, latency='recorded').play('ec2', 'DescribeVpcs', {'params': {}})
+        sleep.assert_called_with(0.25)
+
+    def test_secrets_redacted(self):
+        template = {
+            'Parameters': {'DBPassword': {'Type': 'String', 'NoEcho': True, 'Default': 'hunter2'},
+                           'Size': {'Type': 'String', 'Default': 'small'}},
+            'Resources': {'RDSInstance': {'Type': 'AWS::RDS::DBInstance',
+                                          'Properties': {'MasterUserPassword': 'hunter2',
+                                                         'DBName': 'app'}}},
+        }
+        recorder = Cassette(self.path, mode='record')
+        recorder.record('iam', 'UploadServerCertificate',
+                        {'params': {'ServerCertificateName': 'cert', 'CertificateBody': 'BEGIN CERT',
+                                    'PrivateKey': 'BEGIN KEY', 'CertificateChain': 'BEGIN CHAIN'}},
+                        200, 'OK', {}, '', 0.1)
+        recorder.record('cloudformation', 'CreateStack',
+                        {'params': {'StackName': 'app-dev', 'TemplateBody': json.dumps(template),
+                                    'Parameters': [{'ParameterKey': 'DBPassword', 'ParameterValue': 'hunter2'},
+                                                   {'ParameterKey': 'Size', 'ParameterValue': 'large'}]}},
+                        200, 'OK', {}, '', 0.1)
+        recorder.record('cloudformation', 'GetTemplate', {'params': {'StackName': 'app-dev'}}, 200, 'OK', {},
+                        '<GetTemplateResult><TemplateBody>{0}</TemplateBody></GetTemplateResult>'.format(
+                            json.dumps(template)), 0.1)
+        recorder.record('sts', 'AssumeRole', {'params': {}}, 200, 'OK', {},
+                        '<Credentials><AccessKeyId>AKIA</AccessKeyId><SecretAccessKey>s3cr3t</SecretAccessKey>'
+                        '<SessionToken>t0k3n</SessionToken></Credentials>', 0.1)
+        recorder.save()
+
+        compare(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        with open(self.path) as f:
+            saved = f.read()
+        for secret in ('hunter2', 'BEGIN', 's3cr3t', 't0k3n'):
+            self.assertNotIn(secret, saved)
+        # Everything else is kept
+        for kept in ('cert', 'large', 'small', 'AKIA', 'DBName'):
+            self.assertIn(kept, saved)
+
+        # The same requests still match their recordings
+        replayer = Cassette(self.path)
+        params = {'StackName': 'app-dev', 'TemplateBody': json.dumps(template),
+                  'Parameters': [{'ParameterKey': 'DBPassword', 'ParameterValue': 'hunter2'},
+                                 {'ParameterKey': 'Size', 'ParameterValue': 'large'}]}
+        compare(replayer.play('cloudformation', 'CreateStack', {'params': params})['request']['params']['StackName'],
+                'app-dev')
+        self.assertEqual(replayer._used, set([1]))
+
+    def test_pool_replays(self):
+        recorder = Cassette(self.path, mode='record')
+        recorder.record('cloudformation', 'DescribeStacks', {'params': {'StackName': 'app-dev-12345678'}},
+                        200, 'OK', {}, DESCRIBE_STACKS_XML, 0.1)
+        recorder.save()
+
+        pool = utils.ConnectionPool()
+        pool.use_cassette(Cassette(self.path))
+        stacks = pool.client('cloudformation').describe_stacks(StackName='app-dev-12345678')['Stacks']
+        compare([(s['StackName'], s['StackStatus']) for s in stacks], [('app-dev-12345678', 'CREATE_COMPLETE')])
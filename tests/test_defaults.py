@@ -52,6 +52,16 @@ class TestDefaults(unittest.TestCase):
                                   default_settings=default_settings.get(key, {}),
                                   user_keys=user_keys)
 
+    def test_config_source(self):
+        config = ProjectConfig(config='tests/cloudformation/sample-project_minimal.yaml',
+                               passwords='tests/cloudformation/sample-project_minimal-secrets.yaml',
+                               environment='prod')
+        self.assertEqual(config.config_source('rds', 'storage'), 'defaults')
+        self.assertEqual(config.config_source('rds', 'db-name'), 'user')
+        self.assertEqual(config.config_source('rds', 'db-master-password'), 'passwords')
+        self.assertEqual(config.config_source('ec2', 'tags', 'Apps'), 'user')
+        self.assertIsNone(config.config_source('not-a-section'))
+
     def compare_settings(self,
                          actual_settings,
                          user_settings,
@@ -1,3 +1,5 @@
+import datetime
+import json
 import unittest
 
 import boto
@@ -6,7 +8,7 @@ import yaml
 
 from mock import patch, Mock  # noqa
 
-from bootstrap_cfn import cloudformation, config, errors, fab_tasks, iam, r53
+from bootstrap_cfn import api_metrics, cloudformation, config, errors, fab_tasks, iam, r53
 
 fake_profile = {'lol': {'aws_access_key_id': 'secretz', 'aws_secret_access_key': 'verysecretz'}}
 
@@ -40,6 +42,7 @@ class TestFabTasks(unittest.TestCase):
         example_return = {'DeleteStackResponse': {'ResponseMetadata': {'RequestId': 'someuuid'}}}
         stack_mock = Mock(stack_name=stack)
         stack_mock.resource_status = 'CREATE_COMPLETE'
+        stack_mock.stack_status = 'CREATE_COMPLETE'
         mock_config = {'delete_stack.return_value': example_return,
                        'create_stack.return_value': stack,
                        'describe_stacks.return_value': [stack_mock],
@@ -342,6 +345,208 @@ class TestFabTasks(unittest.TestCase):
         ret = fab_tasks.cfn_create(False)
         self.assertTrue(ret)
 
+    def cfn_update_mock(self, deployed_template):
+        cfn = Mock()
+        cfn.get_template.return_value = deployed_template
+        cfn.diff_templates = cloudformation.Cloudformation.diff_templates
+        cfn.create_change_set.return_value = ('change-set-id', [{
+            'Action': 'Modify',
+            'LogicalResourceId': 'A',
+            'ResourceType': 'AWS::EC2::SecurityGroup',
+            'Replacement': 'True'}])
+        # Not started, then in progress, then done
+        cfn.get_stack_status.side_effect = ['UPDATE_COMPLETE', 'UPDATE_COMPLETE',
+                                            'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE']
+        return cfn
+
+    def tail_until_done(self, stack, stack_name, done=None, history=True):
+        while not done():
+            pass
+
+    @patch('bootstrap_cfn.fab_tasks.tail')
+    @patch('bootstrap_cfn.fab_tasks.get_cloudformation_tags', return_value={})
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.fab_tasks.get_config')
+    @patch('bootstrap_cfn.fab_tasks.get_stack_name', return_value="unittest-test-12345678")
+    def test_cfn_update(self, get_stack_name_function, get_config_function,
+                        get_connection_function, get_cloudformation_tags_function,
+                        tail_function):
+        cfn = self.cfn_update_mock({'Resources': {'A': {'Type': 'AWS::EC2::SecurityGroup'}}})
+        get_connection_function.return_value = cfn
+        get_config_function.return_value.data = {'vpc': {}}
+        get_config_function.return_value.process.return_value = \
+            '{"Resources": {"A": {"Type": "AWS::EC2::SecurityGroup", "Properties": {}}}}'
+        tail_function.side_effect = self.tail_until_done
+
+        self.assertTrue(fab_tasks.cfn_update(force=True))
+        cfn.execute_change_set.assert_called_once_with('change-set-id')
+        self.assertTrue(tail_function.called)
+        # Waited for the stack to finish updating, not its starting status
+        self.assertEqual(cfn.get_stack_status.call_count, 4)
+
+    @patch('bootstrap_cfn.fab_tasks.tail')
+    @patch('bootstrap_cfn.fab_tasks.get_cloudformation_tags', return_value={})
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.fab_tasks.get_config')
+    @patch('bootstrap_cfn.fab_tasks.get_stack_name', return_value="unittest-test-12345678")
+    def test_cfn_update_failed(self, get_stack_name_function, get_config_function,
+                               get_connection_function, get_cloudformation_tags_function,
+                               tail_function):
+        cfn = self.cfn_update_mock({'Resources': {'A': {'Type': 'AWS::EC2::SecurityGroup'}}})
+        cfn.get_stack_status.side_effect = ['UPDATE_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS',
+                                            'UPDATE_ROLLBACK_COMPLETE']
+        get_connection_function.return_value = cfn
+        get_config_function.return_value.data = {'vpc': {}}
+        get_config_function.return_value.process.return_value = \
+            '{"Resources": {"A": {"Type": "AWS::EC2::SecurityGroup", "Properties": {}}}}'
+        tail_function.side_effect = self.tail_until_done
+
+        with self.assertRaises(SystemExit):
+            fab_tasks.cfn_update(force=True)
+
+    def parser_without_vpc(self):
+        data = dict(config.ProjectConfig('tests/sample-project.yaml', 'dev',
+                                         'tests/sample-project-passwords.yaml').config)
+        data.pop('vpc')
+        return config.ConfigParser(data, 'unittest-test-12345678', 'dev', 'test')
+
+    @patch('bootstrap_cfn.vpc.get_available_cidr_block')
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.fab_tasks.get_config')
+    @patch('bootstrap_cfn.fab_tasks.get_stack_name', return_value="unittest-test-12345678")
+    def test_cfn_update_without_vpc_section(self, get_stack_name_function, get_config_function,
+                                            get_connection_function, get_available_cidr_block_function):
+        # Deployed with the address ranges cfn_create picked
+        deployed = self.parser_without_vpc()
+        deployed.data['vpc'] = {'CIDR': '10.3.0.0/24', 'SubnetA': '10.3.0.0/28',
+                                'SubnetB': '10.3.0.16/28', 'SubnetC': '10.3.0.32/28'}
+        cfn = self.cfn_update_mock(json.loads(deployed.process()))
+        get_connection_function.return_value = cfn
+        get_config_function.return_value = self.parser_without_vpc()
+
+        # The same ranges are rendered again, so there's nothing to change
+        self.assertTrue(fab_tasks.cfn_update(force=True))
+        self.assertFalse(get_available_cidr_block_function.called)
+        self.assertFalse(cfn.create_change_set.called)
+
+    @patch('bootstrap_cfn.vpc.get_available_cidr_block')
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.fab_tasks.get_config')
+    @patch('bootstrap_cfn.fab_tasks.get_stack_name', return_value="unittest-test-12345678")
+    def test_cfn_update_without_vpc_section_or_mapping(self, get_stack_name_function, get_config_function,
+                                                       get_connection_function,
+                                                       get_available_cidr_block_function):
+        cfn = self.cfn_update_mock({'Resources': {'A': {'Type': 'AWS::EC2::SecurityGroup'}}})
+        get_connection_function.return_value = cfn
+        get_config_function.return_value = self.parser_without_vpc()
+
+        with self.assertRaises(SystemExit):
+            fab_tasks.cfn_update(force=True)
+        self.assertFalse(get_available_cidr_block_function.called)
+        self.assertFalse(cfn.create_change_set.called)
+
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.fab_tasks.get_config')
+    @patch('bootstrap_cfn.fab_tasks.get_stack_name', return_value="unittest-test-12345678")
+    def test_cfn_update_up_to_date(self, get_stack_name_function, get_config_function,
+                                   get_connection_function):
+        cfn = self.cfn_update_mock({'Resources': {'A': {'Type': 'AWS::EC2::SecurityGroup'}}})
+        get_connection_function.return_value = cfn
+        get_config_function.return_value.data = {'vpc': {}}
+        get_config_function.return_value.process.return_value = \
+            '{"Resources": {"A": {"Type": "AWS::EC2::SecurityGroup"}}}'
+
+        self.assertTrue(fab_tasks.cfn_update(force=True))
+        self.assertFalse(cfn.create_change_set.called)
+
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.stream.stream_stacks')
+    def test_cfn_tail(self, stream_stacks_function, get_connection_function):
+        stream_stacks_function.return_value = {
+            'app1-dev': {'status': 'CREATE_COMPLETE', 'ok': True, 'seconds': 10, 'events': 5},
+            'app2-dev': {'status': 'ROLLBACK_COMPLETE', 'ok': False, 'seconds': 20, 'events': 8},
+        }
+        with self.assertRaises(SystemExit):
+            fab_tasks.cfn_tail(stacks='app1-dev; app2-dev', history='false')
+        stream_stacks_function.assert_called_once_with(
+            get_connection_function.return_value, ['app1-dev', 'app2-dev'], rate=2.0, history=False)
+
+        del stream_stacks_function.return_value['app2-dev']
+        self.assertTrue(fab_tasks.cfn_tail(stacks='app1-dev'))
+
+    @patch('bootstrap_cfn.fab_tasks.env', api_stats='')
+    @patch('bootstrap_cfn.api_metrics.metrics', spec=api_metrics.ApiMetrics)
+    def test_api_stats(self, metrics, env):
+        metrics.summary.return_value = [{'service': 'ec2', 'operation': 'DescribeTags'}]
+        metrics.format_summary.return_value = 'summary'
+        with patch('sys.stderr') as stderr:
+            fab_tasks.report_api_stats()
+        self.assertTrue(stderr.write.called)
+        self.assertFalse(metrics.write_json.called)
+
+        fab_tasks.api_stats(output='/tmp/api-stats.json')
+        self.assertEqual(env.api_stats, '/tmp/api-stats.json')
+        with patch('sys.stderr'):
+            fab_tasks.report_api_stats()
+        metrics.write_json.assert_called_once_with('/tmp/api-stats.json')
+
+        fab_tasks.api_stats(output='off')
+        metrics.write_json.reset_mock()
+        with patch('sys.stderr') as stderr:
+            fab_tasks.report_api_stats()
+        self.assertFalse(stderr.write.called)
+        self.assertFalse(metrics.write_json.called)
+
+        # Nothing to report for a run that didn't call AWS
+        fab_tasks.api_stats()
+        metrics.summary.return_value = []
+        with patch('sys.stderr') as stderr:
+            fab_tasks.report_api_stats()
+        self.assertFalse(stderr.write.called)
+
+    @patch('bootstrap_cfn.utils.connections')
+    @patch('bootstrap_cfn.utils.throttle')
+    def test_api_limits(self, throttle, connections):
+        fab_tasks.api_limits('cloudformation=2;route53=1', retries='3')
+        throttle.configure.assert_called_once_with({'cloudformation': 2, 'route53': 1}, max_retries=3)
+        self.assertTrue(connections.clear.called)
+
+    @patch('bootstrap_cfn.utils.connections')
+    @patch('bootstrap_cfn.fab_tasks.atexit.register')
+    @patch('bootstrap_cfn.fab_tasks.Cassette')
+    def test_cassette(self, cassette_class, register_function, connections):
+        cassette_class.return_value.replaying = False
+        fab_tasks.cassette('/tmp/cfn-create.json', mode='Record', latency='0.1')
+        cassette_class.assert_called_once_with('/tmp/cfn-create.json', mode='record',
+                                               latency='0.1', region_name='eu-west-1')
+        connections.use_cassette.assert_called_once_with(cassette_class.return_value)
+        register_function.assert_called_once_with(cassette_class.return_value.save)
+
+    @patch('bootstrap_cfn.utils.connections')
+    @patch('bootstrap_cfn.fab_tasks.boto3.setup_default_session')
+    def test_aws_replaying(self, setup_default_session, connections):
+        connections.cassette.replaying = True
+        fab_tasks.aws('nonexistent')
+        self.assertFalse(setup_default_session.called)
+
+    @patch('bootstrap_cfn.fab_tasks.get_connection')
+    @patch('bootstrap_cfn.timeline.export')
+    @patch('bootstrap_cfn.timeline.fetch_events')
+    def test_cfn_timeline(self, fetch_events_function, export_function, get_connection_function):
+        fetch_events_function.return_value = []
+        with self.assertRaises(SystemExit):
+            fab_tasks.cfn_timeline(stack='app-dev')
+
+        start = Mock(stack_name='app-dev', logical_resource_id='SG', resource_type='AWS::EC2::SecurityGroup',
+                     resource_status='CREATE_IN_PROGRESS', timestamp=datetime.datetime(2016, 1, 1))
+        end = Mock(stack_name='app-dev', logical_resource_id='SG', resource_type='AWS::EC2::SecurityGroup',
+                   resource_status='CREATE_COMPLETE', timestamp=datetime.datetime(2016, 1, 1, 0, 1))
+        fetch_events_function.return_value = [start, end]
+        rows = fab_tasks.cfn_timeline(output='/tmp/timeline.csv', stack='app-dev')
+        fetch_events_function.assert_called_with(get_connection_function.return_value, 'app-dev')
+        export_function.assert_called_once_with(rows, '/tmp/timeline.csv')
+        self.assertEqual(rows[0]['seconds'], 60)
+
     @patch('bootstrap_cfn.fab_tasks.get_legacy_name', return_value="unittest-dev")
     def test_get_tag_record_name(self, get_legacy_name_function):
         '''
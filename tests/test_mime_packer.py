@@ -34,3 +34,10 @@ class TestMimePacker(unittest.TestCase):
             prefix="mimeparts are in expected order")
         compare(parts[1].get_payload(), "MORESTRING")
         compare(parts[2].get_payload(), "SOMESTRING")
+
+    def test_pack_is_repeatable(self):
+        compare(mime_packer.pack(self.parts), mime_packer.pack(self.parts))
+        compare(mime_packer.pack(self.parts, {'compress': True}),
+                mime_packer.pack(self.parts, {'compress': True}))
+        self.assertNotEqual(mime_packer.pack(self.parts),
+                            mime_packer.pack(self.parts[:1]))
@@ -0,0 +1,95 @@
+import datetime
+import unittest
+from StringIO import StringIO
+
+import mock
+
+from testfixtures import compare
+
+from bootstrap_cfn import stream
+
+
+def stack_event(stack_name, n, status='CREATE_IN_PROGRESS'):
+    return mock.Mock(event_id='{0}-event-{1}'.format(stack_name, n),
+                     timestamp=datetime.datetime(2016, 1, 1) + datetime.timedelta(seconds=n),
+                     resource_status=status,
+                     resource_type='AWS::EC2::Instance',
+                     resource_status_reason=None)
+
+
+class FakeStacks(object):
+    """
+    Stands in for Cloudformation, each stack moving through a list of
+    statuses with one new event per status
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.events = dict((name, []) for name in statuses)
+        self.conn_cfn = mock.Mock()
+        self.conn_cfn.describe_stack_events.side_effect = self.describe_stack_events
+
+    def get_stack_status(self, stack_name):
+        statuses = self.statuses[stack_name]
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        if status is not None:
+            events = self.events[stack_name]
+            events.append(stack_event(stack_name, len(events), status))
+        return status
+
+    def describe_stack_events(self, stack_name, next_token=None):
+        return list(reversed(self.events[stack_name]))
+
+
+@mock.patch('bootstrap_cfn.stream.time.sleep')
+class TestStackStreamer(unittest.TestCase):
+
+    def test_stream_stacks(self, mock_sleep):
+        stacks = FakeStacks({
+            'app1-dev': ['CREATE_IN_PROGRESS', 'CREATE_IN_PROGRESS', 'CREATE_COMPLETE'],
+            'app2-dev': ['CREATE_IN_PROGRESS', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE'],
+            'app3-dev': [None],
+        })
+        out = StringIO()
+        results = stream.stream_stacks(stacks, ['app1-dev', 'app2-dev', 'app3-dev'],
+                                       rate=1000, burst=1000, out=out)
+
+        compare(sorted(results), ['app1-dev', 'app2-dev', 'app3-dev'])
+        compare(results['app1-dev']['status'], 'CREATE_COMPLETE')
+        self.assertTrue(results['app1-dev']['ok'])
+        compare(results['app1-dev']['events'], 3)
+        compare(results['app2-dev']['status'], 'ROLLBACK_COMPLETE')
+        self.assertFalse(results['app2-dev']['ok'])
+        compare(results['app3-dev']['status'], None)
+        self.assertFalse(results['app3-dev']['ok'])
+        compare(results['app3-dev']['events'], 0)
+
+        lines = out.getvalue().splitlines()
+        compare(len(lines), 6)
+        app1_lines = [line for line in lines if 'app1-dev-event' in line]
+        compare(len(app1_lines), 3)
+        for line in app1_lines:
+            self.assertIn('[app1-dev]', line)
+        # Each stack's events are in order
+        self.assertIn('CREATE_COMPLETE', app1_lines[-1])
+
+    def test_follow_delete(self, mock_sleep):
+        stacks = FakeStacks({'app1-dev': ['DELETE_IN_PROGRESS', 'DELETE_IN_PROGRESS', None]})
+        results = stream.stream_stacks(stacks, ['app1-dev'], rate=1000, burst=1000, out=StringIO())
+        compare(results['app1-dev']['status'], 'DELETE_COMPLETE')
+        self.assertTrue(results['app1-dev']['ok'])
+        compare(results['app1-dev']['events'], 2)
+
+    def test_timeout(self, mock_sleep):
+        stacks = FakeStacks({'app1-dev': ['CREATE_IN_PROGRESS']})
+        with mock.patch('bootstrap_cfn.utils._monotonic', side_effect=range(100)):
+            results = stream.stream_stacks(stacks, ['app1-dev'], rate=1000, timeout=5, out=StringIO())
+        self.assertFalse(results['app1-dev']['ok'])
+        compare(results['app1-dev']['error'], 'timed out after 5 seconds')
+
+    def test_error(self, mock_sleep):
+        stacks = mock.Mock()
+        stacks.get_stack_status.side_effect = ValueError('boom')
+        results = stream.stream_stacks(stacks, ['app1-dev'], rate=1000, out=StringIO())
+        self.assertFalse(results['app1-dev']['ok'])
+        compare(results['app1-dev']['error'], 'boom')
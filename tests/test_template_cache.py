@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from testfixtures import compare
+
+from bootstrap_cfn.config import ConfigParser, ProjectConfig
+from bootstrap_cfn.template_cache import SectionCache, TemplateCache
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = TemplateCache(os.path.join(self.work_dir, 'templates'))
+        self.include_path = os.path.join(self.work_dir, 'include.json')
+        with open(self.include_path, 'w') as f:
+            json.dump({'Outputs': {'someoutput': {'Value': 'BLAH'}}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _parser(self):
+        project_config = ProjectConfig('tests/sample-project.yaml',
+                                       'dev',
+                                       'tests/sample-project-passwords.yaml')
+        project_config.config['includes'] = [self.include_path]
+        parser = ConfigParser(project_config.config, 'my-stack-12345678', 'dev', 'test')
+        parser.template_cache = self.cache
+        return parser
+
+    def test_repeat_render_is_served_from_cache(self):
+        first = self._parser().process()
+        parser = self._parser()
+        with patch.object(ConfigParser, 'base_template') as base_template:
+            second = parser.process()
+        self.assertFalse(base_template.called)
+        self.assertEqual(first, second)
+
+    def test_key_is_stable(self):
+        self.assertEqual(self.cache.key(self._parser()),
+                         self.cache.key(self._parser()))
+
+    def test_key_changes_with_stack_name(self):
+        parser = self._parser()
+        key = self.cache.key(parser)
+        parser.stack_name = 'my-stack-87654321'
+        self.assertNotEqual(key, self.cache.key(parser))
+
+    def test_key_changes_with_include_contents(self):
+        key = self.cache.key(self._parser())
+        with open(self.include_path, 'w') as f:
+            json.dump({'Outputs': {'someoutput': {'Value': 'CHANGED'}}}, f)
+        self.assertNotEqual(key, self.cache.key(self._parser()))
+
+    def test_key_changes_with_render_code(self):
+        parser = self._parser()
+        key = self.cache.key(parser)
+        sources = self.cache._parser_sources(parser)
+        for name in ('config.py', 'mime_packer.py', 'utils.py', 'vpc.py'):
+            self.assertIn(name, [os.path.basename(path) for path in sources])
+        with patch('troposphere.__version__', '0.0.1'):
+            self.assertNotEqual(key, self.cache.key(parser))
+
+    def test_no_vpc_section_is_not_cached(self):
+        parser = self._parser()
+        parser.data.pop('vpc')
+        self.assertIsNone(self.cache.key(parser))
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get('notakey'))
+
+
+class TestSectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = SectionCache(os.path.join(self.work_dir, 'sections'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _parser(self):
+        project_config = ProjectConfig('tests/sample-project.yaml',
+                                       'dev',
+                                       'tests/sample-project-passwords.yaml')
+        parser = ConfigParser(project_config.config, 'my-stack-12345678', 'dev', 'test')
+        parser.section_cache = self.cache
+        return parser
+
+    def test_unchanged_sections_are_not_rebuilt(self):
+        first = json.loads(self._parser().process())
+
+        # A new parser, as in a later run, with only the elb config changed
+        parser = self._parser()
+        parser.data['elb'][0]['listeners'][0]['LoadBalancerPort'] = 8080
+        with patch('bootstrap_cfn.config.mime_packer.pack') as pack, \
+                patch.object(ConfigParser, 'rds') as rds, \
+                patch.object(ConfigParser, 's3') as s3:
+            second = json.loads(parser.process())
+        self.assertFalse(pack.called)
+        self.assertFalse(rds.called)
+        self.assertFalse(s3.called)
+        compare(second['Resources']['ELBtestdevexternal']['Properties']['Listeners'][0]['LoadBalancerPort'],
+                8080)
+        compare(second['Resources']['RDSInstance'], first['Resources']['RDSInstance'])
+        compare(sorted(second['Outputs']), sorted(first['Outputs']))
+
+        # Same as a render without the cache
+        fresh = ConfigParser(parser.data, 'my-stack-12345678', 'dev', 'test')
+        compare(second, json.loads(fresh.process()))
+
+    def test_key_changes_with_render_code(self):
+        parser = self._parser()
+        key = self.cache.key(parser, 'elb', 'digest')
+        with patch('troposphere.__version__', '0.0.1'):
+            self.assertNotEqual(key, SectionCache(self.cache.cache_dir).key(parser, 'elb', 'digest'))
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get('notakey'))
@@ -0,0 +1,126 @@
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from testfixtures import compare
+
+from bootstrap_cfn import timeline
+
+START = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+
+def event(seconds, logical_id, status, resource_type='AWS::EC2::SecurityGroup'):
+    return Mock(stack_name='app-dev', logical_resource_id=logical_id,
+                physical_resource_id='{0}-id'.format(logical_id), resource_type=resource_type,
+                resource_status=status, timestamp=START + datetime.timedelta(seconds=seconds))
+
+
+# A stack with a security group, then a database and load balancer that
+# both wait for it, then a launch configuration that waits for the
+# database
+EVENTS = [
+    event(0, 'app-dev', 'CREATE_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+    event(2, 'SG', 'CREATE_IN_PROGRESS'),
+    event(3, 'SG', 'CREATE_IN_PROGRESS'),
+    event(10, 'SG', 'CREATE_COMPLETE'),
+    event(11, 'RDS', 'CREATE_IN_PROGRESS', 'AWS::RDS::DBInstance'),
+    event(11, 'ELB', 'CREATE_IN_PROGRESS', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+    event(71, 'ELB', 'CREATE_COMPLETE', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+    event(611, 'RDS', 'CREATE_COMPLETE', 'AWS::RDS::DBInstance'),
+    event(612, 'LC', 'CREATE_IN_PROGRESS', 'AWS::AutoScaling::LaunchConfiguration'),
+    event(615, 'LC', 'CREATE_COMPLETE', 'AWS::AutoScaling::LaunchConfiguration'),
+    event(616, 'app-dev', 'CREATE_COMPLETE', 'AWS::CloudFormation::Stack'),
+]
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = timeline.resource_timeline(EVENTS)
+
+    def test_resource_timeline(self):
+        compare([(row['logical_resource_id'], row['operation'], row['status'], row['seconds'])
+                 for row in self.rows],
+                [('app-dev', 'CREATE', 'CREATE_COMPLETE', 616),
+                 ('SG', 'CREATE', 'CREATE_COMPLETE', 8),
+                 ('RDS', 'CREATE', 'CREATE_COMPLETE', 600),
+                 ('ELB', 'CREATE', 'CREATE_COMPLETE', 60),
+                 ('LC', 'CREATE', 'CREATE_COMPLETE', 3)])
+
+    def test_unfinished_and_failed(self):
+        rows = timeline.resource_timeline([
+            event(0, 'SG', 'DELETE_COMPLETE'),
+            event(1, 'SG', 'UPDATE_IN_PROGRESS'),
+            event(5, 'SG', 'UPDATE_FAILED'),
+            event(6, 'RDS', 'UPDATE_IN_PROGRESS'),
+        ])
+        compare([(row['logical_resource_id'], row['status'], row['seconds']) for row in rows],
+                [('SG', 'UPDATE_FAILED', 4), ('RDS', 'UPDATE_IN_PROGRESS', None)])
+
+    def test_critical_path(self):
+        compare([row['logical_resource_id'] for row in timeline.critical_path(self.rows)],
+                ['SG', 'RDS', 'LC'])
+
+    def test_critical_path_of_last_operation(self):
+        events = EVENTS + [
+            event(700, 'app-dev', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+            event(701, 'ELB', 'UPDATE_IN_PROGRESS', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(720, 'ELB', 'UPDATE_COMPLETE', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(721, 'app-dev', 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack'),
+        ]
+        path = timeline.critical_path(timeline.resource_timeline(events))
+        compare([(row['logical_resource_id'], row['operation']) for row in path], [('ELB', 'UPDATE')])
+
+    def test_update_with_cleanup(self):
+        events = EVENTS + [
+            event(700, 'app-dev', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+            # The load balancer is replaced, and the old one deleted in the cleanup
+            event(701, 'ELB', 'UPDATE_IN_PROGRESS', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(760, 'ELB', 'UPDATE_COMPLETE', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(761, 'app-dev', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+            event(762, 'ELB', 'DELETE_IN_PROGRESS', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(800, 'ELB', 'DELETE_COMPLETE', 'AWS::ElasticLoadBalancing::LoadBalancer'),
+            event(801, 'app-dev', 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack'),
+        ]
+        rows = timeline.resource_timeline(events)
+        compare([(row['logical_resource_id'], row['operation'], row['status'], row['seconds'])
+                 for row in rows[5:]],
+                [('app-dev', 'UPDATE', 'UPDATE_COMPLETE', 101),
+                 ('ELB', 'UPDATE', 'UPDATE_COMPLETE', 59),
+                 ('app-dev', 'UPDATE_COMPLETE_CLEANUP', 'UPDATE_COMPLETE', 40),
+                 ('ELB', 'DELETE', 'DELETE_COMPLETE', 38)])
+        path = timeline.critical_path(rows)
+        compare([(row['logical_resource_id'], row['operation']) for row in path], [('ELB', 'UPDATE')])
+
+    def test_resource_type_summary(self):
+        summary = timeline.resource_type_summary(self.rows)
+        compare([(s['resource_type'], s['count'], s['max_seconds']) for s in summary],
+                [('AWS::RDS::DBInstance', 1, 600),
+                 ('AWS::ElasticLoadBalancing::LoadBalancer', 1, 60),
+                 ('AWS::EC2::SecurityGroup', 1, 8),
+                 ('AWS::AutoScaling::LaunchConfiguration', 1, 3)])
+
+    def test_export(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            ndjson_path = os.path.join(work_dir, 'timeline.ndjson')
+            timeline.export(self.rows, ndjson_path)
+            with open(ndjson_path) as f:
+                rows = [json.loads(line) for line in f]
+            compare(rows[1]['logical_resource_id'], 'SG')
+            compare(rows[1]['start'], '2016-01-01T12:00:02')
+
+            csv_path = os.path.join(work_dir, 'timeline.csv')
+            timeline.export(self.rows, csv_path)
+            with open(csv_path) as f:
+                rows = list(csv.DictReader(f))
+            compare(len(rows), 5)
+            compare(rows[2]['seconds'], '600.0')
+        finally:
+            shutil.rmtree(work_dir)
@@ -0,0 +1,489 @@
+import copy
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import boto.cloudformation.connection
+import boto.exception
+
+import boto3
+
+import mock
+
+from testfixtures import compare
+
+from bootstrap_cfn import api_metrics, errors, utils
+
+
+class TestMergeLayers(unittest.TestCase):
+
+    def test_merge_matches_dict_merge(self):
+        defaults = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': {'f': 4}, 'g': {'h': 5}}
+        user = {'b': {'c': 20}, 'e': [1, 2], 'g': 'ignored', 'i': {'j': 6}}
+        passwords = {'b': {'d': 30}}
+
+        merged, _ = utils.merge_layers([defaults, user, passwords])
+
+        expected = utils.dict_merge(copy.deepcopy(defaults), user, passwords)
+        compare(merged, expected)
+
+    def test_merge_shares_untouched_values(self):
+        defaults = {'a': {'big': range(10)}, 'b': {'c': 1}}
+        user = {'b': {'c': 2}, 'd': {'e': range(10)}}
+
+        merged, _ = utils.merge_layers([defaults, user])
+
+        self.assertIs(merged['a'], defaults['a'])
+        self.assertIs(merged['d'], user['d'])
+        self.assertIsNot(merged['b'], defaults['b'])
+        # Layers are never modified
+        compare(defaults, {'a': {'big': range(10)}, 'b': {'c': 1}})
+
+    def test_non_dict_layer_replaces(self):
+        merged, sources = utils.merge_layers([{'a': 1}, [1, 2]], names=['defaults', 'user'])
+        compare(merged, [1, 2])
+        self.assertEqual(utils.layer_source(sources, ()), 'user')
+
+    def test_layer_source(self):
+        merged, sources = utils.merge_layers(
+            [{'rds': {'storage': 5, 'engine': 'postgres'}},
+             {'rds': {'db-name': 'test'}, 'tags': {'Role': 'docker'}},
+             {'rds': {'password': 'secret'}}],
+            names=['defaults', 'user', 'passwords'])
+
+        self.assertEqual(utils.layer_source(sources, ('rds', 'storage')), 'defaults')
+        self.assertEqual(utils.layer_source(sources, ('rds', 'db-name')), 'user')
+        self.assertEqual(utils.layer_source(sources, ('tags', 'Role')), 'user')
+        self.assertEqual(utils.layer_source(sources, ('rds', 'password')), 'passwords')
+
+    def test_replaced_subtree_forgets_deeper_sources(self):
+        _, sources = utils.merge_layers(
+            [{}, {'a': {'b': {'c': 1}}}, {'a': {'b': {'d': 2}}}, {'a': {'b': 'x', 'e': 3}}],
+            names=['zero', 'one', 'two', 'three'])
+        self.assertEqual(utils.layer_source(sources, ('a', 'b', 'c')), 'one')
+        self.assertEqual(utils.layer_source(sources, ('a', 'b', 'd')), 'two')
+        self.assertEqual(utils.layer_source(sources, ('a', 'e')), 'three')
+
+
+class EventPage(list):
+    """A page of describe_stack_events results"""
+
+    def __init__(self, events, next_token=None):
+        super(EventPage, self).__init__(events)
+        self.next_token = next_token
+
+
+def stack_event(n):
+    return mock.Mock(event_id='event-{0}'.format(n),
+                     timestamp=datetime.datetime(2016, 1, 1) + datetime.timedelta(seconds=n))
+
+
+class TestEventTailer(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [stack_event(n) for n in range(5)]
+        self.stack = mock.Mock()
+        self.stack.conn_cfn.describe_stack_events.side_effect = self.describe_stack_events
+
+    def describe_stack_events(self, stack_name, next_token=None):
+        # Newest first, two events per page
+        events = list(reversed(self.events))
+        start = int(next_token or 0)
+        end = start + 2
+        return EventPage(events[start:end], str(end) if end < len(events) else None)
+
+    def event_ids(self, events):
+        return [e.event_id for e in events]
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    def test_new_events(self, mock_sleep):
+        describe = self.stack.conn_cfn.describe_stack_events
+        tailer = utils.EventTailer(self.stack, 'my-stack')
+        compare(self.event_ids(tailer.new_events()),
+                ['event-0', 'event-1', 'event-2', 'event-3', 'event-4'])
+        compare(describe.call_count, 3)
+
+        # Two new events fill the first page, so we need the second to be
+        # sure we've caught up
+        self.events.extend([stack_event(5), stack_event(6)])
+        describe.reset_mock()
+        compare(self.event_ids(tailer.new_events()), ['event-5', 'event-6'])
+        compare(describe.call_count, 2)
+
+        self.events.append(stack_event(7))
+        describe.reset_mock()
+        compare(self.event_ids(tailer.new_events()), ['event-7'])
+        describe.assert_called_once_with('my-stack', None)
+
+        describe.reset_mock()
+        compare(tailer.new_events(), [])
+        compare(describe.call_count, 1)
+
+    def test_skip_history(self):
+        tailer = utils.EventTailer(self.stack, 'my-stack')
+        tailer.skip_history()
+        self.events.append(stack_event(5))
+        compare(self.event_ids(tailer.new_events()), ['event-5'])
+
+    def test_missing_stack(self):
+        self.stack.conn_cfn.describe_stack_events.side_effect = boto.exception.BotoServerError(
+            400, 'Bad Request', 'Stack [my-stack] does not exist')
+        tailer = utils.EventTailer(self.stack, 'my-stack')
+        compare(tailer.new_events(), [])
+        tailer.skip_history()
+        compare(tailer.new_events(), [])
+
+    @mock.patch('bootstrap_cfn.utils.time.sleep')
+    @mock.patch('bootstrap_cfn.utils.format_event', side_effect=lambda e: e.event_id)
+    def test_tail_shows_final_events(self, format_event, mock_sleep):
+        def done():
+            # The stack finishes, logging its last event, as we look
+            self.events.append(stack_event(5))
+            return True
+
+        utils.tail(self.stack, 'my-stack', done=done, history=False)
+        compare([c[0][0].event_id for c in format_event.call_args_list], ['event-5'])
+        self.assertFalse(mock_sleep.called)
+
+
+class FakeClock(object):
+    """Stands in for the monotonic clock and time.sleep"""
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [mock.patch('bootstrap_cfn.utils._monotonic', self.clock.monotonic),
+                    mock.patch('bootstrap_cfn.utils.time.sleep', self.clock.sleep)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_backoff(self):
+        results = [None] * 6 + ['done']
+        poller = utils.Poller(3600, initial_interval=1, max_interval=10, jitter=0)
+        compare(poller.wait(results.pop, 0), 'done')
+        compare(self.clock.sleeps, [1, 2, 4, 8, 10, 10])
+        compare(poller.attempts, 7)
+        compare(poller.elapsed, 35)
+
+    def test_jitter(self):
+        results = [None] * 20 + ['done']
+        utils.Poller(3600, initial_interval=1, max_interval=10, jitter=0.1).wait(results.pop, 0)
+        for sleep, interval in zip(self.clock.sleeps, [1, 2, 4, 8] + [10] * 16):
+            self.assertTrue(interval * 0.9 <= sleep <= interval * 1.1)
+
+    def test_timeout(self):
+        func = mock.Mock(return_value=False, __name__='stack_done')
+        poller = utils.Poller(20, initial_interval=1, max_interval=10, jitter=0)
+        with self.assertRaises(errors.CfnTimeoutError):
+            poller.wait(func)
+        # The last wait is cut short so we check once more at the deadline
+        compare(self.clock.sleeps, [1, 2, 4, 8, 5])
+        compare(self.clock.now, 20)
+        compare(func.call_count, 6)
+
+    def test_timeout_decorator(self):
+        func = mock.Mock(side_effect=[False, False, True], __name__='stack_done')
+        self.assertTrue(utils.timeout(60, 30)(func)('my-stack'))
+        func.assert_called_with('my-stack')
+        # Starts off polling quickly whatever the interval
+        compare(len(self.clock.sleeps), 2)
+        self.assertTrue(self.clock.sleeps[0] <= 1.1)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [mock.patch('bootstrap_cfn.utils._monotonic', self.clock.monotonic),
+                    mock.patch('bootstrap_cfn.utils.time.sleep', self.clock.sleep)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_burst_then_rate(self):
+        limiter = utils.RateLimiter(2, burst=3)
+        for _ in range(3):
+            compare(limiter.acquire(), 0)
+        compare(limiter.acquire(), 0.5)
+        compare(limiter.acquire(), 0.5)
+        compare(self.clock.now, 1)
+
+    def test_tokens_refill(self):
+        limiter = utils.RateLimiter(1, burst=2)
+        limiter.acquire()
+        limiter.acquire()
+        self.clock.now += 10
+        # Only burst tokens are saved up
+        compare(limiter.acquire(), 0)
+        compare(limiter.acquire(), 0)
+        compare(limiter.acquire(), 1)
+
+
+class TestApiThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [mock.patch('bootstrap_cfn.utils._monotonic', self.clock.monotonic),
+                    mock.patch('bootstrap_cfn.utils.time.sleep', self.clock.sleep)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        api_metrics.metrics.reset()
+        self.addCleanup(api_metrics.metrics.reset)
+        self.conn = boto.cloudformation.connection.CloudFormationConnection(
+            aws_access_key_id='access', aws_secret_access_key='secret')
+
+    def throttled_response(self):
+        response = mock.Mock(status=400)
+        response.read.return_value = '<ErrorResponse><Error><Code>Throttling</Code></Error></ErrorResponse>'
+        return response
+
+    def test_parse_rate_limits(self):
+        compare(utils.parse_rate_limits('cloudformation=2; route53=0.5,default=20'),
+                {'cloudformation': 2, 'route53': 0.5, 'default': 20})
+        compare(utils.parse_rate_limits(''), {})
+        with self.assertRaises(errors.BootstrapCfnError):
+            utils.parse_rate_limits('cloudformation')
+
+    def test_limiters_shared_per_service(self):
+        throttle = utils.ApiThrottle({'cloudformation': 2})
+        self.assertIs(throttle.limiter('cloudformation'), throttle.limiter('cloudformation'))
+        compare(throttle.limiter('cloudformation').rate, 2)
+        compare(throttle.limiter('ec2').rate, utils.DEFAULT_API_RATE_LIMITS['default'])
+
+        throttle.configure({'ec2': 1}, max_retries=2)
+        compare(throttle.limiter('ec2').rate, 1)
+        compare(throttle.limiter('cloudformation').rate, 2)
+        compare(throttle.max_retries, 2)
+        compare(throttle.client_config().retries, {'mode': 'standard', 'max_attempts': 2})
+
+    @mock.patch('bootstrap_cfn.utils.random.uniform', lambda low, high: high)
+    def test_connection_retries_throttled_calls(self):
+        ok = mock.Mock(status=200)
+        self.conn.make_request = mock.Mock(side_effect=[
+            self.throttled_response(),
+            boto.exception.BotoServerError(400, 'Bad Request',
+                                           '<ErrorResponse><Error><Code>Throttling</Code></Error></ErrorResponse>'),
+            ok])
+        utils.ApiThrottle().wrap_connection(self.conn, 'cloudformation')
+
+        self.assertIs(self.conn.make_request('DescribeStacks', {}, '/', 'POST'), ok)
+        compare(self.clock.sleeps, [0.5, 1.0])
+        compare([(row['operation'], row['retries'], row['throttles']) for row in api_metrics.metrics.summary()],
+                [('DescribeStacks', 2, 2)])
+
+    def test_connection_gives_up(self):
+        throttled = self.throttled_response()
+        make_request = self.conn.make_request = mock.Mock(return_value=throttled)
+        utils.ApiThrottle(max_retries=3).wrap_connection(self.conn, 'cloudformation')
+
+        self.assertIs(self.conn.make_request('DescribeStacks', {}, '/', 'POST'), throttled)
+        compare(make_request.call_count, 4)
+        compare(api_metrics.metrics.summary()[0]['retries'], 3)
+
+    def test_connection_doesnt_retry_other_errors(self):
+        self.conn.make_request = mock.Mock(side_effect=boto.exception.BotoServerError(
+            400, 'Bad Request', '<ErrorResponse><Error><Code>ValidationError</Code></Error></ErrorResponse>'))
+        utils.ApiThrottle().wrap_connection(self.conn, 'cloudformation')
+
+        with self.assertRaises(boto.exception.BotoServerError):
+            self.conn.make_request('DescribeStacks', {}, '/', 'POST')
+        compare(self.clock.sleeps, [])
+
+    def test_connection_rate_limited(self):
+        self.conn.make_request = mock.Mock(return_value=mock.Mock(status=200))
+        utils.ApiThrottle({'cloudformation': 2}).wrap_connection(self.conn, 'cloudformation')
+        for _ in range(4):
+            self.conn.make_request('DescribeStacks', {}, '/', 'POST')
+        compare(self.clock.now, 1)
+
+    def test_client_rate_limited(self):
+        throttle = utils.ApiThrottle({'cloudformation': 2})
+        client = boto3.session.Session(aws_access_key_id='access', aws_secret_access_key='secret',
+                                       region_name='eu-west-1').client('cloudformation')
+        throttle.wrap_client(client)
+        for _ in range(4):
+            client.meta.events.emit('before-send.cloudformation.DescribeStacks', request=None)
+        compare(self.clock.now, 1)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.module = mock.Mock(__name__='boto.fake')
+        self.module.connect_to_region.side_effect = lambda **kwargs: mock.Mock()
+
+    def instance(self, profile='dev', region='eu-west-1'):
+        return mock.Mock(aws_profile_name=profile, aws_region_name=region)
+
+    @mock.patch.dict('os.environ', clear=True)
+    def test_connections_shared(self):
+        pool = utils.ConnectionPool()
+        with mock.patch('bootstrap_cfn.utils.connections', pool):
+            conn = utils.connect_to_aws(self.module, self.instance())
+            self.assertIs(utils.connect_to_aws(self.module, self.instance()), conn)
+            self.assertIsNot(utils.connect_to_aws(self.module, self.instance(region='us-east-1')), conn)
+            self.assertIsNot(utils.connect_to_aws(self.module, self.instance(profile='prod')), conn)
+        compare(self.module.connect_to_region.call_count, 3)
+        self.module.connect_to_region.assert_any_call(region_name='eu-west-1', profile_name='dev')
+
+        pool.clear()
+        self.assertIsNot(pool.connection(self.module, 'dev', 'eu-west-1'), conn)
+
+    def assume_role(self, mock_sts, expires_in=3600):
+        def assume_role(**kwargs):
+            expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
+            return mock.Mock(credentials=mock.Mock(
+                access_key='AKIA{0}'.format(mock_sts.return_value.assume_role.call_count),
+                secret_key='secret', session_token='token',
+                expiration=expiration.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        mock_sts.return_value.assume_role.side_effect = assume_role
+
+    @mock.patch.dict('bootstrap_cfn.utils._role_credentials', clear=True)
+    @mock.patch('boto.sts.connect_to_region')
+    def test_connections_keyed_on_role(self, mock_sts):
+        self.assume_role(mock_sts)
+        pool = utils.ConnectionPool()
+        with mock.patch.dict('os.environ', {'AWS_ROLE_ARN_ID': 'arn:aws:iam::123456789012:role/one'}):
+            conn = pool.connection(self.module, 'dev', 'eu-west-1')
+            self.assertIs(pool.connection(self.module, 'dev', 'eu-west-1'), conn)
+        with mock.patch.dict('os.environ', {'AWS_ROLE_ARN_ID': 'arn:aws:iam::123456789012:role/two'}):
+            self.assertIsNot(pool.connection(self.module, 'dev', 'eu-west-1'), conn)
+        compare(mock_sts.return_value.assume_role.call_count, 2)
+
+    @mock.patch.dict('bootstrap_cfn.utils._role_credentials', clear=True)
+    @mock.patch.dict('os.environ', {'AWS_ROLE_ARN_ID': 'arn:aws:iam::123456789012:role/one'})
+    @mock.patch('boto.sts.connect_to_region')
+    def test_connection_renewed_with_credentials(self, mock_sts):
+        # Credentials that are already due for renewal
+        self.assume_role(mock_sts, expires_in=utils.CREDENTIALS_EXPIRY_MARGIN - 10)
+        pool = utils.ConnectionPool()
+        conn = pool.connection(self.module, 'dev', 'eu-west-1')
+        self.assertIsNot(pool.connection(self.module, 'dev', 'eu-west-1'), conn)
+        self.module.connect_to_region.assert_called_with(
+            region_name='eu-west-1', aws_access_key_id='AKIA2',
+            aws_secret_access_key='secret', security_token='token')
+
+        self.assume_role(mock_sts)
+        conn = pool.connection(self.module, 'dev', 'eu-west-1')
+        self.assertIs(pool.connection(self.module, 'dev', 'eu-west-1'), conn)
+
+    @mock.patch.dict('bootstrap_cfn.utils._role_credentials', clear=True)
+    @mock.patch.dict('os.environ', {'AWS_ROLE_ARN_ID': 'arn:aws:iam::123456789012:role/one'})
+    @mock.patch('boto.sts.connect_to_region')
+    def test_pooled_connection_renewed(self, mock_sts):
+        class Service:
+            conn = utils.PooledConnection(self.module)
+
+            def __init__(self):
+                self.aws_profile_name = 'dev'
+                self.aws_region_name = 'eu-west-1'
+
+        self.assume_role(mock_sts)
+        pool = utils.ConnectionPool()
+        with mock.patch('bootstrap_cfn.utils.connections', pool):
+            service = Service()
+            conn = service.conn
+            self.assertIs(service.conn, conn)
+            # The credentials expire while the instance is still in use
+            for credentials in utils._role_credentials.values():
+                credentials['expiration'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            self.assertIsNot(service.conn, conn)
+            self.module.connect_to_region.assert_called_with(
+                region_name='eu-west-1', aws_access_key_id='AKIA2',
+                aws_secret_access_key='secret', security_token='token')
+
+            service.conn = mock.sentinel.conn
+            self.assertIs(service.conn, mock.sentinel.conn)
+
+    def test_clients_shared(self):
+        pool = utils.ConnectionPool()
+        session = mock.Mock()
+        session.client.side_effect = lambda *args, **kwargs: mock.Mock()
+        with mock.patch('boto3.DEFAULT_SESSION', session):
+            client = pool.client('ec2')
+            self.assertIs(pool.client('ec2'), client)
+            self.assertIsNot(pool.client('ec2', region_name='us-east-1'), client)
+            self.assertIs(pool.resource('ec2'), pool.resource('ec2'))
+        # A new default session, e.g. from the aws task, gets new clients
+        with mock.patch('boto3.DEFAULT_SESSION', mock.Mock()):
+            self.assertIsNot(pool.client('ec2'), client)
+
+
+@mock.patch.dict('bootstrap_cfn.utils._role_credentials', clear=True)
+@mock.patch('boto.sts.connect_to_region')
+class TestAssumeRoleCredentials(unittest.TestCase):
+
+    role_arn = 'arn:aws:iam::123456789012:role/deploy'
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def credentials(self, mock_sts, expires_in=3600):
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
+        credentials = mock.Mock(access_key='AKIA{0}'.format(mock_sts.return_value.assume_role.call_count),
+                                secret_key='secret',
+                                session_token='token',
+                                expiration=expiration.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return mock.Mock(credentials=credentials)
+
+    def assume_role(self, mock_sts, expires_in=3600):
+        mock_sts.return_value.assume_role.side_effect = \
+            lambda **kwargs: self.credentials(mock_sts, expires_in)
+
+    @mock.patch.dict('os.environ', clear=True)
+    def test_reused_in_memory(self, mock_sts):
+        self.assume_role(mock_sts)
+        first = utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+        second = utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+        compare(second, first)
+        compare(mock_sts.return_value.assume_role.call_count, 1)
+        mock_sts.return_value.assume_role.assert_called_with(
+            role_arn=self.role_arn, role_session_name="AssumeRoleSession1")
+
+    @mock.patch.dict('os.environ', clear=True)
+    def test_renewed_before_expiry(self, mock_sts):
+        self.assume_role(mock_sts, expires_in=utils.CREDENTIALS_EXPIRY_MARGIN - 10)
+        utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+        utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+        compare(mock_sts.return_value.assume_role.call_count, 2)
+
+    def test_disk_cache(self, mock_sts):
+        self.assume_role(mock_sts)
+        cache_dir = os.path.join(self.work_dir, 'credentials')
+        with mock.patch.dict('os.environ', {'BOOTSTRAP_CFN_CREDENTIALS_CACHE': cache_dir}):
+            first = utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+            # As if from another process
+            utils._role_credentials.clear()
+            compare(utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn), first)
+        compare(mock_sts.return_value.assume_role.call_count, 1)
+        cache_files = [name for name in os.listdir(cache_dir) if name.endswith('.json')]
+        compare(len(cache_files), 1)
+        compare(stat.S_IMODE(os.stat(os.path.join(cache_dir, cache_files[0])).st_mode), 0o600)
+
+    def test_disk_cache_expired(self, mock_sts):
+        self.assume_role(mock_sts, expires_in=60)
+        with mock.patch.dict('os.environ', {'BOOTSTRAP_CFN_CREDENTIALS_CACHE': self.work_dir}):
+            utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+            utils._role_credentials.clear()
+            second = utils.assume_role_credentials('dev', 'eu-west-1', self.role_arn)
+        compare(second['access_key'], 'AKIA2')
+        compare(mock_sts.return_value.assume_role.call_count, 2)
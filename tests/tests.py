@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 import json
+import os
+import shutil
+import tempfile
 import unittest
 from StringIO import StringIO
 
@@ -19,7 +22,7 @@ import yaml
 
 from bootstrap_cfn import errors
 from bootstrap_cfn import mime_packer
-from bootstrap_cfn.config import ConfigParser, ProjectConfig
+from bootstrap_cfn.config import ConfigParser, IndexedTemplate, ProjectConfig, section_builder
 
 
 class TestConfig(unittest.TestCase):
@@ -52,6 +55,46 @@ class TestConfig(unittest.TestCase):
             config.config['rds']['db-master-password'],
             'testpassword')
 
+    def test_load_yaml_parses_once(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        path = os.path.join(work_dir, 'config.yaml')
+        with open(path, 'w') as f:
+            f.write('dev:\n  ec2: {tags: {Role: docker}}\n')
+
+        with patch('yaml.load', wraps=yaml.load) as yaml_load:
+            first = ProjectConfig.load_yaml(path)
+            first['dev']['ec2']['tags']['Role'] = 'changed'
+            second = ProjectConfig.load_yaml(path)
+        self.assertEqual(yaml_load.call_count, 1)
+        # Callers get their own copy to modify
+        self.assertEqual(second['dev']['ec2']['tags']['Role'], 'docker')
+
+        # A changed file is parsed again
+        with open(path, 'w') as f:
+            f.write('dev:\n  ec2: {tags: {Role: changed-role}}\n')
+        os.utime(path, (0, 0))
+        self.assertEqual(ProjectConfig.load_yaml(path)['dev']['ec2']['tags']['Role'], 'changed-role')
+
+    def test_load_yaml_disk_cache(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        path = os.path.join(work_dir, 'config.yaml')
+        cache_dir = os.path.join(work_dir, 'cache')
+        with open(path, 'w') as f:
+            f.write('dev:\n  ec2: {}\n')
+
+        expected = ProjectConfig.load_yaml(path, cache_dir)
+        cache_files = os.listdir(cache_dir)
+        self.assertEqual(len(cache_files), 1)
+        self.assertTrue(cache_files[0].endswith('.marshal'))
+        self.assertEqual(os.stat(os.path.join(cache_dir, cache_files[0])).st_mode & 0o777, 0o600)
+        # Simulate another process that hasn't parsed the file yet
+        with patch.dict('bootstrap_cfn.config._parsed_yaml', clear=True):
+            with patch('yaml.load') as yaml_load:
+                compare(ProjectConfig.load_yaml(path, cache_dir), expected)
+        self.assertFalse(yaml_load.called)
+
 
 class TestConfigParser(unittest.TestCase):
 
@@ -910,6 +953,168 @@ class TestConfigParser(unittest.TestCase):
         }
         compare(mappings, expected)
 
+    def test_process_compact(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        project_config.config['includes'] = ['tests/sample-include.json']
+        config = ConfigParser(project_config.config, 'my-stack-name')
+
+        compact = config.process(compact=True)
+        indented = config.process()
+
+        self.assertNotIn('\n', compact.replace('\\n', ''))
+        self.assertLess(len(compact), len(indented))
+        compact_template = json.loads(compact)
+        indented_template = json.loads(indented)
+        compare(sorted(compact_template['Resources'].keys()),
+                sorted(indented_template['Resources'].keys()))
+        compare(compact_template['Outputs'], indented_template['Outputs'])
+
+    def test_size_report(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = ConfigParser(project_config.config, 'my-stack-name')
+        template_body = config.process()
+        report = ConfigParser.size_report(template_body)
+
+        compare(report['total'], len(template_body))
+        compare(report['compact'], len(config.process(compact=True)))
+        compare(sorted(report['sections']),
+                ['Mappings', 'Outputs', 'Resources'])
+        sizes = [size for _, _, size in report['resources']]
+        compare(sizes, sorted(sizes, reverse=True))
+        # The launch config carries the user data
+        compare(report['resources'][0][:2], ('BaseHostLaunchConfig', 'AWS::AutoScaling::LaunchConfiguration'))
+        # Resources plus the braces and commas around them
+        compare(sum(sizes) + len(sizes) + 1, report['sections']['Resources'])
+
+    def test_process_builds_sections_once(self):
+        class CountingParser(ConfigParser):
+            vpc_builds = 0
+
+            @section_builder
+            def vpc(self):
+                self.vpc_builds += 1
+                return super(CountingParser, self).vpc()
+
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = CountingParser(project_config.config, 'my-stack-name')
+        config.process()
+        self.assertEqual(config.vpc_builds, 1)
+        # ec2 depends on the vpc gateway attachment built for the render
+        self.assertIs(config.vpc()[0], config.vpc()[0])
+        self.assertEqual(config.vpc_builds, 1)
+
+        config.invalidate_sections('vpc')
+        config.vpc()
+        self.assertEqual(config.vpc_builds, 2)
+        # Nothing has changed, so the next render reuses the section
+        config.process()
+        self.assertEqual(config.vpc_builds, 2)
+
+    def test_process_rebuilds_changed_sections(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = ConfigParser(project_config.config, 'my-stack-name')
+        first = json.loads(config.process())
+
+        config.data['elb'][0]['listeners'][0]['LoadBalancerPort'] = 8080
+        with patch('bootstrap_cfn.config.mime_packer.pack') as pack, \
+                patch.object(ConfigParser, 'rds', wraps=config.rds) as rds:
+            second = json.loads(config.process())
+        # Only the elb section was rebuilt
+        self.assertFalse(pack.called)
+        self.assertFalse(rds.called)
+        compare(second['Resources']['ELBtestdevexternal']['Properties']['Listeners'][0]['LoadBalancerPort'],
+                8080)
+        compare(second['Resources']['RDSInstance'], first['Resources']['RDSInstance'])
+        compare(second['Resources']['BaseHostLaunchConfig'], first['Resources']['BaseHostLaunchConfig'])
+        compare(second['Resources']['ScalingGroup']['Properties']['LoadBalancerNames'],
+                [{'Ref': 'ELBtestdevexternal'}, {'Ref': 'ELBtestdevinternal'}])
+        compare(sorted(second['Outputs']), sorted(first['Outputs']))
+
+        # Same as a fresh render of the changed config
+        fresh = json.loads(ConfigParser(config.data, 'my-stack-name').process())
+        compare(second, fresh)
+
+    def test_process_detaches_removed_elbs(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = ConfigParser(project_config.config, 'my-stack-name')
+        config.process()
+        config.data.pop('elb')
+        template = json.loads(config.process())
+        self.assertNotIn('LoadBalancerNames', template['Resources']['ScalingGroup']['Properties'])
+        self.assertNotIn('ELBtestdevexternal', template['Resources'])
+
+    def test_process_repeat_rds_identifier(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = ConfigParser(project_config.config, 'my-stack-12345678')
+        config.process()
+        # Changing rds rebuilds it, without the stack id added twice
+        config.data['rds']['storage'] = 10
+        template = json.loads(config.process())
+        compare(template['Resources']['RDSInstance']['Properties']['DBInstanceIdentifier'],
+                'test-dev-12345678')
+        compare(config.data['rds']['identifier'], 'test-dev')
+
+    def test_process_rebuilds_s3_when_policy_file_changes(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        policy_path = os.path.join(work_dir, 'policy.json')
+        with open(policy_path, 'w') as f:
+            json.dump({'Action': ['s3:GetObject'], 'Effect': 'Allow', 'Principal': '*'}, f)
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        project_config.config['s3']['policy'] = policy_path
+        config = ConfigParser(project_config.config, 'my-stack-name')
+        config.process()
+
+        with open(policy_path, 'w') as f:
+            json.dump({'Action': ['s3:PutObject'], 'Effect': 'Allow', 'Principal': '*'}, f)
+        template = json.loads(config.process())
+        compare(template['Resources']['StaticBucketPolicy']['Properties']['PolicyDocument'],
+                {'Statement': [{'Action': ['s3:PutObject'], 'Effect': 'Allow', 'Principal': '*'}]})
+
+    def test_indexed_template_find_resources(self):
+        project_config = ProjectConfig(
+            'tests/sample-project.yaml',
+            'dev',
+            'tests/sample-project-passwords.yaml')
+        config = ConfigParser(project_config.config, 'my-stack-name')
+        indexed = IndexedTemplate()
+        plain = Template()
+        for template in [indexed, plain]:
+            map(template.add_resource, config.vpc())
+            template.add_resource(config.ec2())
+            config.elb(template)
+
+        for resource_type in ['AWS::EC2::SecurityGroup',
+                              'AWS::ElasticLoadBalancing::LoadBalancer',
+                              'AWS::EC2::VPCGatewayAttachment',
+                              'AWS::RDS::DBInstance']:
+            compare(sorted(r.title for r in config._find_resources(indexed, resource_type)),
+                    sorted(r.title for r in config._find_resources(plain, resource_type)))
+        # Index keeps the order the ELBs were configured in
+        compare([r.title for r in config._find_resources(indexed, 'AWS::ElasticLoadBalancing::LoadBalancer')],
+                ['ELBtestdevexternal', 'ELBtestdevinternal'])
+
     def test_process_with_vpc_config(self):
         """
         This isn't the best test, but we at least check that we have the right